@@ -0,0 +1,349 @@
+"""In-memory stand-in for the GCS JSON API, enough for the storage client calls the app makes.
+
+Point the app at it with STORAGE_EMULATOR_HOST:
+
+    python benchmarks/fake_gcs.py --port 4443 --bucket bench --objects 100000
+    STORAGE_EMULATOR_HOST=http://127.0.0.1:4443 flask --app "storage_explorer:app()" run
+
+Seeded objects only keep their metadata; their content is generated on read.
+"""
+import argparse, base64, bisect, datetime, email.parser, hashlib, json, re, threading, uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import google_crc32c
+
+# Last code point, to skip a whole "folder/" subtree of a sorted name list with one bisect.
+_MAX_CHAR = '\U0010ffff'
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+_CONTENT_RANGE = re.compile(r'bytes (?:(\d+)-(\d+)|\*)/(\d+|\*)$')
+
+
+class FakeBucket:
+    """Objects of a bucket: names kept sorted, so prefix and delimiter listings are bisections."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.names = []
+        self.objects = {}  # name -> (size, generation, updated, content_type, data or None)
+        self.lock = threading.Lock()
+
+    def put(self, name: str, size: int, generation: int, data: bytes = None, content_type: str = None) -> None:
+        with self.lock:
+            if name not in self.objects:
+                bisect.insort(self.names, name)
+            self.objects[name] = (size, generation, _now(), content_type, data)
+
+    def seed(self, names, size_of) -> None:
+        """Add many objects at once, sorting the names only once."""
+        updated = _now()
+        with self.lock:
+            for generation, name in enumerate(names, 1):
+                self.objects[name] = (size_of(name), generation, updated, 'text/plain', None)
+            self.names = sorted(self.objects)
+
+    def delete(self, name: str) -> bool:
+        with self.lock:
+            if self.objects.pop(name, None) is None:
+                return False
+            del self.names[bisect.bisect_left(self.names, name)]
+            return True
+
+    def list(self, prefix: str, delimiter: str, start: str, max_results: int) -> tuple:
+        items, prefixes = [], []
+        with self.lock:
+            names = self.names
+            i = bisect.bisect_left(names, max(start or '', prefix))
+            while i < len(names) and len(items) + len(prefixes) < max_results:
+                name = names[i]
+                if not name.startswith(prefix):
+                    break
+                cut = name.find(delimiter, len(prefix)) if delimiter else -1
+                if cut != -1:
+                    prefixes.append(name[:cut + 1])
+                    i = bisect.bisect_left(names, name[:cut + 1] + _MAX_CHAR)
+                    continue
+                items.append(name)
+                i += 1
+            next_token = names[i] if i < len(names) and names[i].startswith(prefix) else None
+        return items, prefixes, next_token
+
+
+class FakeGCS:
+    """Buckets plus the HTTP server serving them."""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.buckets = {}
+        self.sessions = {}
+        self._generation = 10 ** 6
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _handler_for(self))
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def bucket(self, name: str, create: bool = True) -> FakeBucket:
+        with self._lock:
+            if name not in self.buckets and create:
+                self.buckets[name] = FakeBucket(name)
+            return self.buckets.get(name)
+
+    def next_generation(self) -> int:
+        with self._lock:
+            self._generation += 1
+            return self._generation
+
+    def start(self) -> 'FakeGCS':
+        threading.Thread(target=self.server.serve_forever, name="fake-gcs", daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _handler_for(gcs: FakeGCS):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            path, query = self._parse()
+            if path.startswith('/download/storage/v1/b/'):
+                return self._download(*self._bucket_and_object(path[len('/download/storage/v1/b/'):]))
+            if path.startswith('/storage/v1/b/'):
+                bucket_name, name = self._bucket_and_object(path[len('/storage/v1/b/'):])
+                if name is None and path.endswith('/o'):
+                    return self._list(bucket_name, query)
+                if name is None:
+                    bucket = gcs.bucket(bucket_name, create=False)
+                    return self._json(200, {'kind': 'storage#bucket', 'name': bucket_name}) if bucket else self._error(404)
+                if query.get('alt') == 'media':
+                    return self._download(bucket_name, name)
+                return self._metadata(bucket_name, name)
+            self._error(404)
+
+        def do_POST(self):
+            path, query = self._parse()
+            if path == '/storage/v1/b':
+                body = self._read_json()
+                if gcs.bucket(body['name'], create=False) is not None:
+                    return self._error(409)
+                gcs.bucket(body['name'])
+                return self._json(200, {'kind': 'storage#bucket', 'name': body['name']})
+            if path.startswith('/upload/storage/v1/b/'):
+                bucket_name = path[len('/upload/storage/v1/b/'):].split('/', 1)[0]
+                upload_type = query.get('uploadType')
+                if upload_type == 'resumable':
+                    return self._start_resumable(bucket_name, query)
+                if upload_type == 'multipart':
+                    return self._multipart(bucket_name)
+                data = self._read_body()
+                return self._store(bucket_name, query.get('name'), data, self.headers.get('Content-Type'))
+            self._error(404)
+
+        def do_PUT(self):
+            path, _ = self._parse()
+            if path.startswith('/upload/session/'):
+                return self._resumable_chunk(path[len('/upload/session/'):])
+            self._error(404)
+
+        def do_DELETE(self):
+            path, _ = self._parse()
+            if path.startswith('/storage/v1/b/'):
+                bucket_name, name = self._bucket_and_object(path[len('/storage/v1/b/'):])
+                bucket = gcs.bucket(bucket_name, create=False)
+                if bucket is not None and name and bucket.delete(name):
+                    return self._send(204, b'')
+            self._error(404)
+
+        # Endpoints
+        def _list(self, bucket_name, query):
+            bucket = gcs.bucket(bucket_name, create=False)
+            if bucket is None:
+                return self._error(404)
+            items, prefixes, next_token = bucket.list(
+                query.get('prefix', ''),
+                query.get('delimiter'),
+                query.get('pageToken'),
+                min(int(query.get('maxResults', 1000)), 1000),
+            )
+            body = {'kind': 'storage#objects', 'items': [self._resource(bucket, name) for name in items]}
+            if prefixes:
+                body['prefixes'] = prefixes
+            if next_token:
+                body['nextPageToken'] = next_token
+            self._json(200, body)
+
+        def _metadata(self, bucket_name, name):
+            bucket = gcs.bucket(bucket_name, create=False)
+            if bucket is None or name not in bucket.objects:
+                return self._error(404)
+            self._json(200, self._resource(bucket, name))
+
+        def _download(self, bucket_name, name):
+            bucket = gcs.bucket(bucket_name, create=False)
+            entry = bucket.objects.get(name) if bucket else None
+            if entry is None:
+                return self._error(404)
+            size, generation, _, content_type, data = entry
+            data = data if data is not None else _content(name, size)
+            start, end, status = 0, size - 1, 200
+            match = _RANGE.match(self.headers.get('Range', ''))
+            if match and size:
+                first, last = match.groups()
+                if first:
+                    start, end = int(first), min(int(last), size - 1) if last else size - 1
+                else:
+                    start = max(size - int(last), 0)
+                status = 206
+            self.send_response(status)
+            self.send_header('Content-Type', content_type or 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1 if size else 0))
+            self.send_header('X-Goog-Generation', str(generation))
+            if status == 206:
+                self.send_header('Content-Range', f"bytes {start}-{end}/{size}")
+            self.end_headers()
+            self.wfile.write(data[start:end + 1])
+
+        def _start_resumable(self, bucket_name, query):
+            metadata = self._read_json() if int(self.headers.get('Content-Length') or 0) else {}
+            session_id = uuid.uuid4().hex
+            gcs.sessions[session_id] = {
+                'bucket': bucket_name,
+                'name': metadata.get('name') or query.get('name'),
+                'content_type': metadata.get('contentType') or self.headers.get('X-Upload-Content-Type'),
+                'data': bytearray(),
+            }
+            self.send_response(200)
+            self.send_header('Location', f"{gcs.url}/upload/session/{session_id}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def _resumable_chunk(self, session_id):
+            session = gcs.sessions.get(session_id)
+            if session is None:
+                return self._error(404)
+            chunk = self._read_body()
+            match = _CONTENT_RANGE.match(self.headers.get('Content-Range', ''))
+            if match is None:
+                return self._error(400)
+            first, _, total = match.groups()
+            if first is not None and int(first) == len(session['data']):
+                session['data'] += chunk
+            if total != '*' and len(session['data']) == int(total):
+                del gcs.sessions[session_id]
+                return self._store(session['bucket'], session['name'], bytes(session['data']), session['content_type'])
+            self.send_response(308)
+            if session['data']:
+                self.send_header('Range', f"bytes=0-{len(session['data']) - 1}")
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def _multipart(self, bucket_name):
+            raw = self._read_body()
+            message = email.parser.BytesParser().parsebytes(
+                b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + raw
+            )
+            metadata_part, media_part = message.get_payload()
+            metadata = json.loads(metadata_part.get_payload(decode=True))
+            return self._store(bucket_name, metadata['name'], media_part.get_payload(decode=True), media_part.get_content_type())
+
+        def _store(self, bucket_name, name, data, content_type):
+            bucket = gcs.bucket(bucket_name, create=False)
+            if bucket is None or not name:
+                return self._error(404)
+            bucket.put(name, len(data), gcs.next_generation(), data, content_type)
+            self._json(200, self._resource(bucket, name))
+
+        # Utils
+        def _resource(self, bucket, name):
+            size, generation, updated, content_type, data = bucket.objects[name]
+            resource = {
+                'kind': 'storage#object',
+                'id': f"{bucket.name}/{name}/{generation}",
+                'name': name,
+                'bucket': bucket.name,
+                'generation': str(generation),
+                'metageneration': '1',
+                'contentType': content_type or 'application/octet-stream',
+                'size': str(size),
+                'updated': updated,
+                'timeCreated': updated,
+            }
+            if data is not None:
+                resource['md5Hash'] = base64.b64encode(hashlib.md5(data).digest()).decode()
+                resource['crc32c'] = base64.b64encode(google_crc32c.Checksum(data).digest()).decode()
+            return resource
+
+        def _parse(self):
+            parts = urlsplit(self.path)
+            return parts.path, {key: values[-1] for key, values in parse_qs(parts.query).items()}
+
+        def _bucket_and_object(self, rest):
+            bucket_name, _, tail = rest.partition('/')
+            if tail.startswith('o/'):
+                return bucket_name, unquote(tail[2:])
+            return bucket_name, None
+
+        def _read_body(self) -> bytes:
+            return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+        def _read_json(self) -> dict:
+            return json.loads(self._read_body() or b'{}')
+
+        def _json(self, status, body):
+            self._send(status, json.dumps(body).encode(), 'application/json')
+
+        def _error(self, status):
+            self._read_body()
+            self._json(status, {'error': {'code': status, 'message': 'fake-gcs error', 'errors': []}})
+
+        def _send(self, status, payload, content_type=None):
+            self.send_response(status)
+            if content_type:
+                self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def seed_bucket(bucket: FakeBucket, objects: int, folders: int = None, size: int = 16 * 1024) -> list:
+    """Fill a bucket with synthetic objects spread over two levels of folders; returns their names."""
+    folders = folders or max(1, int(objects ** 0.5) // 4)
+    names = [f"folder-{i % folders:05d}/part-{(i // folders) % 8}/object-{i:07d}.txt" for i in range(objects)]
+    bucket.seed(names, lambda name: size)
+    return names
+
+def _content(name: str, size: int) -> bytes:
+    pattern = (quote(name) + '\n').encode()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+def _now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=4443)
+    parser.add_argument('--bucket', action='append', default=[])
+    parser.add_argument('--objects', type=int, default=0, help="Synthetic objects seeded in each bucket.")
+    args = parser.parse_args(argv)
+
+    gcs = FakeGCS(port=args.port)
+    for name in args.bucket:
+        seed_bucket(gcs.bucket(name), args.objects)
+    print(f"Fake GCS listening on {gcs.url}", flush=True)
+    gcs.server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
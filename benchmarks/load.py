@@ -0,0 +1,74 @@
+"""Fire concurrent GET requests at a running Storage Explorer and report latency and throughput.
+
+Run it once against the gunicorn (WSGI) deployment and once against the
+uvicorn (ASGI) one to compare serving modes:
+
+    python benchmarks/load.py http://localhost:8080/buckets --concurrency 200 --requests 2000 --cookie "session=..."
+"""
+import argparse, json, statistics, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def percentile(samples: list, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def run(url: str, total: int, concurrency: int, cookie: str = None, timeout: float = 60) -> dict:
+    """Send `total` GET requests to url, `concurrency` at a time, and summarize the results."""
+    local = threading.local()
+    headers = {'Cookie': cookie} if cookie else {}
+
+    def one(_):
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=timeout)
+            # Read the whole body, streamed pages included
+            ok = response.status_code < 400 and response.content is not None
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency * 1000 for latency, ok in results if ok]
+    return {
+        'url': url,
+        'requests': total,
+        'concurrency': concurrency,
+        'errors': sum(1 for _, ok in results if not ok),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies), 2) if latencies else 0.0,
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+        },
+    }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--cookie', help="Cookie header of a logged-in session.")
+    args = parser.parse_args(argv)
+
+    json.dump(run(args.url, args.requests, args.concurrency, args.cookie), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
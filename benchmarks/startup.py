@@ -0,0 +1,120 @@
+"""Measure how long a fresh Storage Explorer process takes to import, build the app and serve its first page.
+
+Each run is a new interpreter, as for a gunicorn worker spawn or a Cloud Run
+cold start, with EAGER_STARTUP off so only imports and app setup are timed,
+not connections. Reports medians, the slowest top-level imports and which
+lazily imported dependencies got loaded anyway, as JSON; exits 1 over budget:
+
+    python benchmarks/startup.py --runs 10 --budget 800 --output startup.json
+"""
+import argparse, json, os, statistics, subprocess, sys, tempfile, time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# Dependencies only imported on first use; loading one at startup is a regression.
+DEFERRED_MODULES = ('google.cloud.sql.connector', 'aiohttp', 'pytds', 'google.cloud.storage', 'google.oauth2', 'PIL', 'fitz')
+
+CHILD = """
+import json, sys, time
+started = time.perf_counter()
+import storage_explorer
+imported = time.perf_counter()
+app = storage_explorer.app()
+built = time.perf_counter()
+status = app.test_client().get('/').status_code
+served = time.perf_counter()
+json.dump({
+    'import_ms': (imported - started) * 1000,
+    'app_ms': (built - imported) * 1000,
+    'first_request_ms': (served - built) * 1000,
+    'status': status,
+    'loaded': [name for name in %r if name in sys.modules],
+}, sys.stdout)
+""" % (DEFERRED_MODULES,)
+
+
+def run_once(env: dict, importtime: bool = False) -> tuple:
+    """Start one process; return its measurements, wall time included, and its stderr."""
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD]
+    started = time.perf_counter()
+    process = subprocess.run(command, env=env, cwd=ROOT, capture_output=True, text=True)
+    wall = (time.perf_counter() - started) * 1000
+    if process.returncode != 0:
+        raise RuntimeError(f"Startup failed:\n{process.stderr}")
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result['process_ms'] = wall
+    return result, process.stderr
+
+def slowest_imports(stderr: str, top: int) -> list:
+    """The top-level modules with the largest cumulative import time, from -X importtime output."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Nested imports are indented below the module that caused them
+        if not name[1:].startswith(' '):
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return [{'module': name, 'cumulative_ms': round(ms, 1)} for ms, name in sorted(imports, reverse=True)[:top]]
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix='storage-explorer-startup-')
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{workdir}/startup.db",
+        # Never contacted with EAGER_STARTUP off; it only lets the factory accept a fake key
+        STORAGE_EMULATOR_HOST='http://127.0.0.1:9',
+        API_KEY=json.dumps({'project_id': 'startup'}),
+        SECRET_KEY='startup',
+        EAGER_STARTUP='false',
+        JOBS_IN_PROCESS='false',
+        PASSWORD_HASH_WORKERS='0',
+        PYTHONPATH=os.pathsep.join(filter(None, (str(ROOT), os.environ.get('PYTHONPATH')))),
+    )
+    env.update(dict(setting.split('=', 1) for setting in args.env))
+
+    runs = [run_once(env)[0] for _ in range(args.runs)]
+    _, stderr = run_once(env, importtime=True)
+
+    def median(key):
+        return round(statistics.median(result[key] for result in runs), 1)
+
+    return {
+        'runs': args.runs,
+        'python': sys.version.split()[0],
+        'median_ms': {key: median(key) for key in ('import_ms', 'app_ms', 'first_request_ms', 'process_ms')},
+        'max_process_ms': round(max(result['process_ms'] for result in runs), 1),
+        'first_request_status': runs[-1]['status'],
+        'deferred_modules_loaded': sorted({name for result in runs for name in result['loaded']}),
+        'slowest_imports': slowest_imports(stderr, args.top),
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="Fresh processes measured.")
+    parser.add_argument('--budget', type=float, help="Allowed median process time, in ms, to the first page served.")
+    parser.add_argument('--top', type=int, default=10, help="Slowest top-level imports listed.")
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="App setting, e.g. SESSION_BACKEND=local.")
+    parser.add_argument('--output', help="Write the results to this file as well.")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    sys.stdout.write(output + '\n')
+
+    failed = False
+    if results['deferred_modules_loaded']:
+        print(f"Loaded at startup: {', '.join(results['deferred_modules_loaded'])}", file=sys.stderr)
+        failed = True
+    if args.budget is not None and results['median_ms']['process_ms'] > args.budget:
+        print(f"Startup took {results['median_ms']['process_ms']} ms, over the {args.budget} ms budget.", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
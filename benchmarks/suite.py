@@ -0,0 +1,357 @@
+"""Benchmark Storage Explorer end to end against a local fake GCS and a local SQL database.
+
+Boots the app in a child process with DATABASE_URL pointing at a SQLite file
+(or --database-url) and STORAGE_EMULATOR_HOST at an in-process fake GCS,
+seeds synthetic users and buckets, drives the login, list, upload and
+download scenarios and writes latency percentiles, throughput and peak RSS
+as JSON:
+
+    python benchmarks/suite.py run --objects 100000 --concurrency 32 --requests 2000 --output after.json
+    python benchmarks/suite.py compare before.json after.json --threshold 10
+"""
+import argparse, contextlib, datetime, json, os, platform, queue, random, socket, statistics, subprocess, sys, tempfile, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fake_gcs import FakeGCS, seed_bucket
+from load import percentile
+
+SCENARIOS = ('login', 'list', 'upload', 'download')
+PASSWORD = 'benchmark-password-1'
+UPLOAD_SIZE = 64 * 1024
+
+
+class Target:
+    """The seeded world the scenarios pick their users and objects from."""
+
+    def __init__(self, base_url: str, users: list, folders: list, objects: list, seed: int):
+        self.base_url = base_url
+        self.users = users
+        self.folders = folders
+        self.objects = objects
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sessions = queue.SimpleQueue()
+
+    def choice(self, items: list):
+        with self._lock:
+            return self.random.choice(items)
+
+    def log_in(self, count: int) -> None:
+        """Open logged-in sessions up front, so logging in is not part of the other scenarios' timings."""
+        for _ in range(count - self._sessions.qsize()):
+            session = requests.Session()
+            username = self.choice(self.users)
+            response = session.post(f"{self.base_url}/login", data={'username': username, 'password': PASSWORD}, allow_redirects=False)
+            if not _logged_in(response):
+                raise RuntimeError(f"Could not log {username} in.")
+            self._sessions.put(session)
+
+    @contextlib.contextmanager
+    def session(self):
+        """Borrow one of the logged-in sessions."""
+        session = self._sessions.get()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+
+
+def scenario_login(target: Target) -> bool:
+    response = requests.post(
+        f"{target.base_url}/login",
+        data={'username': target.choice(target.users), 'password': PASSWORD},
+        allow_redirects=False,
+    )
+    return _logged_in(response)
+
+def scenario_list(target: Target) -> bool:
+    folder = target.choice(target.folders)
+    with target.session() as session:
+        response = session.get(f"{target.base_url}/buckets/browse/{folder}" if folder else f"{target.base_url}/buckets")
+    return response.status_code == 200 and len(response.content) > 0
+
+def scenario_upload(target: Target) -> bool:
+    with target.session() as session:
+        response = session.post(
+            f"{target.base_url}/buckets/upload",
+            data={'prefix': 'uploads'},
+            files={'file': (f"bench-{uuid.uuid4().hex}.txt", os.urandom(UPLOAD_SIZE))},
+            allow_redirects=False,
+        )
+    return response.status_code == 302
+
+def scenario_download(target: Target) -> bool:
+    with target.session() as session:
+        response = session.get(f"{target.base_url}/buckets/download/{target.choice(target.objects)}")
+    return response.status_code == 200 and len(response.content) > 0
+
+def measure(func, target: Target, total: int, concurrency: int) -> dict:
+    """Call func(target) `total` times, `concurrency` at a time, and summarize latency and throughput."""
+    def one(_):
+        started = time.perf_counter()
+        try:
+            ok = func(target)
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency * 1000 for latency, ok in results if ok]
+    return {
+        'requests': total,
+        'errors': sum(1 for _, ok in results if not ok),
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(statistics.fmean(latencies), 2) if latencies else 0.0,
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+        },
+    }
+
+def seed_database(database_url: str, users: int, buckets: int) -> list:
+    """Create the schema and the synthetic users, spread round-robin over the buckets."""
+    import sqlalchemy
+    from werkzeug.security import generate_password_hash
+    from storage_explorer.db import migrate_db
+
+    engine = sqlalchemy.create_engine(database_url)
+    migrate_db(engine)
+    password = generate_password_hash(PASSWORD)
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    usernames = [f"bench{i}" for i in range(users)]
+    with engine.connect() as conn:
+        conn.execute(sqlalchemy.text("DELETE FROM users WHERE username LIKE 'bench%'"))
+        conn.execute(
+            sqlalchemy.text(
+                "INSERT INTO users (username, name, password, gcp_bucket_name, created_at) "
+                "VALUES (:username, :name, :password, :gcp_bucket_name, :created_at)"
+            ),
+            [
+                {
+                    'username': username,
+                    'name': 'Bench User',
+                    'password': password,
+                    'gcp_bucket_name': f"bench-bucket-{i % buckets}",
+                    'created_at': created_at,
+                }
+                for i, username in enumerate(usernames)
+            ],
+        )
+        conn.commit()
+    engine.dispose()
+    return usernames
+
+def start_server(kind: str, port: int, env: dict, log) -> subprocess.Popen:
+    """Start the app in a child process with the given server, logging to log."""
+    if kind == 'gunicorn':
+        command = ['gunicorn', '--bind', f"127.0.0.1:{port}", '--workers', '1', '--threads', '8', 'storage_explorer:app()']
+    elif kind == 'uvicorn':
+        command = ['uvicorn', '--factory', 'storage_explorer.asgi:app', '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning']
+    else:
+        command = [sys.executable, __file__, 'serve', '--port', str(port)]
+    return subprocess.Popen(command, env=env, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+def wait_until_up(base_url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with code {process.returncode}.")
+        try:
+            if requests.get(base_url + '/readyz', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("The app did not start in time.")
+
+def peak_rss_mb(pid: int) -> float:
+    """Sum of the peak resident set sizes of a process and its descendants (Linux only)."""
+    total_kb = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                total_kb += next((int(line.split()[1]) for line in status if line.startswith('VmHWM:')), 0)
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as children:
+                    pending.extend(int(child) for child in children.read().split())
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1) if total_kb else None
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix='storage-explorer-bench-')
+    database_url = args.database_url or f"sqlite:///{workdir}/bench.db"
+
+    gcs = FakeGCS().start()
+    objects, folders = [], ['']
+    for i in range(args.buckets):
+        names = seed_bucket(gcs.bucket(f"bench-bucket-{i}"), args.objects)
+        objects = objects or names
+        folders = folders[:1] + sorted({name.rsplit('/', 2)[0] for name in names})
+    users = seed_database(database_url, args.users, args.buckets)
+
+    port = _free_port()
+    env = dict(
+        os.environ,
+        DATABASE_URL=database_url,
+        STORAGE_EMULATOR_HOST=gcs.url,
+        API_KEY=json.dumps({'project_id': 'bench'}),
+        SECRET_KEY='bench',
+        JOBS_IN_PROCESS='false',
+        PREVIEW_ON_UPLOAD='false',
+        # The login scenario would be throttled long before it is measured
+        LOGIN_THROTTLE_ENABLED='false',
+        PYTHONPATH=os.pathsep.join(filter(None, (str(ROOT), os.environ.get('PYTHONPATH')))),
+    )
+    env.update(dict(setting.split('=', 1) for setting in args.env))
+    log = open(os.path.join(workdir, 'app.log'), 'wb')
+    process = start_server(args.server, port, env, log)
+    base_url = f"http://127.0.0.1:{port}"
+    target = Target(base_url, users, folders, objects, args.seed)
+    try:
+        wait_until_up(base_url, process)
+        results = {}
+        for name in args.scenarios:
+            func = globals()[f"scenario_{name}"]
+            if name != 'login':
+                target.log_in(args.concurrency)
+            if args.warmup:
+                measure(func, target, args.warmup, args.concurrency)
+            results[name] = measure(func, target, args.requests, args.concurrency)
+            print(f"{name}: {results[name]['throughput_rps']} req/s, p95 {results[name]['latency_ms']['p95']} ms", file=sys.stderr)
+        rss = peak_rss_mb(process.pid)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        log.close()
+        gcs.stop()
+        print(f"App log: {log.name}", file=sys.stderr)
+
+    return {
+        'meta': {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'server': args.server,
+            'database': database_url.split(':', 1)[0],
+            'users': args.users,
+            'buckets': args.buckets,
+            'objects_per_bucket': args.objects,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'env': args.env,
+        },
+        'peak_rss_mb': rss,
+        'scenarios': results,
+    }
+
+def compare(before: dict, after: dict, threshold: float) -> tuple:
+    """Return the per-scenario change in percent and whether any exceeds the threshold."""
+    report = {}
+    regressed = False
+    for name, new in after['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if old is None:
+            continue
+        changes = {
+            key: _change(old['latency_ms'][key], new['latency_ms'][key])
+            for key in ('p50', 'p95', 'p99')
+        }
+        changes['throughput_rps'] = _change(old['throughput_rps'], new['throughput_rps'])
+        changes['regressed'] = (
+            any(changes[key] > threshold for key in ('p50', 'p95', 'p99'))
+            or changes['throughput_rps'] < -threshold
+            or new['errors'] > old['errors']
+        )
+        regressed = regressed or changes['regressed']
+        report[name] = changes
+    return report, regressed
+
+def serve(args) -> int:
+    """Child process entry point: serve the app with the threaded Werkzeug server."""
+    from werkzeug.serving import make_server
+    import storage_explorer
+
+    make_server('127.0.0.1', args.port, storage_explorer.app(), threaded=True).serve_forever()
+    return 0
+
+# Utils
+def _logged_in(response: requests.Response) -> bool:
+    return response.status_code == 302 and not response.headers.get('Location', '').endswith('/login')
+
+def _change(old: float, new: float) -> float:
+    return round((new - old) / old * 100, 1) if old else 0.0
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="Run the scenarios and write the results as JSON.")
+    run_parser.add_argument('--objects', type=int, default=1000, help="Objects seeded in each bucket (10 to 1000000).")
+    run_parser.add_argument('--buckets', type=int, default=1)
+    run_parser.add_argument('--users', type=int, default=10)
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    run_parser.add_argument('--requests', type=int, default=500, help="Measured requests per scenario.")
+    run_parser.add_argument('--warmup', type=int, default=50, help="Unmeasured requests per scenario.")
+    run_parser.add_argument('--concurrency', type=int, default=16)
+    run_parser.add_argument('--server', choices=('werkzeug', 'gunicorn', 'uvicorn'), default='werkzeug')
+    run_parser.add_argument('--database-url', help="SQLAlchemy URL of the database; a fresh SQLite file by default.")
+    run_parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="App setting, e.g. OBJECT_INDEX_ENABLED=true.")
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', help="Write the results to this file as well.")
+
+    compare_parser = commands.add_parser('compare', help="Compare two result files; exit 1 on a regression.")
+    compare_parser.add_argument('before')
+    compare_parser.add_argument('after')
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help="Allowed change in percent.")
+
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('--port', type=int, required=True)
+
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        return serve(args)
+
+    if args.command == 'compare':
+        with open(args.before) as before, open(args.after) as after:
+            report, regressed = compare(json.load(before), json.load(after), args.threshold)
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 1 if regressed else 0
+
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + '\n')
+    sys.stdout.write(output + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
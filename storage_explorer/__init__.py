@@ -21,7 +21,126 @@ def app(test_config=None):
   app = Flask(__name__, instance_relative_config=True)
   app.config.from_mapping(
     SECRET_KEY=os.environ.get("SECRET_KEY", "dev"),
-    DATABASE=os.environ.get("DATABASE", "storage-explorer.db")
+    DATABASE=os.environ.get("DATABASE", "storage-explorer.db"),
+    # Sessions: "cookie" keeps them in the signed cookie; "local" (one process
+    # only) or "shared" (SESSION_SHARED_STORE, e.g. a Redis client) keep them
+    # server-side with the user record, ended after SESSION_IDLE_TIMEOUT
+    # seconds without a request.
+    SESSION_BACKEND=os.environ.get("SESSION_BACKEND", "cookie"),
+    SESSION_IDLE_TIMEOUT=int(os.environ.get("SESSION_IDLE_TIMEOUT", 24 * 3600)),
+    SESSION_STORE_SIZE=int(os.environ.get("SESSION_STORE_SIZE", 100_000)),
+    # Password hashing runs on PASSWORD_HASH_WORKERS processes (0: in the
+    # request thread), with at most PASSWORD_HASH_QUEUE hashes per worker
+    # queued; a hash waits up to PASSWORD_HASH_TIMEOUT seconds for a slot,
+    # then as long for its result, before a 503. Hashes made with another
+    # method are upgraded on login.
+    PASSWORD_HASH_METHOD=os.environ.get("PASSWORD_HASH_METHOD", "scrypt:32768:8:1"),
+    PASSWORD_HASH_WORKERS=int(os.environ.get("PASSWORD_HASH_WORKERS", 2)),
+    PASSWORD_HASH_QUEUE=int(os.environ.get("PASSWORD_HASH_QUEUE", 4)),
+    PASSWORD_HASH_TIMEOUT=float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10)),
+    # Login attempts allowed per client address and per username, refilled
+    # over LOGIN_THROTTLE_PERIOD seconds (token buckets).
+    LOGIN_THROTTLE_ENABLED=os.environ.get("LOGIN_THROTTLE_ENABLED", "true").lower() in ("1", "true"),
+    LOGIN_IP_LIMIT=int(os.environ.get("LOGIN_IP_LIMIT", 20)),
+    LOGIN_USER_LIMIT=int(os.environ.get("LOGIN_USER_LIMIT", 5)),
+    LOGIN_THROTTLE_PERIOD=float(os.environ.get("LOGIN_THROTTLE_PERIOD", 60)),
+    # Proxies in front of the app whose X-Forwarded-For is trusted (1 on Cloud Run).
+    PROXY_FIX_X_FOR=int(os.environ.get("PROXY_FIX_X_FOR", 0)),
+    # Invite tokens older than this many seconds are refused and deleted by
+    # `flask expire-tokens`; 0 keeps them forever.
+    INVITE_TOKEN_TTL=int(os.environ.get("INVITE_TOKEN_TTL", 30 * 24 * 3600)),
+    # Worker processes per instance and request threads per process; the SQL
+    # pool is sized from them unless DB_POOL_SIZE is set, and kept within
+    # DB_MAX_CONNECTIONS per instance when that is set.
+    WEB_CONCURRENCY=int(os.environ.get("WEB_CONCURRENCY", 1)),
+    WEB_THREADS=int(os.environ.get("WEB_THREADS", 2)),
+    DB_POOL_SIZE=int(os.environ["DB_POOL_SIZE"]) if os.environ.get("DB_POOL_SIZE") else None,
+    DB_MAX_OVERFLOW=int(os.environ["DB_MAX_OVERFLOW"]) if os.environ.get("DB_MAX_OVERFLOW") else None,
+    DB_MAX_CONNECTIONS=int(os.environ["DB_MAX_CONNECTIONS"]) if os.environ.get("DB_MAX_CONNECTIONS") else None,
+    DB_POOL_TIMEOUT=float(os.environ.get("DB_POOL_TIMEOUT", 10)),
+    DB_POOL_RECYCLE=int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+    DB_POOL_LIFO=os.environ.get("DB_POOL_LIFO", "true").lower() in ("1", "true"),
+    # Ping connections idle for longer than this many seconds on checkout (0: always, -1: never).
+    DB_PING_IDLE=float(os.environ.get("DB_PING_IDLE", 30)),
+    # Size of the read replica pool (DATABASE_READ_URL, INSTANCE_READ_HOST or
+    # INSTANCE_READ_CONNECTION_NAME); defaults to the primary's.
+    DB_READ_POOL_SIZE=int(os.environ["DB_READ_POOL_SIZE"]) if os.environ.get("DB_READ_POOL_SIZE") else None,
+    # Sizing of the HTTP connection pool shared by the storage clients.
+    STORAGE_POOL_CONNECTIONS=int(os.environ.get("STORAGE_POOL_CONNECTIONS", 10)),
+    STORAGE_POOL_MAXSIZE=int(os.environ.get("STORAGE_POOL_MAXSIZE", 10)),
+    # In-process cache of user rows and bucket names.
+    USER_CACHE_SIZE=int(os.environ.get("USER_CACHE_SIZE", 1024)),
+    USER_CACHE_TTL=int(os.environ.get("USER_CACHE_TTL", 300)),
+    # Number of objects shown per /buckets page.
+    LIST_PAGE_SIZE=int(os.environ.get("LIST_PAGE_SIZE", 100)),
+    # Serve folder listings from a cached prefix trie of the whole bucket.
+    DIRECTORY_INDEX_ENABLED=os.environ.get("DIRECTORY_INDEX_ENABLED", "").lower() in ("1", "true"),
+    DIRECTORY_INDEX_TTL=int(os.environ.get("DIRECTORY_INDEX_TTL", 600)),
+    # Resumable uploads: largest accepted file and size of the chunks sent to GCS
+    # (a multiple of 256 KiB).
+    MAX_UPLOAD_SIZE=int(os.environ.get("MAX_UPLOAD_SIZE", 5 * 1024 ** 3)),
+    UPLOAD_CHUNK_SIZE=int(os.environ.get("UPLOAD_CHUNK_SIZE", 8 * 1024 ** 2)),
+    # Let the browser transfer file contents with GCS directly, through signed
+    # URLs and resumable session URIs, instead of proxying them.
+    DIRECT_TRANSFER=os.environ.get("DIRECT_TRANSFER", "").lower() in ("1", "true"),
+    SIGNED_URL_EXPIRATION=int(os.environ.get("SIGNED_URL_EXPIRATION", 3600)),
+    # Uploads are hashed first and not sent when the object already has the
+    # same content; with UPLOAD_DEDUPE (and the object index) a file identical
+    # to another object of the bucket is copied from it server-side instead.
+    UPLOAD_SKIP_UNCHANGED=os.environ.get("UPLOAD_SKIP_UNCHANGED", "true").lower() in ("1", "true"),
+    UPLOAD_DEDUPE=os.environ.get("UPLOAD_DEDUPE", "").lower() in ("1", "true"),
+    # Concurrent transfers shared by batch uploads; keep it within STORAGE_POOL_MAXSIZE.
+    TRANSFER_WORKERS=int(os.environ.get("TRANSFER_WORKERS", 8)),
+    MAX_BATCH_FILES=int(os.environ.get("MAX_BATCH_FILES", 1000)),
+    # Folder archives: size of each ranged read and how many may be in flight.
+    ARCHIVE_RANGE_SIZE=int(os.environ.get("ARCHIVE_RANGE_SIZE", 8 * 1024 ** 2)),
+    ARCHIVE_WINDOW=int(os.environ.get("ARCHIVE_WINDOW", 8)),
+    # "async" when served through storage_explorer.asgi, whose views run on
+    # ASGI_WORKER_THREADS threads; the SQL pool is then sized from those.
+    SERVER_MODE=os.environ.get("SERVER_MODE", "sync"),
+    ASGI_WORKER_THREADS=int(os.environ.get("ASGI_WORKER_THREADS", 128)),
+    # Serve listings from an object-metadata index in the app DB, reconciled
+    # with GCS every OBJECT_INDEX_RESYNC_INTERVAL seconds and kept current in
+    # between by Pub/Sub pushes to /buckets/notifications?token=<token>.
+    OBJECT_INDEX_ENABLED=os.environ.get("OBJECT_INDEX_ENABLED", "").lower() in ("1", "true"),
+    OBJECT_INDEX_RESYNC_INTERVAL=int(os.environ.get("OBJECT_INDEX_RESYNC_INTERVAL", 3600)),
+    PUBSUB_VERIFICATION_TOKEN=os.environ.get("PUBSUB_VERIFICATION_TOKEN"),
+    # Usage aggregates (object count, bytes, extensions) of every folder, kept
+    # current on upload and delete and recomputed in the background once older
+    # than BUCKET_STATS_RECONCILE_INTERVAL seconds.
+    BUCKET_STATS_ENABLED=os.environ.get("BUCKET_STATS_ENABLED", "true").lower() in ("1", "true"),
+    BUCKET_STATS_RECONCILE_INTERVAL=int(os.environ.get("BUCKET_STATS_RECONCILE_INTERVAL", 24 * 3600)),
+    # Lifetime of the in-memory file name search index of a bucket.
+    SEARCH_INDEX_TTL=int(os.environ.get("SEARCH_INDEX_TTL", 3600)),
+    # Thumbnails of images, PDFs and text files (needs Pillow, and PyMuPDF for PDFs).
+    PREVIEW_CACHE_DIR=os.environ.get("PREVIEW_CACHE_DIR"),
+    PREVIEW_WORKERS=int(os.environ.get("PREVIEW_WORKERS", 2)),
+    PREVIEW_MAX_SOURCE_SIZE=int(os.environ.get("PREVIEW_MAX_SOURCE_SIZE", 20 * 1024 ** 2)),
+    PREVIEW_WAIT=float(os.environ.get("PREVIEW_WAIT", 5)),
+    PREVIEW_ON_UPLOAD=os.environ.get("PREVIEW_ON_UPLOAD", "true").lower() in ("1", "true"),
+    PREVIEW_MAX_AGE=int(os.environ.get("PREVIEW_MAX_AGE", 365 * 24 * 3600)),
+    # Mixed into listing ETags; defaults to the package version.
+    ETAG_SALT=os.environ.get("ETAG_SALT"),
+    # Background jobs (bucket provisioning, bulk deletes, copies and moves).
+    # With JOBS_IN_PROCESS off, run them with `flask run-jobs` instead.
+    JOBS_IN_PROCESS=os.environ.get("JOBS_IN_PROCESS", "true").lower() in ("1", "true"),
+    JOB_WORKERS=int(os.environ.get("JOB_WORKERS", 4)),
+    JOB_MAX_ATTEMPTS=int(os.environ.get("JOB_MAX_ATTEMPTS", 5)),
+    JOB_RETRY_BACKOFF=float(os.environ.get("JOB_RETRY_BACKOFF", 2)),
+    JOB_POLL_INTERVAL=float(os.environ.get("JOB_POLL_INTERVAL", 5)),
+    JOB_LEASE=int(os.environ.get("JOB_LEASE", 900)),
+    JOB_RETENTION=int(os.environ.get("JOB_RETENTION", 7 * 24 * 3600)),
+    # Prometheus metrics on /metrics, behind the bearer token METRICS_TOKEN (not
+    # served without one, outside debug mode), and an optional Server-Timing header with the time spent in SQL and GCS.
+    METRICS_ENABLED=os.environ.get("METRICS_ENABLED", "true").lower() in ("1", "true"),
+    METRICS_TOKEN=os.environ.get("METRICS_TOKEN"),
+    SERVER_TIMING=os.environ.get("SERVER_TIMING", "").lower() in ("1", "true"),
+    # Connect to the database (migrating it and filling the pool) and to GCS
+    # while the app is built, instead of on the first requests.
+    EAGER_STARTUP=os.environ.get("EAGER_STARTUP", "true").lower() in ("1", "true"),
+    # Without it, still import the driver and GCS libraries while the app is
+    # built, e.g. for gunicorn --preload to share them with every worker.
+    PRELOAD_LIBRARIES=os.environ.get("PRELOAD_LIBRARIES", "").lower() in ("1", "true"),
   )
 
   if test_config is None:
@@ -37,9 +156,65 @@ def app(test_config=None):
     pass
 
   # Register blueprints
+  from storage_explorer.utils import metrics
+  metrics.init_app(app)
+
   from storage_explorer import db
   db.init_app(app)
 
+  from storage_explorer.utils import storage_connector
+  storage_connector.init_app(app)
+
+  from storage_explorer.utils import health
+  health.init_app(app)
+
+  from storage_explorer.utils import cache
+  cache.init_app(app)
+
+  from storage_explorer.utils import sessions
+  sessions.init_app(app)
+
+  from storage_explorer.utils import passwords
+  passwords.init_app(app)
+
+  from storage_explorer.utils import throttle
+  throttle.init_app(app)
+
+  from storage_explorer.bucket.utils import directory_index
+  directory_index.init_app(app)
+
+  from storage_explorer.bucket.utils import resumable
+  resumable.init_app(app)
+
+  from storage_explorer.bucket.utils import signed_urls
+  signed_urls.init_app(app)
+
+  from storage_explorer.bucket.utils import transfers
+  transfers.init_app(app)
+
+  from storage_explorer.bucket.utils import dedupe
+  dedupe.init_app(app)
+
+  from storage_explorer.bucket.utils import object_index
+  object_index.init_app(app)
+
+  from storage_explorer.bucket.utils import stats
+  stats.init_app(app)
+
+  from storage_explorer.bucket.utils import search
+  search.init_app(app)
+
+  from storage_explorer.bucket.utils import previews
+  previews.init_app(app)
+
+  from storage_explorer.bucket.utils import http_cache
+  http_cache.init_app(app)
+
+  from storage_explorer.utils import jobs
+  # Register the storage job handlers before the workers start
+  from storage_explorer.bucket.utils import tasks
+  jobs.init_app(app)
+
   from storage_explorer.home import home_bp
   app.register_blueprint(home_bp)
 
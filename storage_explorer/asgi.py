@@ -0,0 +1,24 @@
+import os
+
+from a2wsgi import WSGIMiddleware
+
+from storage_explorer import app as create_app, get_logger
+
+logger = get_logger()
+
+def app(test_config=None):
+  """Build the ASGI application, e.g. `uvicorn --factory storage_explorer.asgi:app`.
+
+  The event loop owns the client connections and the Flask views run on a
+  pool of ASGI_WORKER_THREADS threads, so one process can hold hundreds of
+  in-flight listings and transfers instead of the two gunicorn threads of the
+  WSGI deployment. A view still reads the request body, and writes the
+  response, from its thread: a slow upload or download holds one of them
+  for as long as it lasts.
+  """
+  # Size the SQL pool for the worker threads below
+  os.environ.setdefault("SERVER_MODE", "async")
+  flask_app = create_app(test_config)
+  workers = flask_app.config['ASGI_WORKER_THREADS']
+  logger.info("Serving through ASGI with %d worker threads.", workers)
+  return WSGIMiddleware(flask_app, workers=workers)
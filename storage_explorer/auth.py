@@ -1,11 +1,11 @@
 import logging, datetime, functools
 from flask import (
-  Blueprint, render_template, redirect, url_for, flash, request, session, g
+  Blueprint, render_template, redirect, url_for, flash, request, session, g, current_app
 )
-import sqlalchemy
-from storage_explorer.db import get_db
-
-from werkzeug.security import check_password_hash, generate_password_hash
+from storage_explorer.db import get_db, get_read_db
+from storage_explorer.utils import accounts, passwords, sessions, throttle
+from storage_explorer.utils.cache import user_cache, bucket_name_cache, invalidate_user
+from storage_explorer.bucket.utils.operations import request_bucket
 
 # logging
 logging.basicConfig(level=logging.INFO)
@@ -22,20 +22,34 @@ def login():
         if not username or not password:
             flash('Username and password are required!', 'validation')
             return redirect(url_for('auth.login'))
+        retry_after = throttle.login_attempt(request.remote_addr, username)
+        if retry_after:
+            flash(f'Too many login attempts. Please try again in {retry_after} seconds.', 'validation')
+            return render_template('pages/auth/login.html'), 429, {'Retry-After': str(retry_after)}
         user = get_user(username, True)
-        logger.info(user)
         if user == -1:
             flash('An error occurred while retrieving the user. Please try again or ask admin to investigate.', 'error')
             return redirect(url_for('auth.login'))
         if not user:
             flash('Invalid username or password!', 'validation')
             return redirect(url_for('auth.login'))
-        if not check_password_hash(user['password'], password):
+        try:
+            valid = passwords.verify_password(user.password, password)
+        except passwords.HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('pages/auth/login.html'), 503, {'Retry-After': '5'}
+        if not valid:
             flash('Invalid username or password!', 'validation')
             return redirect(url_for('auth.login'))
+        if passwords.needs_rehash(user.password):
+            rehash_password(username, password)
         # If login is successful, you can set session variables or tokens here
         session.clear()  # Clear any existing session data
-        session['username'] = user['username']
+        session['username'] = user.username
+        if sessions.is_server_side(session):
+            # Requests read the user from the session store, not from SQL
+            session['user'] = user.without_password().as_dict()
+            session['bucket_name'] = user.gcp_bucket_name
         flash('Login successful!', 'success')
         return redirect(url_for('home.index'))
     return render_template('pages/auth/login.html')
@@ -67,9 +81,11 @@ def register():
         if len(password) < 8 or not any(char.isdigit() for char in password):
             flash('Password must be at least 8 characters long and contain at least one digit!', 'validation')
             return redirect(url_for('auth.register'))
-        else:
-            # hash the password before saving
-            password = generate_password_hash(password)
+
+        retry_after = throttle.register_attempt(request.remote_addr)
+        if retry_after:
+            flash(f'Too many registration attempts. Please try again in {retry_after} seconds.', 'validation')
+            return render_template('pages/auth/register.html'), 429, {'Retry-After': str(retry_after)}
 
         # check if user already exists
         existing_user = get_user(username)
@@ -89,6 +105,13 @@ def register():
             flash('Invalid invite token. Please check the token and try again.', 'validation')
             return redirect(url_for('auth.register'))
         
+        # hash the password before saving
+        try:
+            password = passwords.hash_password(password)
+        except passwords.HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('pages/auth/register.html'), 503, {'Retry-After': '5'}
+
         # save user to database
         res = save_user(username, fullname, password, invite_token)
         if res == 0:
@@ -102,10 +125,19 @@ def logout():
     session.clear()
     return redirect(url_for('home.index'))
 
+@auth_bp.route('/logout/all', methods=['POST'])
+def logout_everywhere():
+    """End every session of the current user, on all devices."""
+    username = session.get('username')
+    if username is not None:
+        sessions.revoke_user(username)
+    session.clear()
+    return redirect(url_for('home.index'))
+
 def login_required(view):
     @functools.wraps(view)
     def wrapped_view(**kwargs):
-        if g.user is None or g.user.get('username') is None:
+        if g.user is None:
             return redirect(url_for('auth.login'))
 
         return view(**kwargs)
@@ -118,6 +150,8 @@ def load_logged_in_user():
 
     if username is None:
         g.user = None
+    elif 'user' in session:
+        g.user = accounts.User.from_dict(session['user'])
     else:
         user = get_user(username)
         if user == -1:
@@ -129,86 +163,76 @@ def load_logged_in_user():
 # Database operations
 def save_user(username, fullname, password, invite_token):
     """Save a new user to the database."""
-    # Assuming get_db() returns a database connection
     db = get_db()
-
-    stmt = sqlalchemy.text(
-        "INSERT INTO users (username, name, password, gcp_bucket_name, created_at) VALUES (:username, :name, :password, :gcp_bucket_name, :created_at)"
-    )
-
-    remove_token_smt = sqlalchemy.text(
-        "DELETE FROM invite_tokens WHERE invite_token_id = :invite_token_id"
-    )
-
+    gcp_bucket_name = generate_bucket_name_from_user_info(username)  # Generate a unique bucket name
     try:
         with db.connect() as conn:
-            conn.execute(stmt, parameters={
-                'username': username,
-                'name': fullname,
-                'password': password,  # In a real application, hash the password!
-                'gcp_bucket_name': generate_bucket_name_from_user_info(username),  # Generate a unique bucket name
-                'created_at': datetime.datetime.now(datetime.timezone.utc)
-            })
-            # Remove the invite token after successful registration
-            conn.execute(remove_token_smt, parameters={
-                'invite_token_id': invite_token
-            })
+            accounts.add_user(conn, username, fullname, password, gcp_bucket_name)
+            # Remove the invite token after successful registration; a concurrent
+            # registration may have used it since it was checked
+            if not accounts.delete_invite_token(conn, invite_token):
+                conn.rollback()
+                flash('Invalid invite token. Please check the token and try again.', 'validation')
+                return -1
             conn.commit()
-        flash('User registered successfully!', 'success')
-        return 0
+        invalidate_user(username)
     except Exception as e:
         logger.exception(e)
         flash('An error occurred while saving the user. Please try again or ask admin to investigate.', 'error')
         return -1
 
-def get_user(username, with_pw = False) -> dict:
-    """Retrieve a user from the database by username."""
-    db = get_db()
-    stmt = sqlalchemy.text(
-        "SELECT TOP 1 user_id, username, name FROM users WHERE username = :username"
-    )
-
-    if with_pw:
-        stmt = sqlalchemy.text(
-            "SELECT TOP 1 user_id, username, name, password FROM users WHERE username = :username"
-        )
+    try:
+        # Create the bucket in the background, before the first page view needs it
+        request_bucket(gcp_bucket_name, owner=username)
+    except Exception as e:
+        # The first listing of the bucket requests it again
+        logger.exception(e)
+    flash('User registered successfully!', 'success')
+    return 0
+
+def rehash_password(username: str, password: str) -> None:
+    """Store a hash of a just verified password made with the current parameters."""
+    try:
+        with get_db().connect() as conn:
+            accounts.update_password(conn, username, passwords.hash_password(password))
+            conn.commit()
+        logger.info("Password hash of %s upgraded to %s.", username, passwords.method)
+    except Exception as e:
+        # The old hash keeps working: retry on the next login
+        logger.exception(e)
+
+def get_user(username, with_pw = False) -> accounts.User:
+    """Retrieve a user from the database by username; None when there is none."""
+    if not with_pw:
+        user = user_cache.get(username)
+        if user is not None:
+            return user
+
+    # Passwords are checked against the primary; profiles may come from the replica
+    db = get_db() if with_pw else get_read_db()
     try:
         with db.connect() as conn:
-            result = conn.execute(stmt, parameters={'username': username}).fetchone()
-        if result:
-            if with_pw:
-                return {
-                    'user_id': result[0],
-                    'username': result[1],
-                    'name': result[2],
-                    'password': result[3]  # Include password if requested
-                }
-            return {
-                'user_id': result[0],
-                'username': result[1],
-                'name': result[2]
-            }
-        return {}
+            user = accounts.find_user(conn, username, with_password=with_pw)
+        if user is None and db is not get_db():
+            # Not replicated yet, e.g. a user who just registered
+            with get_db().connect() as conn:
+                user = accounts.find_user(conn, username, with_password=with_pw)
+        if user is not None:
+            # Cache the profile without the password hash, and the bucket it maps to
+            user_cache.set(username, user.without_password() if with_pw else user)
+            bucket_name_cache.set(username, user.gcp_bucket_name)
+        return user
     except Exception as e:
         logger.exception(e)
         flash('An error occurred while retrieving the user. Please try again or ask admin to investigate.', 'error')
     return -1
 
-def get_invite_token(token_id: str) -> dict:
-    """Retrieve an invite token from the database by token ID."""
+def get_invite_token(token_id: str) -> accounts.InviteToken:
+    """Retrieve an invite token from the database by token ID; None when there is none."""
     db = get_db()
-    stmt = sqlalchemy.text(
-        "SELECT TOP 1 invite_token_id, created_at FROM invite_tokens WHERE invite_token_id = :token_id"
-    )
     try:
         with db.connect() as conn:
-            result = conn.execute(stmt, parameters={'token_id': token_id}).fetchone()
-        if result:
-            return {
-                'invite_token_id': result[0],
-                'created_at': result[1]
-            }
-        return {}
+            return accounts.find_invite_token(conn, token_id, ttl=current_app.config.get("INVITE_TOKEN_TTL"))
     except Exception as e:
         logger.exception(e)
         flash('An error occurred while retrieving the invite token. Please try again or ask admin to investigate.', 'error')
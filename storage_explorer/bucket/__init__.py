@@ -1,40 +1,155 @@
+import base64, functools, json, secrets
 from flask import (
-  Blueprint, g, render_template, url_for, redirect, request
+  Blueprint, g, render_template, stream_template, url_for, redirect, request, current_app, jsonify,
+  Response, abort, stream_with_context, send_file, session
 )
 from storage_explorer import get_logger
-from storage_explorer.db import get_db
+from storage_explorer.db import get_db, get_read_db
 import sqlalchemy
+from google.api_core.exceptions import GoogleAPICallError, NotFound
 
 from storage_explorer.auth import login_required
-from storage_explorer.bucket.utils.operations import list_files, upload_file, allowed_file
+from storage_explorer.bucket.utils.operations import (
+  list_files_page, list_folder_from_index, list_folder_from_object_index, upload_file, open_file, allowed_file, normalize_prefix, secure_path,
+  folder_fingerprint_from_index, folder_fingerprint_from_object_index, MAX_PAGE_SIZE, READ_CHUNK_SIZE
+)
+from storage_explorer.bucket.utils.directory_index import record_upload
+from storage_explorer.bucket.utils import resumable, signed_urls, transfers, object_index, search, previews, http_cache, stats
 
 from werkzeug.utils import secure_filename
 
-from storage_explorer.utils import config
+from storage_explorer.utils import accounts, config, jobs
+from storage_explorer.utils.cache import bucket_name_cache
 
 bucket_bp = Blueprint('bucket', __name__)
 
 logger = get_logger()
 
 @bucket_bp.route('/buckets', methods=['GET'])
+@bucket_bp.route('/buckets/browse/<path:prefix>', methods=['GET'])
 @login_required
-def list():
-    """List all GCP buckets for the authenticated user."""
+def list(prefix: str = ''):
+    """List the files and folders of a folder in the authenticated user's GCP bucket."""
     error: list = []
     if g.user is None:
         return redirect(url_for('auth.login'))
 
-    db = get_db()
+    db = get_read_db()
     user_bucket_name = get_user_bucket_name(db)
 
     if not user_bucket_name:
         error.append("No GCP bucket found for the user.")
         return render_template('pages/bucket/index.html', bucket_name=None, files=[], errors=error)
 
+    page_size = request.args.get('page_size', current_app.config['LIST_PAGE_SIZE'], type=int)
+    page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor')
+    prefix = normalize_prefix(prefix)
+
+    sort = request.args.get('sort', 'name')
+    descending = request.args.get('order') == 'desc'
+
+    # Serve the folder from the object-metadata index or the cached directory
+    # index when they are enabled; only the former can sort
+    if current_app.config['OBJECT_INDEX_ENABLED']:
+        list_folder = functools.partial(list_folder_from_object_index, sort=sort, descending=descending)
+        folder_fingerprint = folder_fingerprint_from_object_index
+    elif current_app.config['DIRECTORY_INDEX_ENABLED']:
+        list_folder = list_folder_from_index
+        folder_fingerprint = folder_fingerprint_from_index
+    else:
+        list_folder = list_files_page
+        folder_fingerprint = None
+
+    api_key = config.get_api_key()
+    # The page only depends on the user, the URL and the folder's fingerprint
+    etag_parts = (g.user.username, user_bucket_name, prefix, request.query_string)
+
+    # With an index, a reload of an unchanged folder is answered before listing it
+    if folder_fingerprint is not None:
+        fingerprint, last_modified = folder_fingerprint(user_bucket_name, api_key=api_key, prefix=prefix)
+        etag = http_cache.listing_etag(*etag_parts, fingerprint)
+        if http_cache.is_not_modified(etag, last_modified):
+            return http_cache.not_modified(etag, last_modified)
+
+    status = 200
+    try:
+        files, folders, next_cursor = list_folder(user_bucket_name, api_key=api_key, page_size=page_size, cursor=cursor, prefix=prefix)
+    except ValueError:
+        error.append("Invalid page cursor, showing the first page.")
+        cursor = None
+        status = 400
+        files, folders, next_cursor = list_folder(user_bucket_name, api_key=api_key, page_size=page_size, prefix=prefix)
+
+    # Stream the page so rows go out while the template renders
+    response = current_app.response_class(stream_template(
+        'pages/bucket/index.html',
+        bucket_name=user_bucket_name,
+        prefix=prefix,
+        folders=folders,
+        files=files,
+        cursor=cursor,
+        next_cursor=next_cursor,
+        page_size=page_size,
+        sortable=current_app.config['OBJECT_INDEX_ENABLED'],
+        sort=sort,
+        order='desc' if descending else 'asc',
+        errors=error
+    ), status=status)
+    # Without an index, the page streams from GCS as it is listed: nothing
+    # fingerprints it before the response starts, so it carries no validators
+    if folder_fingerprint is None:
+        return response
+    return http_cache.set_validators(response, etag, last_modified)
+
+@bucket_bp.route('/buckets/search', methods=['GET'])
+@login_required
+def search_files():
+    """Search the file names of the user's GCP bucket by substring, prefix or extension."""
+    error: list = []
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        error.append("No GCP bucket found for the user.")
+        return render_template('pages/bucket/index.html', bucket_name=None, files=[], errors=error)
+
+    query = request.args.get('q', '').strip()
+    query_type = request.args.get('type', 'substring')
+    if query_type not in search.QUERY_TYPES:
+        query_type = 'substring'
+    limit = max(1, min(request.args.get('limit', current_app.config['LIST_PAGE_SIZE'], type=int), MAX_PAGE_SIZE))
+
     api_key = config.get_api_key()
-    files = list_files(user_bucket_name, api_key=api_key)
+    files = search.search(user_bucket_name, query, api_key=api_key, query_type=query_type, limit=limit) if query else []
 
-    return render_template('pages/bucket/index.html', bucket_name=user_bucket_name, files=files, errors=error)
+    return render_template(
+        'pages/bucket/index.html',
+        bucket_name=user_bucket_name,
+        prefix='',
+        files=files,
+        query=query,
+        query_type=query_type,
+        errors=error
+    )
+
+@bucket_bp.route('/buckets/stats', methods=['GET'])
+@login_required
+def bucket_stats():
+    """Report the object count, total bytes and extension breakdown of the user's bucket, or of a folder with ``prefix``."""
+    if not current_app.config['BUCKET_STATS_ENABLED']:
+        abort(404)
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        return jsonify(error="No GCP bucket found for the user."), 404
+
+    prefix = normalize_prefix(request.args.get('prefix', ''))
+    # Served from the stored aggregates; a stale or never counted bucket is reconciled in the background
+    job_id = stats.ensure_fresh(user_bucket_name, owner=g.user.username)
+    result = stats.get_stats(user_bucket_name, prefix)
+    if result is None:
+        return jsonify(status='pending', job_id=job_id, status_url=url_for('bucket.job_status', job_id=job_id)), 202
+    return jsonify(dict(result, reconciling=job_id is not None))
 
 @bucket_bp.route('/buckets/upload', methods=['POST'])
 @login_required
@@ -57,12 +172,13 @@ def upload():
         errors.append("File type not allowed.")
         return render_template('pages/bucket/index.html', errors=errors)
     
-    filename = secure_filename(file.filename)
+    prefix = normalize_prefix(request.form.get('prefix', ''))
+    filename = prefix + secure_filename(file.filename)
 
     # Handle file upload logic here
     # This is a placeholder for the actual upload implementation
     # You would typically use a form to get the file and then upload it to the GCP bucket
-    db = get_db()
+    db = get_read_db()
     user_bucket_name = get_user_bucket_name(db)
     if not user_bucket_name:
         errors.append("No GCP bucket found for the user.")
@@ -71,17 +187,391 @@ def upload():
     api_key = config.get_api_key()
     upload_file(user_bucket_name, filename=filename, file=file, api_key=api_key)
 
-    return redirect(url_for('bucket.list'))
+    return redirect(url_for('bucket.list', prefix=prefix.rstrip('/') or None))
+
+@bucket_bp.route('/buckets/upload/batch', methods=['POST'])
+@login_required
+def upload_batch():
+    """Upload several files (or a dropped folder) concurrently, streaming one JSON line per file."""
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify(error="No selected file."), 400
+    if len(files) > current_app.config['MAX_BATCH_FILES']:
+        return jsonify(error=f"At most {current_app.config['MAX_BATCH_FILES']} files can be uploaded at once."), 400
+
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        return jsonify(error="No GCP bucket found for the user."), 404
+
+    prefix = normalize_prefix(request.form.get('prefix', ''))
+    accepted = []
+    results = []
+    for file in files:
+        # Folder drops send the relative path of each file as its filename
+        filename = secure_path(file.filename)
+        if not filename or not allowed_file(filename):
+            results.append({'filename': file.filename, 'ok': False, 'error': "File type not allowed."})
+        else:
+            accepted.append((prefix + filename, file))
+
+    api_key = config.get_api_key()
+
+    def generate():
+        uploaded = 0
+        for result in results:
+            yield json.dumps(result) + '\n'
+        for result in transfers.upload_many(user_bucket_name, accepted, api_key=api_key):
+            uploaded += result['ok']
+            yield json.dumps(result) + '\n'
+        yield json.dumps({'done': True, 'uploaded': uploaded, 'failed': len(files) - uploaded}) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@bucket_bp.route('/buckets/uploads', methods=['POST'])
+@login_required
+def start_resumable_upload():
+    """Open a resumable upload session for a file streamed in chunks by the browser."""
+    data = request.get_json(silent=True) or request.form
+    filename = data.get('filename') or ''
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        size = -1
+
+    if filename == '':
+        return jsonify(error="No selected file."), 400
+    if not allowed_file(filename):
+        return jsonify(error="File type not allowed."), 400
+    if size < 0:
+        return jsonify(error="A valid file size is required."), 400
+    if size > current_app.config['MAX_UPLOAD_SIZE']:
+        return jsonify(error="File is too large."), 413
+
+    prefix = normalize_prefix(data.get('prefix', ''))
+    filename = prefix + secure_filename(filename)
+
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        return jsonify(error="No GCP bucket found for the user."), 404
+
+    api_key = config.get_api_key()
+    if current_app.config['DIRECT_TRANSFER']:
+        # The browser uploads straight to GCS; only the session is created here
+        session_url = resumable.start_upload(
+            user_bucket_name, filename, size, data.get('content_type'),
+            api_key=api_key, origin=request.host_url.rstrip('/')
+        )
+        return jsonify(session_url=session_url, offset=0, complete=False, chunk_size=current_app.config['UPLOAD_CHUNK_SIZE']), 201
+
+    session_url = resumable.start_upload(user_bucket_name, filename, size, data.get('content_type'), api_key=api_key)
+    # Read now: once the upload completes, the object it replaces is gone
+    replaced = stats.replaced_size(user_bucket_name, filename, api_key=api_key)
+
+    upload_id = secrets.token_urlsafe(24)
+    resumable.upload_sessions.set(upload_id, {
+        'username': g.user.username,
+        'bucket_name': user_bucket_name,
+        'filename': filename,
+        'size': size,
+        'offset': 0,
+        'session_url': session_url,
+        'replaced_size': replaced,
+    })
+    return jsonify(
+        upload_id=upload_id,
+        offset=0,
+        complete=False,
+        chunk_size=current_app.config['UPLOAD_CHUNK_SIZE']
+    ), 201
+
+@bucket_bp.route('/buckets/uploads/<upload_id>', methods=['GET', 'PUT'])
+@login_required
+def resumable_upload(upload_id: str):
+    """Stream a chunk of the request body into a resumable upload, or report its progress on GET."""
+    upload = resumable.upload_sessions.get(upload_id)
+    if upload is None or upload['username'] != g.user.username:
+        return jsonify(error="Upload session not found."), 404
+
+    api_key = config.get_api_key()
+    try:
+        if request.method == 'GET':
+            offset, complete = resumable.query_offset(upload['session_url'], upload['size'], api_key=api_key)
+        else:
+            start = parse_content_range_start(request.headers.get('Content-Range'))
+            if start is None:
+                return jsonify(error="A 'Content-Range: bytes <start>-<end>/<total>' header is required."), 400
+            if start != upload['offset']:
+                # Out of sync with the client (e.g. after a dropped connection): tell it where to resume
+                offset, complete = resumable.query_offset(upload['session_url'], upload['size'], api_key=api_key)
+            else:
+                offset, complete = resumable.upload_stream(
+                    upload['session_url'],
+                    request.stream,
+                    offset=start,
+                    total=upload['size'],
+                    api_key=api_key,
+                    chunk_size=current_app.config['UPLOAD_CHUNK_SIZE']
+                )
+    except ValueError as e:
+        return jsonify(error=str(e)), 413
+    except resumable.UploadSessionError as e:
+        logger.exception(e)
+        resumable.upload_sessions.invalidate(upload_id)
+        return jsonify(error="Upload session expired or failed. Please start the upload again."), 410
+
+    if complete:
+        resumable.upload_sessions.invalidate(upload_id)
+        record_upload(upload['bucket_name'], upload['filename'], upload['size'])
+        stats.record_upload(upload['bucket_name'], upload['filename'], upload['size'], upload.get('replaced_size'))
+        object_index.refresh_object(upload['bucket_name'], upload['filename'], api_key=api_key)
+        search.record_upload(upload['bucket_name'], upload['filename'])
+    else:
+        upload['offset'] = offset
+        resumable.upload_sessions.set(upload_id, upload)
+    return jsonify(upload_id=upload_id, offset=offset, complete=complete), 201 if complete else 200
+
+@bucket_bp.route('/buckets/archive', methods=['GET'])
+@login_required
+def archive():
+    """Download every file under a folder of the user's GCP bucket as a ZIP archive streamed while it is built."""
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        abort(404)
+
+    prefix = normalize_prefix(request.args.get('prefix', ''))
+    api_key = config.get_api_key()
+    stream = transfers.archive_stream(
+        user_bucket_name,
+        prefix,
+        api_key=api_key,
+        range_size=current_app.config['ARCHIVE_RANGE_SIZE'],
+        window=current_app.config['ARCHIVE_WINDOW']
+    )
+
+    response = Response(stream_with_context(stream), mimetype='application/zip')
+    archive_name = prefix.rstrip('/').rsplit('/', 1)[-1] or user_bucket_name
+    response.headers.set('Content-Disposition', 'attachment', filename=f"{archive_name}.zip")
+    return response
+
+@bucket_bp.route('/buckets/delete', methods=['POST'])
+@login_required
+def delete_objects():
+    """Queue the deletion of files and folders of the user's GCP bucket on the background workers."""
+    data = request.get_json(silent=True) or {}
+    names = [name for name in data.get('names') or [] if isinstance(name, str) and name]
+    prefixes = [normalize_prefix(prefix) for prefix in data.get('prefixes') or [] if isinstance(prefix, str)]
+    if '' in prefixes:
+        return jsonify(error="The bucket root cannot be deleted."), 400
+    if not names and not prefixes:
+        return jsonify(error="Nothing to delete."), 400
+
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        return jsonify(error="No GCP bucket found for the user."), 404
+
+    job_id = jobs.enqueue(
+        'delete_objects',
+        {'bucket_name': user_bucket_name, 'names': names, 'prefixes': prefixes},
+        owner=g.user.username
+    )
+    return jsonify(job_id=job_id, status_url=url_for('bucket.job_status', job_id=job_id)), 202
+
+@bucket_bp.route('/buckets/copy', methods=['POST'])
+@login_required
+def copy_objects():
+    """Queue a server-side copy, or a move with ``move``, of a file or folder within the user's GCP bucket."""
+    data = request.get_json(silent=True) or {}
+    source = data.get('source') or ''
+    destination = data.get('destination') or ''
+    if not isinstance(source, str) or not isinstance(destination, str) or not source:
+        return jsonify(error="A source and a destination are required."), 400
+
+    if source.endswith('/'):
+        # Folder: every object under it keeps its path relative to the folder
+        source, destination = normalize_prefix(source), normalize_prefix(destination)
+        if not source or destination.startswith(source):
+            return jsonify(error="A folder cannot be copied into itself."), 400
+    else:
+        destination = secure_path(destination)
+        if not destination or not allowed_file(destination):
+            return jsonify(error="File type not allowed."), 400
+    if source == destination:
+        return jsonify(error="The source and the destination are the same."), 400
+
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        return jsonify(error="No GCP bucket found for the user."), 404
+
+    job_id = jobs.enqueue(
+        'copy_objects',
+        {'bucket_name': user_bucket_name, 'source': source, 'destination': destination, 'move': bool(data.get('move'))},
+        owner=g.user.username
+    )
+    return jsonify(job_id=job_id, status_url=url_for('bucket.job_status', job_id=job_id)), 202
+
+@bucket_bp.route('/buckets/jobs/<job_id>', methods=['GET'])
+@login_required
+def job_status(job_id: str):
+    """Report the status, attempts and result of a background job of the user."""
+    job = jobs.get_job(job_id)
+    if job is None or job['owner'] != g.user.username:
+        return jsonify(error="Job not found."), 404
+    return jsonify(job)
+
+@bucket_bp.route('/buckets/preview/<path:name>', methods=['GET'])
+@login_required
+def preview(name: str):
+    """Serve the PNG preview of an image, PDF or text file, generating it on first request."""
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        abort(404)
+
+    # Listings link previews with the object generation, which makes the URL immutable
+    generation = request.args.get('g', type=int)
+    api_key = config.get_api_key()
+    # Loaded with the storage client, on first use
+    from google.auth.exceptions import TransportError
+    from requests.exceptions import RequestException
+    try:
+        path, key = previews.get_preview(user_bucket_name, name, api_key=api_key, generation=generation)
+    except NotFound:
+        # Deleted while the preview was rendered
+        abort(404)
+    except (GoogleAPICallError, TransportError, RequestException) as e:
+        logger.exception(e)
+        return Response(status=503, headers={'Retry-After': '5'})
+    if path is None:
+        abort(404)
+
+    response = send_file(path, mimetype='image/png', etag=key, conditional=True, max_age=current_app.config['PREVIEW_MAX_AGE'])
+    if generation is not None:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 0
+        response.cache_control.no_cache = True
+    return response
+
+@bucket_bp.route('/buckets/objects/<path:name>', methods=['GET'])
+@login_required
+def read_object(name: str):
+    """Read a file of the user's GCP bucket inline, with conditional and Range requests."""
+    return serve_object(name, as_attachment=False)
+
+@bucket_bp.route('/buckets/download/<path:name>', methods=['GET'])
+@login_required
+def download(name: str):
+    """Download a file of the user's GCP bucket, through a signed URL in direct transfer mode."""
+    return serve_object(name, as_attachment=True)
+
+@bucket_bp.route('/buckets/notifications', methods=['POST'])
+def notifications():
+    """Apply a GCS object change notification pushed by Pub/Sub to the object-metadata index."""
+    token = current_app.config['PUBSUB_VERIFICATION_TOKEN']
+    if not token:
+        abort(404)
+    if not secrets.compare_digest(request.args.get('token', ''), token):
+        abort(403)
+
+    message = (request.get_json(silent=True) or {}).get('message') or {}
+    attributes = message.get('attributes') or {}
+    data = message.get('data')
+    try:
+        resource = json.loads(base64.b64decode(data)) if data else {}
+    except ValueError:
+        return jsonify(error="Invalid notification payload."), 400
+
+    object_index.apply_notification(attributes, resource)
+    # Acknowledge every well-formed message, even for buckets that are not indexed
+    return '', 204
 
 # Utils
+def serve_object(name: str, as_attachment: bool) -> Response:
+    """Stream an object, answering If-None-Match/If-Modified-Since with 304 and a single Range with 206.
+
+    In direct transfer mode the client is redirected to a signed URL, and GCS handles both.
+    """
+    db = get_read_db()
+    user_bucket_name = get_user_bucket_name(db)
+    if not user_bucket_name:
+        abort(404)
+
+    api_key = config.get_api_key()
+    if current_app.config['DIRECT_TRANSFER']:
+        return redirect(signed_urls.generate_download_url(user_bucket_name, name, api_key=api_key))
+
+    blob, reader = open_file(user_bucket_name, name, api_key=api_key)
+    if blob is None:
+        abort(404)
+
+    # A generation identifies the object's content for good
+    etag = f"{blob.generation}"
+    if http_cache.is_not_modified(etag, blob.updated):
+        reader.close()
+        return http_cache.not_modified(etag, blob.updated)
+
+    size = blob.size or 0
+    start, stop = 0, size
+    status = 200
+    # Multiple ranges and stale If-Range validators get the whole object with a 200;
+    # only an unsatisfiable single range is a 416
+    single_range = request.range is not None and len(request.range.ranges) == 1
+    if single_range and http_cache.if_range_matches(etag, blob.updated):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            reader.close()
+            response = Response(status=416)
+            response.headers['Content-Range'] = f"bytes */{size}"
+            return response
+        start, stop = byte_range
+        status = 206
+        reader.seek(start)
+
+    def generate():
+        remaining = stop - start
+        with reader:
+            while remaining > 0 and (chunk := reader.read(min(READ_CHUNK_SIZE, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+
+    response = Response(generate(), status=status, mimetype=blob.content_type or 'application/octet-stream')
+    response.headers['Content-Length'] = stop - start
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+    disposition = 'attachment' if as_attachment else 'inline'
+    response.headers.set('Content-Disposition', disposition, filename=name.rsplit('/', 1)[-1])
+    return http_cache.set_validators(response, etag, blob.updated)
+
+def parse_content_range_start(content_range: str) -> int:
+    """Return the first byte position of a 'bytes <start>-<end>/<total>' header, or None."""
+    if not content_range or not content_range.startswith('bytes '):
+        return None
+    start, _, _ = content_range[len('bytes '):].partition('-')
+    return int(start) if start.isdigit() else None
+
 def get_user_bucket_name(db: sqlalchemy.engine.base.Engine) -> str:
     """Get the GCP bucket name for the authenticated user."""
+    user_bucket_name = session.get('bucket_name')
+    if user_bucket_name is not None:
+        return user_bucket_name
+    username = g.user.username
+    user_bucket_name = bucket_name_cache.get(username)
+    if user_bucket_name is not None:
+        return user_bucket_name
+
     # Fetch the user's GCP bucket information from the database
     with db.connect() as conn:
-        query = sqlalchemy.text(
-            "SELECT TOP 1 gcp_bucket_name FROM users WHERE username = :username",
-        )
-        result = conn.execute(query, parameters={"username": g.user['username']}).fetchone()
-    
-    user_bucket_name = result[0]
+        user_bucket_name = accounts.find_bucket_name(conn, username)
+    if user_bucket_name is None and db is not get_db():
+        # Not replicated yet: ask the primary
+        with get_db().connect() as conn:
+            user_bucket_name = accounts.find_bucket_name(conn, username)
+
+    bucket_name_cache.set(username, user_bucket_name)
     return user_bucket_name
\ No newline at end of file
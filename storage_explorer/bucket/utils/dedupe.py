@@ -0,0 +1,106 @@
+import base64, hashlib
+
+import google_crc32c
+
+from storage_explorer import get_logger
+from storage_explorer.bucket.utils import object_index
+
+logger = get_logger()
+
+# Outcomes of upload_file.
+UPLOADED = 'uploaded'
+UNCHANGED = 'unchanged'
+COPIED = 'copied'
+
+# Size of the reads hashing an upload.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class Checksums:
+    """MD5 and CRC32C of a file, base64 encoded as GCS reports them, and its size."""
+
+    __slots__ = ('md5_hash', 'crc32c', 'size')
+
+    def __init__(self, md5_hash: str, crc32c: str, size: int):
+        self.md5_hash = md5_hash
+        self.crc32c = crc32c
+        self.size = size
+
+    def matches(self, blob) -> bool:
+        """Whether a blob has this content, by MD5 or, for composite objects which have none, by CRC32C."""
+        if blob.size != self.size:
+            return False
+        if blob.md5_hash:
+            return blob.md5_hash == self.md5_hash
+        return blob.crc32c == self.crc32c
+
+
+def remaining_size(file) -> int:
+    """Bytes left in a file from its current position, or None for unseekable streams."""
+    try:
+        if not file.seekable():
+            return None
+    except AttributeError:
+        return None
+    start = file.tell()
+    end = file.seek(0, 2)
+    file.seek(start)
+    return end - start
+
+def needs_checksums(size: int, existing) -> bool:
+    """Whether an upload of this size must be hashed before it is sent, because the hash decides whether to send it.
+
+    Only when the object it replaces has the same size (it may be unchanged)
+    or duplicates are looked up: otherwise the client library hashes the
+    data while it streams it, and nothing reads the file twice.
+    """
+    if size is None:
+        return False
+    if skip_unchanged and existing is not None and existing.size == size:
+        return True
+    return dedupe and size > 0
+
+def checksum_file(file, chunk_size: int = HASH_CHUNK_SIZE) -> Checksums:
+    """Hash a file from its current position in one pass, then rewind it.
+
+    Returns None for unseekable streams, which can only be read once.
+    """
+    try:
+        if not file.seekable():
+            return None
+    except AttributeError:
+        return None
+    start = file.tell()
+    md5 = hashlib.md5(usedforsecurity=False)
+    crc32c = google_crc32c.Checksum()
+    size = 0
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        md5.update(chunk)
+        crc32c.update(chunk)
+        size += len(chunk)
+    file.seek(start)
+    return Checksums(
+        base64.b64encode(md5.digest()).decode(),
+        base64.b64encode(crc32c.digest()).decode(),
+        size,
+    )
+
+def find_copy_source(bucket_name: str, name: str, checksums: Checksums) -> tuple:
+    """Name and generation of another object of the bucket with the same content, from the object-metadata index, or None."""
+    if not dedupe or not checksums.size:
+        return None
+    source = object_index.find_by_hash(bucket_name, checksums.md5_hash, checksums.size)
+    return tuple(source) if source is not None and source[0] != name else None
+
+
+# Module state, set by init_app
+skip_unchanged = True
+dedupe = False
+
+def init_app(app):
+    """Set whether uploads skip unchanged objects and copy duplicates from the app config."""
+    global skip_unchanged, dedupe
+    skip_unchanged = app.config.get("UPLOAD_SKIP_UNCHANGED", skip_unchanged)
+    dedupe = app.config.get("UPLOAD_DEDUPE", dedupe)
+    if dedupe and not app.config.get("OBJECT_INDEX_ENABLED"):
+        logger.warning("UPLOAD_DEDUPE finds duplicates through the object-metadata index: set OBJECT_INDEX_ENABLED.")
@@ -0,0 +1,141 @@
+import threading, time
+
+from storage_explorer import get_logger
+from storage_explorer.utils.cache import TTLCache
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+DELIMITER = '/'
+
+
+class FolderNode:
+    """A folder of the prefix trie with the aggregated count and size of everything below it."""
+
+    __slots__ = ('children', 'files', 'count', 'size')
+
+    def __init__(self):
+        self.children = {}
+        self.files = {}
+        self.count = 0
+        self.size = 0
+
+
+class DirectoryIndex:
+    """Prefix trie over the object names of a bucket.
+
+    Lets any folder be listed with per-folder object counts and total sizes
+    without walking the bucket again.
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+        self.root = FolderNode()
+        self.built_at = time.time()
+        # Bumped on every change, to fingerprint listings served from the index
+        self.version = 0
+        self._lock = threading.Lock()
+
+    def add(self, name: str, size: int) -> None:
+        """Add or replace an object in the index."""
+        with self._lock:
+            self._remove(name)
+            self.version += 1
+            *folders, filename = name.split(DELIMITER)
+            node = self.root
+            node.count += 1
+            node.size += size
+            for folder in folders:
+                node = node.children.setdefault(folder, FolderNode())
+                node.count += 1
+                node.size += size
+            node.files[filename] = size
+
+    def remove(self, name: str) -> None:
+        """Remove an object from the index, if present."""
+        with self._lock:
+            self._remove(name)
+
+    def listing(self, prefix: str = '') -> tuple:
+        """Return the immediate folders and files under prefix.
+
+        Folders are dicts with ``prefix``, ``count`` and ``size``; files are
+        full object names. Both are sorted by name.
+        """
+        with self._lock:
+            node = self._find(prefix)
+            if node is None:
+                return [], []
+            folders = [
+                {'prefix': f"{prefix}{name}{DELIMITER}", 'count': child.count, 'size': child.size}
+                for name, child in sorted(node.children.items())
+            ]
+            # Skip the empty name of "folder/" placeholder objects
+            files = [f"{prefix}{name}" for name in sorted(node.files) if name]
+        return folders, files
+
+    # Internals
+    def _find(self, prefix: str):
+        node = self.root
+        for folder in prefix.split(DELIMITER)[:-1]:
+            node = node.children.get(folder)
+            if node is None:
+                return None
+        return node
+
+    def _remove(self, name: str) -> None:
+        *folders, filename = name.split(DELIMITER)
+        path = [self.root]
+        for folder in folders:
+            child = path[-1].children.get(folder)
+            if child is None:
+                return
+            path.append(child)
+        size = path[-1].files.pop(filename, None)
+        if size is None:
+            return
+        self.version += 1
+        for node in path:
+            node.count -= 1
+            node.size -= size
+        # Prune folders left empty, deepest first
+        for parent, folder, node in reversed(list(zip(path, folders, path[1:]))):
+            if node.count == 0:
+                del parent.children[folder]
+
+
+# Directory indexes keyed by bucket name.
+index_cache = TTLCache("directory_index", maxsize=64, ttl=600)
+
+def build_index(bucket_name: str, api_key: dict) -> DirectoryIndex:
+    """Walk the whole bucket once and build its directory index."""
+    client = get_client(api_key)
+    index = DirectoryIndex(bucket_name)
+    for blob in client.list_blobs(bucket_name, fields='items(name,size),nextPageToken'):
+        index.add(blob.name, int(blob.size or 0))
+    logger.info("Directory index built for %s (%d objects).", bucket_name, index.root.count)
+    return index
+
+def get_index(bucket_name: str, api_key: dict) -> DirectoryIndex:
+    """Return the cached directory index of a bucket, building it on a miss."""
+    index = index_cache.get(bucket_name)
+    if index is None:
+        index = build_index(bucket_name, api_key)
+        index_cache.set(bucket_name, index)
+    return index
+
+def record_upload(bucket_name: str, name: str, size: int) -> None:
+    """Reflect an upload in the cached index of the bucket, if one exists."""
+    index = index_cache.get(bucket_name)
+    if index is not None:
+        index.add(name, size)
+
+def record_delete(bucket_name: str, name: str) -> None:
+    """Reflect a delete in the cached index of the bucket, if one exists."""
+    index = index_cache.get(bucket_name)
+    if index is not None:
+        index.remove(name)
+
+def init_app(app):
+    """Configure the directory index cache from the app config."""
+    index_cache.configure(ttl=app.config.get("DIRECTORY_INDEX_TTL"))
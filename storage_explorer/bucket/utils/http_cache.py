@@ -0,0 +1,54 @@
+import datetime, hashlib, importlib.metadata
+
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+# Mixed into every listing ETag so a deploy with new templates invalidates them.
+etag_salt = ''
+
+
+def listing_etag(*parts) -> str:
+    """Build the ETag of a rendered listing from its fingerprint and whatever else the page depends on."""
+    digest = hashlib.blake2b(repr((etag_salt, *parts)).encode(), digest_size=16)
+    return digest.hexdigest()
+
+def is_not_modified(etag: str, last_modified=None) -> bool:
+    """Whether the conditional headers of the current request match these validators."""
+    return not is_resource_modified(request.environ, etag=etag, last_modified=last_modified)
+
+def if_range_matches(etag: str, last_modified=None) -> bool:
+    """Whether a Range of the current request applies: no If-Range, or one that strongly matches."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return last_modified is not None and _as_utc(last_modified) == if_range.date
+    return True
+
+def set_validators(response: Response, etag: str, last_modified=None) -> Response:
+    """Tag a per-user response so browsers revalidate it on every use."""
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+def not_modified(etag: str, last_modified=None) -> Response:
+    return set_validators(Response(status=304), etag, last_modified)
+
+def _as_utc(value: datetime.datetime) -> datetime.datetime:
+    # HTTP dates have no sub-second part; naive datetimes are UTC in this app
+    value = value.replace(microsecond=0)
+    return value.astimezone(datetime.timezone.utc) if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc)
+
+def init_app(app):
+    """Set the ETag salt from the app config, defaulting to the installed package version."""
+    global etag_salt
+    etag_salt = app.config.get("ETAG_SALT")
+    if not etag_salt:
+        try:
+            etag_salt = importlib.metadata.version('storage_explorer')
+        except importlib.metadata.PackageNotFoundError:
+            etag_salt = ''
@@ -0,0 +1,506 @@
+import datetime, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlalchemy
+from sqlalchemy import (
+    BigInteger, Column, DateTime, Index, Integer, MetaData, String, Table, UniqueConstraint, bindparam
+)
+
+from storage_explorer import get_logger
+from storage_explorer.db import get_db
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+DELIMITER = '/'
+# Sort orders accepted by list_folder, mapped to their column.
+SORT_COLUMNS = ('name', 'size', 'updated')
+# Tries of an upsert racing other writers of the same rows.
+UPSERT_ATTEMPTS = 3
+
+metadata = MetaData()
+
+# Metadata of every object of the indexed buckets. `parent` is the folder
+# prefix of the object ("" at the root), so a folder is listed with one
+# index seek. `sync_run` is the time (in microseconds) the object was last
+# seen by a reconcile or written through. `md5_hash` is base64 as reported
+# by GCS (None for composite objects), to find objects by content.
+objects_table = Table(
+    "objects",
+    metadata,
+    Column("object_id", Integer, primary_key=True, nullable=False),
+    Column("bucket_name", String(63), nullable=False),
+    Column("name", String(1024), nullable=False),
+    Column("parent", String(1024), nullable=False),
+    Column("size", BigInteger, nullable=False),
+    Column("content_type", String(255), nullable=True),
+    Column("generation", BigInteger, nullable=False),
+    Column("updated", DateTime, nullable=True),
+    Column("sync_run", BigInteger, nullable=False),
+    Column("md5_hash", String(24), nullable=True),
+    UniqueConstraint("bucket_name", "name", name="uq_objects_bucket_name_name"),
+    Index("ix_objects_bucket_name_parent", "bucket_name", "parent"),
+)
+# Added to the objects table after it was first released; migrate_db adds both to older tables.
+md5_hash_index = Index("ix_objects_bucket_name_md5_hash", objects_table.c.bucket_name, objects_table.c.md5_hash)
+
+# One row per indexed bucket, with the watermark of its last full reconcile.
+# `revision` goes up with every write to the objects of the bucket and
+# `changed_at` is the time of the last one: together they fingerprint the
+# bucket without reading its objects.
+object_index_state_table = Table(
+    "object_index_state",
+    metadata,
+    Column("bucket_name", String(63), primary_key=True, nullable=False),
+    Column("sync_run", BigInteger, nullable=False),
+    Column("synced_at", DateTime, nullable=False),
+    Column("revision", BigInteger, nullable=False, server_default="0"),
+    Column("changed_at", DateTime, nullable=True),
+)
+
+# One row per folder holding objects of an indexed bucket, with the number
+# and total size of the objects anywhere below it. `parent` is the folder
+# containing it, so the sub-folders of a folder are listed with one index
+# seek. Writes keep the counts current and every reconcile rebuilds them.
+object_folders_table = Table(
+    "object_folders",
+    metadata,
+    Column("folder_id", Integer, primary_key=True, nullable=False),
+    Column("bucket_name", String(63), nullable=False),
+    Column("prefix", String(1024), nullable=False),
+    Column("parent", String(1024), nullable=False),
+    Column("object_count", BigInteger, nullable=False),
+    Column("total_bytes", BigInteger, nullable=False),
+    UniqueConstraint("bucket_name", "prefix", name="uq_object_folders_bucket_name_prefix"),
+    Index("ix_object_folders_bucket_name_parent", "bucket_name", "parent"),
+)
+
+# Module state, set by init_app
+enabled = False
+resync_interval = 3600
+_indexed = {}  # bucket name -> time.monotonic() of its last reconcile
+_syncing = set()
+_first_syncs = {}  # bucket name -> threading.Event set once its first sync ends
+_lock = threading.Lock()
+# Background reconciles run one at a time, off the request threads.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="object-index")
+
+
+def ensure_fresh(bucket_name: str, api_key: dict) -> None:
+    """Fill the index of a bucket on first access and reconcile it in the background once stale."""
+    synced_at = _indexed.get(bucket_name)
+    if synced_at is None:
+        synced_at = _load_state(bucket_name)
+    if synced_at is None:
+        _first_sync(bucket_name, api_key)
+    elif time.monotonic() - synced_at > resync_interval:
+        with _lock:
+            if bucket_name in _syncing:
+                return
+            _syncing.add(bucket_name)
+        _executor.submit(_background_sync, bucket_name, api_key)
+
+def sync(bucket_name: str, api_key: dict) -> None:
+    """Reconcile the index of a bucket with a full listing, one page at a time.
+
+    Only new or changed generations are written; rows the listing did not
+    see are deleted at the end, and the folder counts rebuilt from the rows.
+    """
+    run = _new_run()
+    client = get_client(api_key)
+    db = get_db()
+    seen = 0
+    blobs = client.list_blobs(bucket_name, fields='items(name,size,contentType,generation,updated,md5Hash),nextPageToken')
+    for page in blobs.pages:
+        rows = [row_from_blob(blob, run) for blob in page]
+        seen += len(rows)
+        if rows:
+            upsert(bucket_name, rows, db=db, run=run)
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    with db.connect() as conn:
+        conn.execute(
+            objects_table.delete().where(
+                objects_table.c.bucket_name == bucket_name,
+                # Rows written through while the listing ran are newer than the run
+                objects_table.c.sync_run < run,
+            )
+        )
+        rebuild_folders(conn, bucket_name)
+        updated = conn.execute(
+            object_index_state_table.update()
+            .where(object_index_state_table.c.bucket_name == bucket_name)
+            .values(
+                sync_run=run, synced_at=now,
+                revision=object_index_state_table.c.revision + 1, changed_at=now,
+            )
+        ).rowcount
+        if not updated:
+            conn.execute(object_index_state_table.insert().values(
+                bucket_name=bucket_name, sync_run=run, synced_at=now, revision=1, changed_at=now,
+            ))
+        conn.commit()
+    _indexed[bucket_name] = time.monotonic()
+    logger.info("Object index of %s synced (%d objects).", bucket_name, seen)
+
+def upsert(bucket_name: str, rows: list, db: sqlalchemy.engine.base.Engine = None, run: int = None) -> None:
+    """Write rows for objects of a bucket, skipping those whose generation is not newer than the indexed one.
+
+    Rows another writer inserts concurrently make the insert fail: they are
+    read again and updated instead. Outside a reconcile (no ``run``), the
+    folder counts and the revision of the bucket are updated in the same
+    transaction; a reconcile rebuilds them once at its end instead.
+    """
+    db = db or get_db()
+    for attempt in range(UPSERT_ATTEMPTS):
+        with db.connect() as conn:
+            try:
+                _upsert(conn, bucket_name, rows, run)
+                conn.commit()
+                return
+            except sqlalchemy.exc.IntegrityError:
+                conn.rollback()
+                if attempt == UPSERT_ATTEMPTS - 1:
+                    raise
+
+def remove(bucket_name: str, name: str, generation: int = None) -> None:
+    """Drop an object from the index, only if it still has the given generation when one is passed."""
+    stmt = objects_table.delete().where(
+        objects_table.c.bucket_name == bucket_name,
+        objects_table.c.name == name,
+    )
+    if generation is not None:
+        stmt = stmt.where(objects_table.c.generation <= generation)
+    with get_db().connect() as conn:
+        row = conn.execute(
+            sqlalchemy.select(objects_table.c.parent, objects_table.c.size).where(
+                objects_table.c.bucket_name == bucket_name,
+                objects_table.c.name == name,
+            )
+        ).fetchone()
+        if row is not None and conn.execute(stmt).rowcount:
+            _update_folders(conn, bucket_name, {row.parent: (-1, -row.size)})
+            _bump_revision(conn, bucket_name)
+        conn.commit()
+
+def record_blob(bucket_name: str, blob) -> None:
+    """Write through an object the app just uploaded, when its bucket is indexed."""
+    if not enabled or not is_indexed(bucket_name):
+        return
+    try:
+        upsert(bucket_name, [row_from_blob(blob, _new_run())])
+    except Exception as e:
+        # The next reconcile picks the object up
+        logger.exception(e)
+
+def record_delete(bucket_name: str, name: str) -> None:
+    """Drop an object the app just deleted, when its bucket is indexed."""
+    if not enabled or not is_indexed(bucket_name):
+        return
+    try:
+        remove(bucket_name, name)
+    except Exception as e:
+        # The next reconcile drops the object
+        logger.exception(e)
+
+def refresh_object(bucket_name: str, name: str, api_key: dict) -> None:
+    """Fetch the metadata of an object uploaded outside upload_file and index it."""
+    if not enabled or not is_indexed(bucket_name):
+        return
+    blob = get_client(api_key).bucket(bucket_name).get_blob(name)
+    if blob is not None:
+        record_blob(bucket_name, blob)
+
+def find_by_hash(bucket_name: str, md5_hash: str, size: int) -> tuple:
+    """Return the name and generation of an indexed object with this content, or None (also when the bucket is not indexed)."""
+    if not enabled or not md5_hash or not is_indexed(bucket_name):
+        return None
+    with get_db().connect() as conn:
+        return conn.execute(
+            sqlalchemy.select(objects_table.c.name, objects_table.c.generation).where(
+                objects_table.c.bucket_name == bucket_name,
+                objects_table.c.md5_hash == md5_hash,
+                objects_table.c.size == size,
+            ).limit(1)
+        ).fetchone()
+
+def apply_notification(attributes: dict, resource: dict) -> bool:
+    """Apply a GCS Pub/Sub notification (attributes and decoded object resource) to the index.
+
+    Returns False when the bucket is not indexed and the event was ignored.
+    """
+    bucket_name = attributes.get('bucketId') or resource.get('bucket')
+    if not bucket_name or not is_indexed(bucket_name):
+        return False
+
+    event_type = attributes.get('eventType')
+    if event_type in ('OBJECT_FINALIZE', 'OBJECT_METADATA_UPDATE'):
+        upsert(bucket_name, [row_from_resource(resource, _new_run())])
+    elif event_type in ('OBJECT_DELETE', 'OBJECT_ARCHIVE'):
+        # A delete older than the indexed generation was overwritten meanwhile
+        remove(bucket_name, attributes.get('objectId') or resource['name'], int(attributes.get('objectGeneration') or resource['generation']))
+    return True
+
+def list_folder(bucket_name: str, prefix: str = '', sort: str = 'name', descending: bool = False, limit: int = 100, offset: int = 0) -> tuple:
+    """List a folder from the index.
+
+    Returns a page of file rows (dicts with ``name``, ``size``,
+    ``content_type``, ``updated`` and ``generation``) sorted as requested, the immediate
+    sub-folders with their object count and total size, and the number of
+    files in the folder. Only the direct children of the folder are read.
+    """
+    column = objects_table.c[sort if sort in SORT_COLUMNS else 'name']
+    order = [column.desc() if descending else column.asc(), objects_table.c.name.asc()]
+    in_folder = (objects_table.c.bucket_name == bucket_name) & (objects_table.c.parent == prefix)
+
+    with get_db().connect() as conn:
+        files = [
+            dict(row._mapping) for row in conn.execute(
+                sqlalchemy.select(
+                    objects_table.c.name, objects_table.c.size, objects_table.c.content_type,
+                    objects_table.c.updated, objects_table.c.generation
+                ).where(in_folder).order_by(*order).limit(limit).offset(offset)
+            )
+        ]
+        total = conn.execute(sqlalchemy.select(sqlalchemy.func.count()).where(in_folder)).scalar()
+        folders = [
+            {'prefix': folder, 'count': count, 'size': size} for folder, count, size in conn.execute(
+                sqlalchemy.select(
+                    object_folders_table.c.prefix, object_folders_table.c.object_count, object_folders_table.c.total_bytes
+                ).where(
+                    object_folders_table.c.bucket_name == bucket_name,
+                    object_folders_table.c.parent == prefix,
+                ).order_by(object_folders_table.c.prefix)
+            )
+        ]
+    return files, folders, total
+
+def fingerprint(bucket_name: str) -> tuple:
+    """Return the revision of the index of a bucket and the time of its last change.
+
+    Any upload, overwrite, delete or reconcile of the bucket bumps the revision.
+    """
+    with get_db().connect() as conn:
+        row = conn.execute(
+            sqlalchemy.select(
+                object_index_state_table.c.revision,
+                object_index_state_table.c.changed_at,
+                object_index_state_table.c.synced_at,
+            ).where(object_index_state_table.c.bucket_name == bucket_name)
+        ).fetchone()
+    if row is None:
+        return 0, None
+    return row.revision, row.changed_at or row.synced_at
+
+def rebuild_folders(conn, bucket_name: str) -> None:
+    """Recount the folders of a bucket from its indexed objects, in the caller's transaction."""
+    folders = {}
+    for parent, count, size in conn.execute(
+        sqlalchemy.select(
+            objects_table.c.parent, sqlalchemy.func.count(), sqlalchemy.func.sum(objects_table.c.size)
+        ).where(objects_table.c.bucket_name == bucket_name).group_by(objects_table.c.parent)
+    ):
+        for folder in _ancestors(parent):
+            totals = folders.setdefault(folder, [0, 0])
+            totals[0] += count
+            totals[1] += size or 0
+    conn.execute(object_folders_table.delete().where(object_folders_table.c.bucket_name == bucket_name))
+    if folders:
+        conn.execute(object_folders_table.insert(), [
+            {
+                'bucket_name': bucket_name, 'prefix': folder, 'parent': _parent(folder),
+                'object_count': count, 'total_bytes': size,
+            }
+            for folder, (count, size) in folders.items()
+        ])
+
+def last_synced(bucket_name: str) -> float:
+    """Return the time.monotonic() of the last reconcile of a bucket in this process, or 0."""
+    return _indexed.get(bucket_name, 0.0)
+
+def is_indexed(bucket_name: str) -> bool:
+    return bucket_name in _indexed or _load_state(bucket_name) is not None
+
+# Utils
+def row_from_blob(blob, run: int) -> dict:
+    return _row(blob.name, blob.size, blob.content_type, blob.generation, blob.updated, run, blob.md5_hash)
+
+def row_from_resource(resource: dict, run: int) -> dict:
+    """Build a row from an object resource as sent in Pub/Sub notifications."""
+    updated = resource.get('updated')
+    if updated:
+        updated = datetime.datetime.fromisoformat(updated.replace('Z', '+00:00'))
+    return _row(resource['name'], resource.get('size'), resource.get('contentType'), resource.get('generation'), updated, run, resource.get('md5Hash'))
+
+def _row(name, size, content_type, generation, updated, run, md5_hash=None) -> dict:
+    if updated is not None and updated.tzinfo is not None:
+        updated = updated.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return {
+        'name': name,
+        'parent': name[:name.rfind(DELIMITER) + 1],
+        'size': int(size or 0),
+        'content_type': content_type,
+        'generation': int(generation or 0),
+        'updated': updated,
+        'sync_run': run,
+        'md5_hash': md5_hash,
+    }
+
+def _upsert(conn, bucket_name: str, rows: list, run: int) -> None:
+    names = [row['name'] for row in rows]
+    existing = {
+        name: (generation, md5_hash, size) for name, generation, md5_hash, size in conn.execute(
+            sqlalchemy.select(
+                objects_table.c.name, objects_table.c.generation, objects_table.c.md5_hash, objects_table.c.size
+            ).where(
+                objects_table.c.bucket_name == bucket_name,
+                objects_table.c.name.in_(names),
+            )
+        )
+    }
+    new = [row for row in rows if row['name'] not in existing]
+
+    def is_newer(row):
+        generation, md5_hash, _ = existing[row['name']]
+        # Rows indexed before md5_hash existed are rewritten once to fill it in
+        return row['generation'] > generation or (
+            row['generation'] == generation and md5_hash is None and row['md5_hash'] is not None
+        )
+
+    # Notifications arrive out of order and listing pages may predate a
+    # write-through: an older generation never replaces a newer one
+    changed = [
+        dict(row, b_name=row['name'], b_generation=row['generation']) for row in rows
+        if row['name'] in existing and is_newer(row)
+    ]
+
+    if new:
+        conn.execute(objects_table.insert(), [dict(row, bucket_name=bucket_name) for row in new])
+    if changed:
+        conn.execute(
+            objects_table.update().where(
+                objects_table.c.bucket_name == bucket_name,
+                objects_table.c.name == bindparam('b_name'),
+                objects_table.c.generation <= bindparam('b_generation'),
+            ),
+            changed,
+        )
+    # Still in the bucket, at this generation or a newer one already indexed
+    unchanged = [row['name'] for row in rows if row['name'] in existing and not is_newer(row)]
+    if run is not None and unchanged:
+        conn.execute(
+            objects_table.update().where(
+                objects_table.c.bucket_name == bucket_name,
+                objects_table.c.name.in_(unchanged),
+            ).values(sync_run=run)
+        )
+    if run is None and (new or changed):
+        deltas = {}
+        for row in new:
+            count, size = deltas.get(row['parent'], (0, 0))
+            deltas[row['parent']] = (count + 1, size + row['size'])
+        for row in changed:
+            count, size = deltas.get(row['parent'], (0, 0))
+            deltas[row['parent']] = (count, size + row['size'] - existing[row['name']][2])
+        _update_folders(conn, bucket_name, deltas)
+        _bump_revision(conn, bucket_name)
+
+def _update_folders(conn, bucket_name: str, deltas: dict) -> None:
+    """Apply (count, size) changes of the objects directly in some folders to them and their ancestors."""
+    totals = {}
+    for parent, (count, size) in deltas.items():
+        for folder in _ancestors(parent):
+            folder_count, folder_size = totals.get(folder, (0, 0))
+            totals[folder] = (folder_count + count, folder_size + size)
+    for folder, (count, size) in sorted(totals.items()):
+        if count == 0 and size == 0:
+            continue
+        updated = conn.execute(
+            object_folders_table.update().where(
+                object_folders_table.c.bucket_name == bucket_name,
+                object_folders_table.c.prefix == folder,
+            ).values(
+                object_count=object_folders_table.c.object_count + count,
+                total_bytes=object_folders_table.c.total_bytes + size,
+            )
+        ).rowcount
+        if not updated and count > 0:
+            conn.execute(object_folders_table.insert().values(
+                bucket_name=bucket_name, prefix=folder, parent=_parent(folder), object_count=count, total_bytes=size,
+            ))
+    if any(count < 0 for count, _ in totals.values()):
+        # Folders whose last object went away
+        conn.execute(object_folders_table.delete().where(
+            object_folders_table.c.bucket_name == bucket_name,
+            object_folders_table.c.prefix.in_([folder for folder, (count, _) in totals.items() if count < 0]),
+            object_folders_table.c.object_count <= 0,
+        ))
+
+def _bump_revision(conn, bucket_name: str) -> None:
+    conn.execute(
+        object_index_state_table.update()
+        .where(object_index_state_table.c.bucket_name == bucket_name)
+        .values(
+            revision=object_index_state_table.c.revision + 1,
+            changed_at=datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None),
+        )
+    )
+
+def _ancestors(parent: str) -> list:
+    """Return the folders containing an object of this parent, outermost first ("a/" and "a/b/" for "a/b/")."""
+    parts = parent.split(DELIMITER)[:-1]
+    return [DELIMITER.join(parts[:i]) + DELIMITER for i in range(1, len(parts) + 1)]
+
+def _parent(folder: str) -> str:
+    return folder[:folder[:-1].rfind(DELIMITER) + 1]
+
+def _load_state(bucket_name: str):
+    with get_db().connect() as conn:
+        row = conn.execute(
+            sqlalchemy.select(object_index_state_table.c.synced_at)
+            .where(object_index_state_table.c.bucket_name == bucket_name)
+        ).fetchone()
+    if row is None:
+        return None
+    # Translate the persisted timestamp into this process' monotonic clock
+    age = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - row[0]
+    _indexed[bucket_name] = time.monotonic() - age.total_seconds()
+    return _indexed[bucket_name]
+
+def _new_run() -> int:
+    return time.time_ns() // 1000
+
+def _first_sync(bucket_name: str, api_key: dict) -> None:
+    """Fill the index of a bucket once, however many requests reach it first; the others wait for it."""
+    with _lock:
+        done = _first_syncs.get(bucket_name)
+        leader = done is None
+        if leader:
+            done = _first_syncs[bucket_name] = threading.Event()
+    if not leader:
+        done.wait()
+        if bucket_name not in _indexed:
+            # It failed: this request tries again
+            _first_sync(bucket_name, api_key)
+        return
+    try:
+        sync(bucket_name, api_key)
+    finally:
+        with _lock:
+            del _first_syncs[bucket_name]
+        done.set()
+
+def _background_sync(bucket_name: str, api_key: dict) -> None:
+    try:
+        sync(bucket_name, api_key)
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        with _lock:
+            _syncing.discard(bucket_name)
+
+def init_app(app):
+    """Enable the index and set its reconcile interval from the app config."""
+    global enabled, resync_interval
+    enabled = app.config.get("OBJECT_INDEX_ENABLED", False)
+    resync_interval = app.config.get("OBJECT_INDEX_RESYNC_INTERVAL", resync_interval)
@@ -1,36 +1,257 @@
-from google.cloud import storage
-from google.cloud.exceptions import NotFound
+import base64, binascii, mimetypes
+
+from google.cloud.exceptions import BadRequest, NotFound, PreconditionFailed
+from werkzeug.utils import secure_filename
 from storage_explorer import get_logger
+from storage_explorer.utils.storage_connector import get_client
+from storage_explorer.bucket.utils.directory_index import get_index, record_upload
+from storage_explorer.bucket.utils import dedupe, object_index, search, previews, stats
+from storage_explorer.utils import jobs
 
 logger = get_logger()
 
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'md'}
 
+# Upper bound of objects fetched per listing page (the GCS API maximum).
+MAX_PAGE_SIZE = 1000
+# Size of the reads issued while streaming an object to the client.
+READ_CHUNK_SIZE = 1024 * 1024
+
 def create_bucket(bucket_name: str, api_key: dict) -> str:
     """Create a new GCP bucket."""
-    client = storage.Client.from_service_account_info(api_key)
+    client = get_client(api_key)
     bucket = client.bucket(bucket_name)
     bucket.create()
     return bucket
 
-def list_files(bucket_name: str, api_key: dict) -> list:
-    """List all files in a GCP bucket."""
-    client = storage.Client.from_service_account_info(api_key)
+def request_bucket(bucket_name: str, owner: str = None) -> str:
+    """Queue the creation of a bucket on the background workers. Returns the job id."""
+    return jobs.enqueue(
+        'provision_bucket',
+        {'bucket_name': bucket_name},
+        owner=owner,
+        dedupe_key=f"provision_bucket:{bucket_name}"
+    )
+
+def list_files_page(bucket_name: str, api_key: dict, page_size: int = 100, cursor: str = None, prefix: str = '') -> tuple:
+    """List a single page of the immediate children of a folder in a GCP bucket.
+
+    Returns a generator over the files of the page (dicts with ``name``,
+    ``size``, ``content_type``, ``updated`` and ``generation``), the list
+    of sub-folders and the cursor of the next page, or None when this is
+    the last one.
+    """
+    client = get_client(api_key)
+    blobs = client.list_blobs(
+        bucket_name,
+        prefix=prefix or None,
+        delimiter='/',
+        page_size=min(page_size, MAX_PAGE_SIZE),
+        page_token=decode_cursor(cursor),
+    )
+    try:
+        page = next(blobs.pages)
+    except StopIteration:
+        return iter(()), [], None
+    except NotFound:
+        request_bucket(bucket_name)
+        return iter(()), [], None
+    except BadRequest as e:
+        if cursor is None:
+            raise
+        # Well-formed base64, but not a page token GCS issued
+        raise ValueError("Invalid page cursor.") from e
+    folders = [{'prefix': folder, 'count': None, 'size': None} for folder in sorted(page.prefixes)]
+    # Skip the "folder/" placeholder object of the current folder
+    files = (
+        {
+            'name': blob.name,
+            'size': blob.size,
+            'content_type': blob.content_type,
+            'updated': blob.updated,
+            'generation': blob.generation,
+        }
+        for blob in page if blob.name != prefix
+    )
+    return files, folders, encode_cursor(blobs.next_page_token)
+
+def list_folder_from_index(bucket_name: str, api_key: dict, page_size: int = 100, cursor: str = None, prefix: str = '') -> tuple:
+    """Same contract as list_files_page, served from the cached directory index.
+
+    Folders come with their object count and total size.
+    """
+    token = decode_cursor(cursor) or '0'
+    if not token.isdigit():
+        raise ValueError("Invalid page cursor.")
+    offset = int(token)
+
+    try:
+        folders, files = get_index(bucket_name, api_key).listing(prefix)
+    except NotFound:
+        request_bucket(bucket_name)
+        return iter(()), [], None
+    # Folders are listed first, then files, and pages are cut across both
+    page_folders = folders[offset:offset + page_size]
+    file_offset = max(offset - len(folders), 0)
+    page_files = files[file_offset:file_offset + page_size - len(page_folders)]
+
+    next_offset = offset + page_size
+    next_cursor = encode_cursor(str(next_offset)) if next_offset < len(folders) + len(files) else None
+    return iter(page_files), page_folders, next_cursor
+
+def list_folder_from_object_index(bucket_name: str, api_key: dict, page_size: int = 100, cursor: str = None, prefix: str = '', sort: str = 'name', descending: bool = False) -> tuple:
+    """Same contract as list_files_page, served from the object-metadata index in the app DB.
+
+    Files can be sorted by any of name, size or updated time;
+    folders come with their object count and total size.
+    """
+    token = decode_cursor(cursor) or '0'
+    if not token.isdigit():
+        raise ValueError("Invalid page cursor.")
+    offset = int(token)
+
+    try:
+        object_index.ensure_fresh(bucket_name, api_key)
+    except NotFound:
+        request_bucket(bucket_name)
+        return iter(()), [], None
+
+    files, folders, total = object_index.list_folder(
+        bucket_name, prefix, sort=sort, descending=descending, limit=page_size, offset=offset
+    )
+    next_cursor = encode_cursor(str(offset + page_size)) if offset + page_size < total else None
+    # Sub-folders are shown on the first page only
+    return iter(files), folders if offset == 0 else [], next_cursor
+
+def folder_fingerprint_from_index(bucket_name: str, api_key: dict, prefix: str = '') -> tuple:
+    """Fingerprint a folder from the cached directory index, without listing it.
+
+    Returns a value that changes whenever the index does, and no Last-Modified time.
+    """
     try:
-        bucket = client.get_bucket(bucket_name)
+        index = get_index(bucket_name, api_key)
     except NotFound:
-        bucket = create_bucket(bucket_name, api_key)
-    blobs = client.list_blobs(bucket)
-    return [blob.name for blob in blobs]
+        request_bucket(bucket_name)
+        return None, None
+    return (index.built_at, index.version), None
+
+def folder_fingerprint_from_object_index(bucket_name: str, api_key: dict, prefix: str = '') -> tuple:
+    """Fingerprint a folder from the object-metadata index: the revision of its bucket's index.
 
-def upload_file(bucket_name: str, filename: str, file, api_key: dict) -> None:
-    client = storage.Client.from_service_account_info(api_key)
+    Returns the fingerprint and the bucket's Last-Modified time.
+    """
+    try:
+        object_index.ensure_fresh(bucket_name, api_key)
+    except NotFound:
+        request_bucket(bucket_name)
+        return None, None
+    return object_index.fingerprint(bucket_name)
+
+def upload_file(bucket_name: str, filename: str, file, api_key: dict) -> str:
+    """Upload a file to a GCP bucket, unless the object already has the same content.
+
+    Returns dedupe.UPLOADED, dedupe.UNCHANGED when nothing was sent, or
+    dedupe.COPIED when the object was copied server-side from an identical one.
+    """
+    client = get_client(api_key)
     bucket = client.bucket(bucket_name)
     blob = bucket.blob(filename)
-    blob.upload_from_file(file_obj=file)
+    size = dedupe.remaining_size(file)
+    # The object this upload replaces, to skip unchanged content and count overwrites in the stats
+    existing = None
+    if (size is not None and dedupe.skip_unchanged) or stats.tracks(bucket_name):
+        existing = bucket.get_blob(filename)
+    if not dedupe.needs_checksums(size, existing):
+        # Hashed by the client library while it streams, for GCS to validate
+        blob.upload_from_file(file_obj=file, size=size)
+        outcome = dedupe.UPLOADED
+    else:
+        # Hashed in a pass of its own before sending: the checksums decide whether to send at all
+        checksums = dedupe.checksum_file(file)
+        if dedupe.skip_unchanged and existing is not None and checksums.matches(existing):
+            return dedupe.UNCHANGED
+        source = dedupe.find_copy_source(bucket_name, filename, checksums)
+        if source is not None and _copy_identical(bucket, blob, source, checksums):
+            outcome = dedupe.COPIED
+        else:
+            # GCS validates the checksums it is given, so the client need not hash again
+            blob.md5_hash = checksums.md5_hash
+            blob.crc32c = checksums.crc32c
+            blob.upload_from_file(file_obj=file, size=checksums.size, checksum=None)
+            outcome = dedupe.UPLOADED
+    record_upload(bucket_name, filename, blob.size or 0)
+    stats.record_upload(bucket_name, filename, blob.size or 0, existing.size or 0 if existing is not None else None)
+    object_index.record_blob(bucket_name, blob)
+    search.record_upload(bucket_name, filename)
+    previews.schedule_for_upload(bucket_name, blob)
+    return outcome
+
+
+def iter_files(bucket_name: str, api_key: dict, prefix: str = ''):
+    """Lazily iterate over every blob under a prefix, one listing page at a time."""
+    client = get_client(api_key)
+    return iter(client.list_blobs(bucket_name, prefix=prefix or None))
 
+def read_range(blob, start: int, end: int) -> bytes:
+    """Read the bytes start..end (inclusive) of a blob."""
+    # Checksums cannot be validated on partial reads
+    return blob.download_as_bytes(start=start, end=end, checksum=None)
+
+def open_file(bucket_name: str, name: str, api_key: dict, chunk_size: int = READ_CHUNK_SIZE):
+    """Open an object of a GCP bucket for streamed reading.
+
+    Returns the blob, with its metadata loaded, and a binary reader, or
+    (None, None) when the object does not exist.
+    """
+    client = get_client(api_key)
+    blob = client.bucket(bucket_name).get_blob(name)
+    if blob is None:
+        return None, None
+    return blob, blob.open('rb', chunk_size=chunk_size)
 
 # Utils
+def _copy_identical(bucket, blob, source: tuple, checksums) -> bool:
+    """Rewrite blob from the (name, generation) of an identical object; False when that one is gone or changed since indexed."""
+    name, generation = source
+    # The rewrite keeps the source's metadata unless given the destination's:
+    # set what an upload of this name would get, and nothing else
+    blob.content_type = mimetypes.guess_type(blob.name)[0] or 'application/octet-stream'
+    blob.metadata = {}
+    try:
+        token, _, _ = blob.rewrite(bucket.blob(name), if_source_generation_match=generation)
+        # Large objects take several rewrite calls
+        while token is not None:
+            token, _, _ = blob.rewrite(bucket.blob(name), token=token, if_source_generation_match=generation)
+    except (NotFound, PreconditionFailed):
+        logger.info("Copy source %s changed since it was indexed, uploading %s.", name, blob.name)
+        return False
+    return checksums.matches(blob)
+
 def allowed_file(filename):
     return '.' in filename and \
-      filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
\ No newline at end of file
+      filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def secure_path(path: str) -> str:
+    """Apply secure_filename to each folder of a relative path, e.g. from a folder drop."""
+    parts = (secure_filename(part) for part in path.replace('\\', '/').split('/'))
+    return '/'.join(part for part in parts if part)
+
+def normalize_prefix(prefix: str) -> str:
+    """Turn a folder path such as "photos/2024" into the GCS prefix "photos/2024/"."""
+    prefix = '/'.join(part for part in (prefix or '').split('/') if part and part not in ('.', '..'))
+    return f"{prefix}/" if prefix else ''
+
+def encode_cursor(page_token: str) -> str:
+    """Wrap a GCS page token into an opaque, URL-safe cursor."""
+    if not page_token:
+        return None
+    return base64.urlsafe_b64encode(page_token.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> str:
+    """Unwrap a cursor produced by encode_cursor, raising ValueError when it is malformed."""
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError("Invalid page cursor.") from e
\ No newline at end of file
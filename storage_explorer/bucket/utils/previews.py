@@ -0,0 +1,210 @@
+import base64, importlib.util, io, multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from storage_explorer import get_logger
+from storage_explorer.utils.cache import TTLCache
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+THUMBNAIL_SIZE = (256, 256)
+# Only the head of text files is read to render their preview.
+TEXT_PREVIEW_BYTES = 4096
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+TEXT_EXTENSIONS = {'md', 'txt'}
+
+
+class PreviewUnavailable(Exception):
+    """Raised when no preview can be generated for an object."""
+
+
+def preview_kind(name: str):
+    """Return 'image', 'pdf', 'text' or None for an object name, given the renderers installed."""
+    extension = name.rsplit('.', 1)[-1].lower() if '.' in name else ''
+    if extension in IMAGE_EXTENSIONS and _has_pillow:
+        return 'image'
+    if extension == 'pdf' and _has_pillow and _has_pymupdf:
+        return 'pdf'
+    if extension in TEXT_EXTENSIONS and _has_pillow:
+        return 'text'
+    return None
+
+def get_preview(bucket_name: str, name: str, api_key: dict, generation: int = None, wait: float = None):
+    """Return the path and content key of the PNG preview of an object, generating it if needed.
+
+    With the generation of the object (as listed), a cached preview is found
+    without any GCS call. Otherwise the object metadata is fetched once.
+    Returns (None, None) when the preview is not ready within ``wait``
+    seconds or cannot be generated.
+    """
+    if preview_kind(name) is None:
+        return None, None
+
+    ref = f"{bucket_name}/{name}#{generation}"
+    key = refs.get(ref) if generation is not None else None
+    if key is not None and os.path.exists(_path(key)):
+        return _path(key), key
+
+    blob = get_client(api_key).bucket(bucket_name).get_blob(name)
+    if blob is None or (generation is not None and blob.generation != generation):
+        return None, None
+    key = _content_key(blob)
+    refs.set(f"{bucket_name}/{name}#{blob.generation}", key)
+    if os.path.exists(_path(key)):
+        return _path(key), key
+
+    future = _schedule(blob, key)
+    try:
+        future.result(timeout=preview_wait if wait is None else wait)
+    except TimeoutError:
+        return None, None
+    except PreviewUnavailable:
+        return None, None
+    return _path(key), key
+
+def schedule_for_upload(bucket_name: str, blob) -> None:
+    """Start generating the preview of a freshly uploaded object in the background."""
+    if not generate_on_upload or preview_kind(blob.name) is None or blob.md5_hash is None:
+        return
+    key = _content_key(blob)
+    refs.set(f"{bucket_name}/{blob.name}#{blob.generation}", key)
+    if not os.path.exists(_path(key)):
+        _schedule(blob, key)
+
+# Internals
+def _schedule(blob, key: str):
+    """Fetch and render a preview once, whatever the number of concurrent requests for it."""
+    with _lock:
+        future = _pending.get(key)
+        if future is None:
+            future = _fetchers.submit(_generate, blob, key)
+            _pending[key] = future
+            future.add_done_callback(lambda _: _forget(key))
+    return future
+
+def _forget(key: str) -> None:
+    with _lock:
+        _pending.pop(key, None)
+
+def _generate(blob, key: str) -> None:
+    kind = preview_kind(blob.name)
+    if (blob.size or 0) > max_source_size and kind != 'text':
+        raise PreviewUnavailable(f"{blob.name} is too large to preview.")
+    if kind == 'text':
+        data = blob.download_as_bytes(start=0, end=TEXT_PREVIEW_BYTES - 1, checksum=None) if blob.size else b''
+    else:
+        data = blob.download_as_bytes()
+
+    renderers = _renderer_pool()
+    future = renderers.submit(render_preview, kind, data, THUMBNAIL_SIZE)
+    try:
+        png = future.result(timeout=preview_wait)
+    except PreviewUnavailable:
+        raise
+    except TimeoutError as e:
+        future.cancel()
+        raise PreviewUnavailable(f"Preview of {blob.name} took too long.") from e
+    except BrokenProcessPool as e:
+        # A renderer died, e.g. on a decompression bomb: the next preview starts a new pool
+        _discard_renderers(renderers)
+        raise PreviewUnavailable(f"Preview of {blob.name} failed.") from e
+    except Exception as e:
+        logger.exception(e)
+        raise PreviewUnavailable(f"Preview of {blob.name} failed.") from e
+
+    # Write then rename, so readers never see a partial file
+    path = _path(key)
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(png)
+    os.replace(tmp_path, path)
+
+def _renderer_pool() -> ProcessPoolExecutor:
+    """The rendering pool of this process, started on first use.
+
+    Not built by the app factory: a worker forked after it (gunicorn
+    --preload) would inherit a pool without live threads.
+    """
+    global _renderers, _renderers_pid
+    if _renderers is None or _renderers_pid != os.getpid():
+        with _lock:
+            if _renderers is None or _renderers_pid != os.getpid():
+                # Spawned, not forked from this threaded process
+                _renderers = ProcessPoolExecutor(max_workers=_render_workers, mp_context=multiprocessing.get_context('spawn'))
+                _renderers_pid = os.getpid()
+    return _renderers
+
+def _discard_renderers(pool: ProcessPoolExecutor) -> None:
+    global _renderers
+    with _lock:
+        if _renderers is pool:
+            _renderers = None
+
+def _content_key(blob) -> str:
+    """Content address of a preview: the object's MD5 plus the thumbnail size."""
+    md5 = base64.b64decode(blob.md5_hash).hex() if blob.md5_hash else f"g{blob.generation}"
+    return f"{md5}-{THUMBNAIL_SIZE[0]}x{THUMBNAIL_SIZE[1]}"
+
+def _path(key: str) -> str:
+    return os.path.join(cache_dir, f"{key}.png")
+
+# Runs in the process pool
+def render_preview(kind: str, data: bytes, size: tuple) -> bytes:
+    """Render a PNG thumbnail of an image, the first page of a PDF or the head of a text file."""
+    from PIL import Image, ImageDraw
+
+    if kind == 'image':
+        image = Image.open(io.BytesIO(data))
+        image.draft('RGB', size)  # let JPEG decode at a reduced scale
+    elif kind == 'pdf':
+        import pymupdf
+        with pymupdf.open(stream=data, filetype='pdf') as document:
+            if not document.page_count:
+                raise PreviewUnavailable("Empty PDF.")
+            pixmap = document[0].get_pixmap(dpi=72)
+            image = Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+    elif kind == 'text':
+        lines = data.decode('utf-8', errors='replace').splitlines()[:16]
+        image = Image.new('RGB', size, 'white')
+        ImageDraw.Draw(image).multiline_text((8, 8), '\n'.join(line[:40] for line in lines), fill='black')
+    else:
+        raise PreviewUnavailable(f"No preview for {kind}.")
+
+    image.thumbnail(size)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    output = io.BytesIO()
+    image.save(output, format='PNG', optimize=True)
+    return output.getvalue()
+
+
+# Module state, set by init_app
+cache_dir = os.path.join(os.getcwd(), 'previews')
+max_source_size = 20 * 1024 * 1024
+preview_wait = 5.0
+generate_on_upload = True
+_has_pillow = importlib.util.find_spec('PIL') is not None
+_has_pymupdf = importlib.util.find_spec('pymupdf') is not None
+# Content key of the preview of each "<bucket>/<object>#<generation>".
+refs = TTLCache("preview_ref", maxsize=100_000, ttl=24 * 3600)
+_pending = {}
+_lock = threading.Lock()
+# Downloads run on threads; decoding and resizing on processes, off the GIL.
+_fetchers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="preview")
+_render_workers = 2
+_renderers = None
+_renderers_pid = None
+
+def init_app(app):
+    """Set up the preview cache directory and the size of the rendering process pool from the app config."""
+    global cache_dir, max_source_size, preview_wait, generate_on_upload, _render_workers
+    cache_dir = app.config.get("PREVIEW_CACHE_DIR") or os.path.join(app.instance_path, 'previews')
+    os.makedirs(cache_dir, exist_ok=True)
+    max_source_size = app.config.get("PREVIEW_MAX_SOURCE_SIZE", max_source_size)
+    preview_wait = app.config.get("PREVIEW_WAIT", preview_wait)
+    generate_on_upload = app.config.get("PREVIEW_ON_UPLOAD", generate_on_upload)
+    if not _has_pillow:
+        logger.warning("Pillow is not installed, file previews are disabled.")
+    app.jinja_env.globals['preview_kind'] = preview_kind
+    _render_workers = app.config.get("PREVIEW_WORKERS", _render_workers)
@@ -0,0 +1,113 @@
+import re
+
+from storage_explorer import get_logger
+from storage_explorer.utils.cache import TTLCache
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+# Every chunk but the last one of a GCS resumable upload must be a multiple of 256 KiB.
+CHUNK_ALIGNMENT = 256 * 1024
+DEFAULT_CHUNK_SIZE = 32 * CHUNK_ALIGNMENT  # 8 MiB
+
+_RANGE_RE = re.compile(r"bytes=0-(\d+)")
+
+
+class UploadSessionError(Exception):
+    """Raised when GCS rejects or no longer knows a resumable upload session."""
+
+
+def start_upload(bucket_name: str, name: str, size: int, content_type: str, api_key: dict, origin: str = None) -> str:
+    """Open a GCS resumable upload session for an object and return its session URI.
+
+    With an ``origin``, the session accepts cross-origin requests so the
+    browser can send the chunks to GCS directly.
+    """
+    client = get_client(api_key)
+    blob = client.bucket(bucket_name).blob(name)
+    return blob.create_resumable_upload_session(
+        content_type=content_type or 'application/octet-stream',
+        size=size,
+        origin=origin,
+        client=client,
+    )
+
+def query_offset(session_url: str, total: int, api_key: dict) -> tuple:
+    """Ask GCS how many bytes of the session are persisted.
+
+    Returns the persisted offset and whether the upload is complete.
+    """
+    response = _put(session_url, b'', f"bytes */{total}", api_key)
+    return _parse_response(response, total)
+
+def upload_stream(session_url: str, stream, offset: int, total: int, api_key: dict, chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple:
+    """Forward a request body into a resumable session, one chunk at a time.
+
+    ``stream`` holds the bytes of the object starting at ``offset``. At most
+    one chunk is held in memory. When the body ends before the object does,
+    only the aligned part of the last chunk is sent and the client resumes
+    from the returned offset.
+
+    Returns the persisted offset and whether the upload is complete.
+    """
+    if total == 0:
+        return query_offset(session_url, total, api_key)
+
+    buffer = bytearray()
+    exhausted = False
+    while True:
+        while not exhausted and len(buffer) < chunk_size:
+            data = stream.read(chunk_size - len(buffer))
+            if not data:
+                exhausted = True
+            buffer += data
+
+        end = offset + len(buffer)
+        if end > total:
+            raise ValueError("Upload body is larger than the declared size.")
+
+        if end == total:
+            send = len(buffer)
+        elif len(buffer) >= chunk_size:
+            send = chunk_size
+        else:
+            send = len(buffer) - len(buffer) % CHUNK_ALIGNMENT
+        if send == 0:
+            return offset, False
+
+        content_range = f"bytes {offset}-{offset + send - 1}/{total}"
+        response = _put(session_url, bytes(buffer[:send]), content_range, api_key)
+        persisted, complete = _parse_response(response, total)
+        if complete:
+            return total, True
+
+        # GCS may persist less than it was sent; keep the rest for the next chunk
+        del buffer[:persisted - offset]
+        offset = persisted
+        if exhausted and len(buffer) < CHUNK_ALIGNMENT and offset + len(buffer) < total:
+            return offset, False
+
+
+# Utils
+def _put(session_url: str, body: bytes, content_range: str, api_key: dict):
+    http = get_client(api_key)._http
+    return http.put(session_url, data=body, headers={'Content-Range': content_range})
+
+def _parse_response(response, total: int) -> tuple:
+    if response.status_code in (200, 201):
+        return total, True
+    if response.status_code == 308:
+        match = _RANGE_RE.match(response.headers.get('Range', ''))
+        return (int(match.group(1)) + 1 if match else 0), False
+    raise UploadSessionError(f"Resumable upload failed with status {response.status_code}: {response.text[:200]}")
+
+
+# Open upload sessions keyed by upload id. GCS keeps a session for a week.
+upload_sessions = TTLCache("upload_session", maxsize=4096, ttl=7 * 24 * 3600)
+
+def init_app(app):
+    """Share open upload sessions across workers when a shared store is configured."""
+    chunk_size = app.config.get("UPLOAD_CHUNK_SIZE", DEFAULT_CHUNK_SIZE)
+    if chunk_size <= 0 or chunk_size % CHUNK_ALIGNMENT:
+        raise ValueError("UPLOAD_CHUNK_SIZE must be a positive multiple of 256 KiB.")
+    upload_sessions.configure(shared=app.config.get("USER_CACHE_SHARED_STORE"))
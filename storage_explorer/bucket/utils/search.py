@@ -0,0 +1,178 @@
+import bisect, threading, time
+from array import array
+
+import sqlalchemy
+
+from storage_explorer import get_logger
+from storage_explorer.bucket.utils import object_index
+from storage_explorer.db import get_db
+from storage_explorer.utils.cache import TTLCache
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+NGRAM = 3
+QUERY_TYPES = ('substring', 'prefix', 'ext')
+
+
+class NameIndex:
+    """Case-insensitive search index over the object names of a bucket.
+
+    - substring: trigram posting lists; candidates from the rarest trigram
+      of the query are verified against the name.
+    - prefix: names kept sorted, so a prefix is a binary search.
+    - ext: posting lists by file extension.
+
+    Posting lists are arrays of name ids in insertion order, so a query can
+    stop as soon as it has ``limit`` matches.
+    """
+
+    def __init__(self, bucket_name: str):
+        self.bucket_name = bucket_name
+        self.built_at = time.monotonic()
+        self._names = []  # id -> name, None once removed
+        self._ids = {}  # name -> id
+        self._lowered = []  # id -> lower-cased name
+        self._sorted = []  # (lower-cased name, id), sorted
+        self._ngrams = {}
+        self._extensions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, name: str) -> None:
+        """Index a new object name; known names are ignored."""
+        with self._lock:
+            entry = self._add(name)
+            if entry is not None:
+                bisect.insort(self._sorted, entry)
+
+    def extend(self, names) -> None:
+        """Index many names at once, sorting the prefix list only once at the end."""
+        with self._lock:
+            for name in names:
+                entry = self._add(name)
+                if entry is not None:
+                    self._sorted.append(entry)
+            self._sorted.sort()
+
+    def remove(self, name: str) -> None:
+        """Forget an object name. Its postings stay behind as tombstones."""
+        with self._lock:
+            object_id = self._ids.pop(name, None)
+            if object_id is None:
+                return
+            self._names[object_id] = None
+            index = bisect.bisect_left(self._sorted, (self._lowered[object_id], object_id))
+            del self._sorted[index]
+
+    def search(self, query: str, query_type: str = 'substring', limit: int = 100) -> list:
+        """Return up to ``limit`` object names matching the query."""
+        query = query.lower()
+        if not query:
+            return []
+        if query_type == 'prefix':
+            return self._search_prefix(query, limit)
+        if query_type == 'ext':
+            return self._collect(self._extensions.get(query.lstrip('.'), ()), None, limit)
+        return self._search_substring(query, limit)
+
+    # Internals
+    def _add(self, name: str):
+        if name in self._ids:
+            return None
+        object_id = len(self._names)
+        lowered = name.lower()
+        self._names.append(name)
+        self._lowered.append(lowered)
+        self._ids[name] = object_id
+        for gram in {lowered[i:i + NGRAM] for i in range(len(lowered) - NGRAM + 1)}:
+            self._ngrams.setdefault(gram, array('I')).append(object_id)
+        self._extensions.setdefault(_extension(lowered), array('I')).append(object_id)
+        return lowered, object_id
+
+    def _search_prefix(self, query: str, limit: int) -> list:
+        start = bisect.bisect_left(self._sorted, (query, -1))
+        results = []
+        for lowered, object_id in self._sorted[start:start + limit]:
+            if not lowered.startswith(query):
+                break
+            results.append(self._names[object_id])
+        return results
+
+    def _search_substring(self, query: str, limit: int) -> list:
+        if len(query) < NGRAM:
+            # Too short for trigrams: scan the names
+            return self._collect(range(len(self._names)), query, limit)
+        grams = {query[i:i + NGRAM] for i in range(len(query) - NGRAM + 1)}
+        postings = [self._ngrams.get(gram) for gram in grams]
+        if any(posting is None for posting in postings):
+            return []
+        rarest = min(postings, key=len)
+        # A single trigram query matches every name of its posting list
+        return self._collect(rarest, query if len(query) > NGRAM else None, limit)
+
+    def _collect(self, ids, query, limit: int) -> list:
+        results = []
+        for object_id in ids:
+            name = self._names[object_id]
+            if name is None or (query is not None and query not in self._lowered[object_id]):
+                continue
+            results.append(name)
+            if len(results) >= limit:
+                break
+        return results
+
+
+# Search indexes keyed by bucket name.
+index_cache = TTLCache("search_index", maxsize=64, ttl=3600)
+
+def build_index(bucket_name: str, api_key: dict) -> NameIndex:
+    """Build the search index of a bucket from the object index when it is enabled, else from a listing."""
+    index = NameIndex(bucket_name)
+    if object_index.enabled and object_index.is_indexed(bucket_name):
+        with get_db().connect() as conn:
+            names = conn.execute(
+                sqlalchemy.select(object_index.objects_table.c.name)
+                .where(object_index.objects_table.c.bucket_name == bucket_name)
+            ).scalars()
+            index.extend(names)
+    else:
+        client = get_client(api_key)
+        index.extend(blob.name for blob in client.list_blobs(bucket_name, fields='items(name),nextPageToken'))
+    logger.info("Search index built for %s (%d objects).", bucket_name, len(index))
+    return index
+
+def get_index(bucket_name: str, api_key: dict) -> NameIndex:
+    """Return the search index of a bucket, rebuilding it when missing or older than the object index."""
+    index = index_cache.get(bucket_name)
+    if index is None or object_index.last_synced(bucket_name) > index.built_at:
+        index = build_index(bucket_name, api_key)
+        index_cache.set(bucket_name, index)
+    return index
+
+def search(bucket_name: str, query: str, api_key: dict, query_type: str = 'substring', limit: int = 100) -> list:
+    """Search the object names of a bucket."""
+    return get_index(bucket_name, api_key).search(query, query_type, limit)
+
+def record_upload(bucket_name: str, name: str) -> None:
+    """Reflect an upload in the cached index of the bucket, if one exists."""
+    index = index_cache.get(bucket_name)
+    if index is not None:
+        index.add(name)
+
+def record_delete(bucket_name: str, name: str) -> None:
+    """Reflect a delete in the cached index of the bucket, if one exists."""
+    index = index_cache.get(bucket_name)
+    if index is not None:
+        index.remove(name)
+
+def init_app(app):
+    """Configure the search index cache from the app config."""
+    index_cache.configure(ttl=app.config.get("SEARCH_INDEX_TTL"))
+
+# Utils
+def _extension(name: str) -> str:
+    filename = name.rsplit('/', 1)[-1]
+    return filename.rsplit('.', 1)[1] if '.' in filename else ''
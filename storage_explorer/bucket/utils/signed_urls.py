@@ -0,0 +1,40 @@
+import datetime
+
+from storage_explorer import get_logger
+from storage_explorer.utils.cache import TTLCache
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+DEFAULT_EXPIRATION = 3600  # 1 hour
+# A cached URL is handed out until it has at least this many seconds left.
+MIN_REMAINING = 300
+
+
+def generate_download_url(bucket_name: str, name: str, api_key: dict) -> str:
+    """Return a V4 signed GET URL for an object, reusing a cached one while it is still valid."""
+    key = f"{bucket_name}/{name}"
+    url = download_urls.get(key)
+    if url is None:
+        client = get_client(api_key)
+        blob = client.bucket(bucket_name).blob(name)
+        url = blob.generate_signed_url(
+            version="v4",
+            expiration=datetime.timedelta(seconds=expiration),
+            method="GET",
+            response_disposition=f'attachment; filename="{name.rsplit("/", 1)[-1]}"',
+        )
+        download_urls.set(key, url)
+    return url
+
+# Signed download URLs keyed by "<bucket>/<object>".
+expiration = DEFAULT_EXPIRATION
+download_urls = TTLCache("signed_url", maxsize=4096, ttl=DEFAULT_EXPIRATION - MIN_REMAINING)
+
+def init_app(app):
+    """Size the URL lifetime and its cache from the app config."""
+    global expiration
+    expiration = app.config.get("SIGNED_URL_EXPIRATION", DEFAULT_EXPIRATION)
+    if expiration <= MIN_REMAINING:
+        raise ValueError(f"SIGNED_URL_EXPIRATION must be longer than {MIN_REMAINING} seconds.")
+    download_urls.configure(ttl=expiration - MIN_REMAINING)
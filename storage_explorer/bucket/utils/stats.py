@@ -0,0 +1,300 @@
+import collections, datetime, time
+
+import click
+import sqlalchemy
+from flask.cli import with_appcontext
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, MetaData, String, Table, bindparam
+
+from storage_explorer import get_logger
+from storage_explorer.db import get_db, get_read_db
+from storage_explorer.utils import accounts, config, jobs
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+DELIMITER = '/'
+# Extension bucket of files whose extension is not an allowed one.
+OTHER = 'other'
+
+metadata = MetaData()
+
+# Running aggregates of every folder of the tracked buckets ("" is the
+# bucket root), one row per extension, so the stats of a folder are one
+# primary key range read whatever the size of the bucket.
+bucket_stats_table = Table(
+    "bucket_stats",
+    metadata,
+    Column("bucket_name", String(63), primary_key=True, nullable=False),
+    Column("prefix", String(1024), primary_key=True, nullable=False),
+    Column("extension", String(16), primary_key=True, nullable=False),
+    Column("object_count", BigInteger, nullable=False),
+    Column("total_bytes", BigInteger, nullable=False),
+)
+
+# One row per tracked bucket. `dirty` is set when a delta could only be
+# applied partially (e.g. a delete of unknown size), to reconcile it early.
+bucket_stats_state_table = Table(
+    "bucket_stats_state",
+    metadata,
+    Column("bucket_name", String(63), primary_key=True, nullable=False),
+    Column("synced_at", DateTime, nullable=False),
+    Column("dirty", Boolean, nullable=False, default=False),
+)
+
+_select_stats = (
+    sqlalchemy.select(bucket_stats_table.c.extension, bucket_stats_table.c.object_count, bucket_stats_table.c.total_bytes)
+    .where(bucket_stats_table.c.bucket_name == bindparam('bucket_name'), bucket_stats_table.c.prefix == bindparam('prefix'))
+)
+_select_state = (
+    sqlalchemy.select(bucket_stats_state_table.c.synced_at, bucket_stats_state_table.c.dirty)
+    .where(bucket_stats_state_table.c.bucket_name == bindparam('bucket_name'))
+)
+_add_delta = (
+    bucket_stats_table.update()
+    .where(
+        bucket_stats_table.c.bucket_name == bindparam('b_bucket_name'),
+        bucket_stats_table.c.extension == bindparam('b_extension'),
+        bucket_stats_table.c.prefix.in_(bindparam('b_prefixes', expanding=True)),
+    )
+    .values(
+        object_count=bucket_stats_table.c.object_count + bindparam('d_count'),
+        total_bytes=bucket_stats_table.c.total_bytes + bindparam('d_bytes'),
+    )
+)
+_select_prefixes = (
+    sqlalchemy.select(bucket_stats_table.c.prefix)
+    .where(
+        bucket_stats_table.c.bucket_name == bindparam('b_bucket_name'),
+        bucket_stats_table.c.extension == bindparam('b_extension'),
+        bucket_stats_table.c.prefix.in_(bindparam('b_prefixes', expanding=True)),
+    )
+)
+_mark_dirty = (
+    bucket_stats_state_table.update()
+    .where(bucket_stats_state_table.c.bucket_name == bindparam('b_bucket_name'))
+    .values(dirty=True)
+)
+
+
+def get_stats(bucket_name: str, prefix: str = '', db: sqlalchemy.engine.base.Engine = None) -> dict:
+    """Return the object count, total bytes and per-extension breakdown of everything under a folder.
+
+    Returns None when the bucket has not been reconciled yet.
+    """
+    with (db or get_read_db()).connect() as conn:
+        state = conn.execute(_select_state, {'bucket_name': bucket_name}).fetchone()
+        if state is None:
+            return None
+        rows = conn.execute(_select_stats, {'bucket_name': bucket_name, 'prefix': prefix}).all()
+
+    extensions = {
+        extension: {'object_count': count, 'total_bytes': size}
+        for extension, count, size in sorted(rows) if count > 0
+    }
+    return {
+        'bucket_name': bucket_name,
+        'prefix': prefix,
+        'object_count': sum(item['object_count'] for item in extensions.values()),
+        'total_bytes': sum(item['total_bytes'] for item in extensions.values()),
+        'extensions': extensions,
+        'synced_at': state.synced_at.replace(tzinfo=datetime.timezone.utc).isoformat(),
+    }
+
+def ensure_fresh(bucket_name: str, owner: str = None) -> str:
+    """Queue a reconcile of a bucket never reconciled, stale or dirty. Returns the job id, or None."""
+    # Read through to the database: other processes may have marked the bucket dirty
+    _tracked.pop(bucket_name, None)
+    synced_at, dirty = _state(bucket_name)
+    if synced_at is not None and not dirty and time.monotonic() - synced_at <= reconcile_interval:
+        return None
+    return jobs.enqueue(
+        'reconcile_stats',
+        {'bucket_name': bucket_name},
+        owner=owner,
+        dedupe_key=f"reconcile_stats:{bucket_name}"
+    )
+
+def reconcile(bucket_name: str, api_key: dict) -> dict:
+    """Recompute the aggregates of a bucket from a full listing and replace the stored ones.
+
+    Deltas recorded while the listing runs may be lost or counted twice;
+    the next reconcile corrects them.
+    """
+    totals = collections.defaultdict(lambda: [0, 0])
+    client = get_client(api_key)
+    for blob in client.list_blobs(bucket_name, fields='items(name,size),nextPageToken'):
+        extension = extension_of(blob.name)
+        for prefix in _prefixes(blob.name):
+            total = totals[prefix, extension]
+            total[0] += 1
+            total[1] += int(blob.size or 0)
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    rows = [
+        {'bucket_name': bucket_name, 'prefix': prefix, 'extension': extension, 'object_count': count, 'total_bytes': size}
+        for (prefix, extension), (count, size) in totals.items()
+    ]
+    with get_db().connect() as conn:
+        conn.execute(bucket_stats_table.delete().where(bucket_stats_table.c.bucket_name == bucket_name))
+        if rows:
+            conn.execute(bucket_stats_table.insert(), rows)
+        updated = conn.execute(
+            bucket_stats_state_table.update()
+            .where(bucket_stats_state_table.c.bucket_name == bucket_name)
+            .values(synced_at=now, dirty=False)
+        ).rowcount
+        if not updated:
+            conn.execute(bucket_stats_state_table.insert().values(bucket_name=bucket_name, synced_at=now, dirty=False))
+        conn.commit()
+    _tracked[bucket_name] = (time.monotonic(), False)
+    objects = sum(count for (prefix, _), (count, _) in totals.items() if prefix == '')
+    logger.info("Stats of %s reconciled (%d objects, %d folders).", bucket_name, objects, len({prefix for prefix, _ in totals}))
+    return {'bucket_name': bucket_name, 'object_count': objects}
+
+def record_upload(bucket_name: str, name: str, size: int, replaced_size: int = None) -> None:
+    """Add an object the app just wrote to the aggregates of its folders, when its bucket is tracked.
+
+    `replaced_size` is the size of the object it overwrote, read from GCS
+    before the write (see tracks), or None for a new object.
+    """
+    if not tracks(bucket_name):
+        return
+    try:
+        if replaced_size is None:
+            _apply(bucket_name, name, 1, size)
+        else:
+            _apply(bucket_name, name, 0, size - replaced_size)
+    except Exception as e:
+        # The next reconcile counts the object
+        logger.exception(e)
+
+def record_delete(bucket_name: str, name: str, size: int) -> None:
+    """Remove an object the app just deleted, of the size GCS reported, from the aggregates of its folders, when its bucket is tracked.
+
+    Without a size only the count is updated, and the bucket is reconciled early.
+    """
+    if not tracks(bucket_name):
+        return
+    try:
+        _apply(bucket_name, name, -1, -(size or 0), dirty=size is None)
+    except Exception as e:
+        # The next reconcile drops the object
+        logger.exception(e)
+
+def tracks(bucket_name: str) -> bool:
+    """Whether writes to a bucket update its aggregates, so writers should read the size of the objects they replace."""
+    return enabled and is_tracked(bucket_name)
+
+def replaced_size(bucket_name: str, name: str, api_key: dict) -> int:
+    """Size of the object a write is about to replace, for record_upload: None when there is none or the bucket is not tracked."""
+    if not tracks(bucket_name):
+        return None
+    blob = get_client(api_key).bucket(bucket_name).get_blob(name)
+    return blob.size or 0 if blob is not None else None
+
+def is_tracked(bucket_name: str) -> bool:
+    return _state(bucket_name)[0] is not None
+
+def extension_of(name: str) -> str:
+    """The allowed extension of a file name, lowercased, or OTHER."""
+    base = name[name.rfind(DELIMITER) + 1:]
+    extension = base.rsplit('.', 1)[1].lower() if '.' in base else ''
+    return extension if extension in extensions else OTHER
+
+# Utils
+def _prefixes(name: str) -> list:
+    """The folders an object counts in: every ancestor, the root ("") included."""
+    prefixes = ['']
+    end = name.find(DELIMITER)
+    while end != -1:
+        prefixes.append(name[:end + 1])
+        end = name.find(DELIMITER, end + 1)
+    return prefixes
+
+def _apply(bucket_name: str, name: str, count: int, size: int, dirty: bool = False) -> None:
+    extension = extension_of(name)
+    prefixes = _prefixes(name)
+    params = {'b_bucket_name': bucket_name, 'b_extension': extension, 'b_prefixes': prefixes}
+    with get_db().connect() as conn:
+        # One statement for every ancestor folder, whatever the depth
+        updated = conn.execute(_add_delta, dict(params, d_count=count, d_bytes=size)).rowcount
+        missing = []
+        if updated < len(prefixes):
+            existing = set(conn.execute(_select_prefixes, params).scalars())
+            missing = [prefix for prefix in prefixes if prefix not in existing]
+        if missing and count > 0:
+            # First object of its extension in these folders
+            try:
+                conn.execute(bucket_stats_table.insert(), [
+                    {'bucket_name': bucket_name, 'prefix': prefix, 'extension': extension, 'object_count': count, 'total_bytes': size}
+                    for prefix in missing
+                ])
+            except sqlalchemy.exc.IntegrityError:
+                # A concurrent insert won: reconcile early to count this object
+                conn.rollback()
+                _mark_bucket_dirty(conn, bucket_name)
+                conn.commit()
+                return
+        if dirty or (missing and count <= 0):
+            _mark_bucket_dirty(conn, bucket_name)
+        conn.commit()
+
+def _mark_bucket_dirty(conn, bucket_name: str) -> None:
+    conn.execute(_mark_dirty, {'b_bucket_name': bucket_name})
+    _tracked.pop(bucket_name, None)
+
+def _state(bucket_name: str) -> tuple:
+    """The time.monotonic() of the last reconcile of a bucket (or None) and whether it is dirty."""
+    state = _tracked.get(bucket_name)
+    if state is not None:
+        return state
+    with get_db().connect() as conn:
+        row = conn.execute(_select_state, {'bucket_name': bucket_name}).fetchone()
+    if row is None:
+        return None, False
+    # Translate the persisted timestamp into this process' monotonic clock
+    age = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - row.synced_at
+    _tracked[bucket_name] = (time.monotonic() - age.total_seconds(), row.dirty)
+    return _tracked[bucket_name]
+
+
+# Module state, set by init_app
+enabled = True
+reconcile_interval = 24 * 3600
+extensions = frozenset()
+_tracked = {}  # bucket name -> (time.monotonic() of its last reconcile, dirty)
+
+@click.command('bucket-stats')
+@click.argument('username', required=False)
+@click.option('--bucket', 'bucket_name', help="Bucket name, instead of a username.")
+@click.option('--prefix', default='', help="Folder, e.g. photos/2024/.")
+@click.option('--reconcile', 'reconcile_first', is_flag=True, help="Recompute the aggregates from a full listing first.")
+@with_appcontext
+def bucket_stats_command(username: str, bucket_name: str, prefix: str, reconcile_first: bool):
+    """Show the object count, total bytes and extension breakdown of a user's bucket or folder."""
+    if bucket_name is None:
+        if username is None:
+            raise click.UsageError("Pass a USERNAME or --bucket.")
+        with get_read_db().connect() as conn:
+            bucket_name = accounts.find_bucket_name(conn, username)
+        if bucket_name is None:
+            raise click.ClickException(f"No bucket found for {username}.")
+    if prefix and not prefix.endswith(DELIMITER):
+        prefix += DELIMITER
+
+    if reconcile_first or not is_tracked(bucket_name):
+        reconcile(bucket_name, config.get_api_key())
+    result = get_stats(bucket_name, prefix, db=get_db())
+    click.echo(f"{bucket_name}/{prefix}: {result['object_count']} objects, {result['total_bytes']} bytes (as of {result['synced_at']})")
+    for extension, item in result['extensions'].items():
+        click.echo(f"  {extension}: {item['object_count']} objects, {item['total_bytes']} bytes")
+
+def init_app(app):
+    """Enable the aggregates and set their reconcile interval from the app config."""
+    global enabled, reconcile_interval, extensions
+    from storage_explorer.bucket.utils.operations import ALLOWED_EXTENSIONS
+
+    enabled = app.config.get("BUCKET_STATS_ENABLED", enabled)
+    reconcile_interval = app.config.get("BUCKET_STATS_RECONCILE_INTERVAL", reconcile_interval)
+    extensions = frozenset(ALLOWED_EXTENSIONS)
+    app.cli.add_command(bucket_stats_command)
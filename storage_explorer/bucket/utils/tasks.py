@@ -0,0 +1,143 @@
+import collections
+
+from google.api_core.exceptions import BadRequest, Conflict, Forbidden, NotFound, PreconditionFailed
+
+from storage_explorer import get_logger
+from storage_explorer.bucket.utils import directory_index, object_index, search, stats, transfers
+from storage_explorer.bucket.utils.operations import create_bucket, iter_files
+from storage_explorer.utils import config, jobs
+from storage_explorer.utils.storage_connector import get_client
+
+logger = get_logger()
+
+
+@jobs.handler('provision_bucket')
+def provision_bucket(bucket_name: str) -> dict:
+    """Create a user's bucket; an existing bucket counts as done if the app can reach it."""
+    api_key = config.get_api_key()
+    try:
+        create_bucket(bucket_name, api_key)
+    except Conflict:
+        # Bucket names are global: the name may belong to another project
+        try:
+            get_client(api_key).get_bucket(bucket_name)
+        except (Forbidden, NotFound) as e:
+            raise jobs.JobFailed(f"Bucket {bucket_name} exists but is not accessible: {e}") from e
+        return {'bucket_name': bucket_name, 'created': False}
+    except BadRequest as e:
+        # e.g. an invalid bucket name: retrying would not help
+        raise jobs.JobFailed(str(e)) from e
+    logger.info("Bucket %s created.", bucket_name)
+    return {'bucket_name': bucket_name, 'created': True}
+
+@jobs.handler('delete_objects')
+def delete_objects(bucket_name: str, names: list = (), prefixes: list = ()) -> dict:
+    """Delete objects by name and every object under some folders, on the transfer pool.
+
+    Objects already gone count as deleted, so a retried job picks up where
+    the failed attempt stopped.
+    """
+    api_key = config.get_api_key()
+    bucket = get_client(api_key).bucket(bucket_name)
+
+    def blobs():
+        for name in names:
+            yield bucket.blob(name)
+        for prefix in prefixes:
+            yield from iter_files(bucket_name, api_key=api_key, prefix=prefix)
+
+    def delete(blob):
+        name = blob.name
+        while True:
+            if blob.generation is None:
+                # Named by the caller: fetch the size the stats need
+                blob = bucket.get_blob(name)
+                if blob is None:
+                    break
+            try:
+                blob.delete(if_generation_match=blob.generation)
+            except NotFound:
+                break
+            except PreconditionFailed:
+                # Overwritten since it was read: delete the new content instead
+                blob = bucket.blob(name)
+            else:
+                stats.record_delete(bucket_name, name, blob.size)
+                break
+        directory_index.record_delete(bucket_name, name)
+        object_index.record_delete(bucket_name, name)
+        search.record_delete(bucket_name, name)
+
+    deleted = _run_bounded(delete, blobs())
+    return {'deleted': deleted}
+
+@jobs.handler('reconcile_stats')
+def reconcile_stats(bucket_name: str) -> dict:
+    """Recompute the usage aggregates of a bucket from a full listing."""
+    try:
+        return stats.reconcile(bucket_name, config.get_api_key())
+    except NotFound as e:
+        # Not provisioned yet: nothing to count
+        raise jobs.JobFailed(str(e)) from e
+
+@jobs.handler('copy_objects')
+def copy_objects(bucket_name: str, source: str, destination: str, move: bool = False) -> dict:
+    """Copy an object, or every object under a folder, within a bucket; with move, delete the sources after.
+
+    Copies are server-side rewrites, so no data goes through the app.
+    """
+    api_key = config.get_api_key()
+    bucket = get_client(api_key).bucket(bucket_name)
+
+    if source.endswith('/'):
+        pairs = ((blob, destination + blob.name[len(source):]) for blob in iter_files(bucket_name, api_key=api_key, prefix=source))
+    else:
+        blob = bucket.get_blob(source)
+        if blob is None:
+            raise jobs.JobFailed(f"{source} does not exist.")
+        pairs = [(blob, destination)]
+
+    def copy(pair):
+        blob, name = pair
+        replaced = stats.replaced_size(bucket_name, name, api_key=api_key)
+        target = bucket.blob(name)
+        token, _, _ = target.rewrite(blob, if_source_generation_match=blob.generation)
+        # Large objects take several rewrite calls
+        while token is not None:
+            token, _, _ = target.rewrite(blob, token=token, if_source_generation_match=blob.generation)
+        directory_index.record_upload(bucket_name, name, target.size or 0)
+        stats.record_upload(bucket_name, name, target.size or 0, replaced)
+        object_index.record_blob(bucket_name, target)
+        search.record_upload(bucket_name, name)
+        if move:
+            try:
+                blob.delete(if_generation_match=blob.generation)
+            except NotFound:
+                pass
+            except PreconditionFailed:
+                # Overwritten since the copy: leave the newer source in place
+                return
+            else:
+                stats.record_delete(bucket_name, blob.name, blob.size)
+            directory_index.record_delete(bucket_name, blob.name)
+            object_index.record_delete(bucket_name, blob.name)
+            search.record_delete(bucket_name, blob.name)
+
+    copied = _run_bounded(copy, pairs)
+    return {'copied': copied, 'moved': move}
+
+# Utils
+def _run_bounded(func, items) -> int:
+    """Run func over items on the transfer pool with a bounded number in flight; return the count."""
+    window = transfers.workers * 4
+    pending = collections.deque()
+    done = 0
+    for item in items:
+        if len(pending) >= window:
+            pending.popleft().result()
+            done += 1
+        pending.append(transfers.executor.submit(func, item))
+    while pending:
+        pending.popleft().result()
+        done += 1
+    return done
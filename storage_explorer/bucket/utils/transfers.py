@@ -0,0 +1,129 @@
+import collections, zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from storage_explorer import get_logger
+from storage_explorer.bucket.utils.operations import upload_file, iter_files, read_range
+
+logger = get_logger()
+
+DEFAULT_WORKERS = 8
+# Archives fetch objects in ranges of this size, with at most ARCHIVE_WINDOW
+# ranges in flight (or buffered) per archive.
+ARCHIVE_RANGE_SIZE = 8 * 1024 * 1024
+ARCHIVE_WINDOW = 8
+
+# Bounded pool shared by every request that transfers several objects at once.
+workers = DEFAULT_WORKERS
+executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transfer")
+
+def upload_many(bucket_name: str, files: list, api_key: dict):
+    """Upload (filename, file object) pairs concurrently on the transfer pool.
+
+    Yields one result dict per file, with ``filename``, ``ok`` and either
+    ``outcome`` (see upload_file) or ``error``, in completion order.
+    """
+    futures = {
+        executor.submit(upload_file, bucket_name, filename=filename, file=file, api_key=api_key): filename
+        for filename, file in files
+    }
+    for future in as_completed(futures):
+        filename = futures[future]
+        try:
+            outcome = future.result()
+        except Exception as e:
+            logger.exception(e)
+            yield {'filename': filename, 'ok': False, 'error': "Upload failed."}
+        else:
+            yield {'filename': filename, 'ok': True, 'outcome': outcome}
+
+class _StreamBuffer:
+    """Write-only, unseekable file object collecting what zipfile writes until it is drained."""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._offset
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def archive_stream(bucket_name: str, prefix: str, api_key: dict, range_size: int = ARCHIVE_RANGE_SIZE, window: int = ARCHIVE_WINDOW):
+    """Yield a ZIP archive of every object under prefix while it is being built.
+
+    Objects are fetched in byte ranges on the transfer pool, ahead of the
+    writer by at most ``window`` ranges, so memory stays bounded by
+    ``window * range_size`` whatever the size of the folder. Entries are
+    stored uncompressed and use zip64 when needed.
+    """
+    def ranges():
+        for blob in iter_files(bucket_name, api_key=api_key, prefix=prefix):
+            if blob.name.endswith('/'):
+                continue
+            size = blob.size or 0
+            yield blob, 0, size == 0 or range_size >= size
+            for start in range(range_size, size, range_size):
+                yield blob, start, start + range_size >= size
+
+    def fetch(blob, start):
+        if not blob.size:
+            return b''
+        return read_range(blob, start, min(start + range_size, blob.size) - 1)
+
+    buffer = _StreamBuffer()
+    pending = collections.deque()
+    parts = ranges()
+    try:
+        with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_STORED) as archive:
+            entry = None
+            while True:
+                # Keep the fetch pool busy, but never more than `window` ranges ahead
+                for blob, start, last in parts:
+                    pending.append((blob, start, last, executor.submit(fetch, blob, start)))
+                    if len(pending) >= window:
+                        break
+                if not pending:
+                    break
+
+                blob, start, last, future = pending.popleft()
+                if start == 0:
+                    info = zipfile.ZipInfo(blob.name[len(prefix):], date_time=_zip_date_time(blob))
+                    info.file_size = blob.size or 0
+                    entry = archive.open(info, mode='w')
+                entry.write(future.result())
+                if last:
+                    entry.close()
+                data = buffer.drain()
+                if data:
+                    yield data
+        yield buffer.drain()
+    finally:
+        for *_, future in pending:
+            future.cancel()
+
+def _zip_date_time(blob) -> tuple:
+    updated = blob.updated
+    if updated is None or updated.year < 1980:
+        return (1980, 1, 1, 0, 0, 0)
+    return updated.timetuple()[:6]
+
+def init_app(app):
+    """Size the transfer pool from the app config."""
+    global executor, workers
+    size = app.config.get("TRANSFER_WORKERS", DEFAULT_WORKERS)
+    if size != workers:
+        executor.shutdown(wait=False)
+        workers = size
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transfer")
@@ -1,21 +1,15 @@
 from __future__ import annotations
-import os, uuid, click, logging, datetime
+import os, csv, json, click, logging, datetime, tempfile, threading
 
 from flask import (
-    Blueprint
+    Blueprint, current_app
 )
+from flask.cli import with_appcontext
 
 import sqlalchemy
-from sqlalchemy import Column
-from sqlalchemy import DateTime
-from sqlalchemy import Integer
-from sqlalchemy import String
-from sqlalchemy import MetaData
-from sqlalchemy.sql import func
 
-from sqlalchemy import Table
-
-from storage_explorer.utils.db_connector import connect_with_connector, connect_tcp_socket
+from storage_explorer.utils import accounts
+from storage_explorer.utils.db_connector import check_liveness, connect_with_connector, connect_tcp_socket, connect_url
 
 # create a Flask blueprint for database operations
 db_bp = Blueprint('db', __name__)
@@ -25,60 +19,177 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 def init_connection_pool() -> sqlalchemy.engine.base.Engine:
+    # use a SQLAlchemy URL when DATABASE_URL (e.g. sqlite:///local.db) is defined
+    if os.environ.get("DATABASE_URL"):
+        return _with_liveness_check(connect_url(**pool_options))
+
     # use a TCP socket when INSTANCE_HOST (e.g. 127.0.0.1) is defined
     if os.environ.get("INSTANCE_HOST"):
-        return connect_tcp_socket()
+        return _with_liveness_check(connect_tcp_socket(**pool_options))
 
     # use the connector when INSTANCE_CONNECTION_NAME (e.g. project:region:instance) is defined
     if os.environ.get("INSTANCE_CONNECTION_NAME"):
-        return connect_with_connector()
+        return _with_liveness_check(connect_with_connector(**pool_options))
 
     raise ValueError(
-        "Missing database connection type. Please define one of INSTANCE_HOST or INSTANCE_CONNECTION_NAME"
+        "Missing database connection type. Please define one of DATABASE_URL, INSTANCE_HOST or INSTANCE_CONNECTION_NAME"
     )
 
-# create 'users' table in database if it does not already exist
+def init_read_pool() -> sqlalchemy.engine.base.Engine:
+    """Connection pool of the read replica, with the primary's credentials, or None without one."""
+    options = dict(pool_options, **read_pool_options)
+    if os.environ.get("DATABASE_READ_URL"):
+        return _with_liveness_check(connect_url(os.environ["DATABASE_READ_URL"], **options))
+    if os.environ.get("INSTANCE_READ_HOST"):
+        return _with_liveness_check(connect_tcp_socket(os.environ["INSTANCE_READ_HOST"], **options))
+    if os.environ.get("INSTANCE_READ_CONNECTION_NAME"):
+        return _with_liveness_check(connect_with_connector(os.environ["INSTANCE_READ_CONNECTION_NAME"], **options))
+    return None
+
+def _with_liveness_check(engine: sqlalchemy.engine.base.Engine) -> sqlalchemy.engine.base.Engine:
+    if ping_idle >= 0:
+        check_liveness(engine, ping_idle)
+    return engine
+
+# create the app tables in database if they do not already exist
 def migrate_db(db: sqlalchemy.engine.base.Engine) -> None:
     inspector = sqlalchemy.inspect(db)
-    if not inspector.has_table("users"):
-        metadata = MetaData()
-        Table(
-            "users",
-            metadata,
-            Column("user_id", Integer, primary_key=True, nullable=False),
-            Column("username", String(100), nullable=False),
-            Column("name", String(100), nullable=False),
-            Column("password", String(255), nullable=False),
-            Column("gcp_bucket_name", String(255), nullable=False),
-            Column("created_at", DateTime, default=func.now(), nullable=False)
-        )
-        metadata.create_all(db)
-    if not inspector.has_table("invite_tokens"):
-        metadata = MetaData()
-        Table(
-            "invite_tokens",
-            metadata,
-            Column("invite_token_id", String(255), primary_key=True, nullable=False),
-            Column("created_at", DateTime, default=func.now(), nullable=False)
-        )
-        metadata.create_all(db)
-
-# This global variable is declared with a value of `None`, instead of calling
-# `init_db()` immediately, to simplify testing. In general, it
-# is safe to initialize your database connection pool when your script starts
-# -- there is no need to wait for the first request.
+    if not inspector.has_table("users") or not inspector.has_table("invite_tokens"):
+        accounts.metadata.create_all(db)
+    # tables created before their indexes existed get them here
+    inspector = sqlalchemy.inspect(db)
+    _index_usernames(db, inspector)
+    if accounts.invite_token_created_index.name not in {index['name'] for index in inspector.get_indexes("invite_tokens")}:
+        _create_index(db, accounts.invite_token_created_index, "invite_tokens")
+    if not inspector.has_table("objects") or not inspector.has_table("object_index_state"):
+        # tables of the bucket object-metadata index
+        from storage_explorer.bucket.utils import object_index
+        object_index.metadata.create_all(db)
+        inspector = sqlalchemy.inspect(db)
+    _add_object_hashes(db, inspector)
+    _add_object_folders(db, inspector)
+    if not inspector.has_table("bucket_stats") or not inspector.has_table("bucket_stats_state"):
+        # tables of the bucket usage aggregates
+        from storage_explorer.bucket.utils import stats
+        stats.metadata.create_all(db)
+    if not inspector.has_table("jobs"):
+        # table of the background job queue
+        from storage_explorer.utils import jobs
+        jobs.metadata.create_all(db)
+
+def _add_object_hashes(db: sqlalchemy.engine.base.Engine, inspector) -> None:
+    """Add the md5_hash column and its index to an objects table created before they existed."""
+    from storage_explorer.bucket.utils import object_index
+
+    if "md5_hash" not in {column['name'] for column in inspector.get_columns("objects")}:
+        try:
+            with db.connect() as conn:
+                conn.execute(sqlalchemy.text("ALTER TABLE objects ADD md5_hash VARCHAR(24) NULL"))
+                conn.commit()
+            logger.info("Added column objects.md5_hash.")
+        except sqlalchemy.exc.DBAPIError:
+            # Another process starting at the same time may have added it first
+            if "md5_hash" not in {column['name'] for column in sqlalchemy.inspect(db).get_columns("objects")}:
+                raise
+    if object_index.md5_hash_index.name not in {index['name'] for index in inspector.get_indexes("objects")}:
+        _create_index(db, object_index.md5_hash_index, "objects")
+
+def _add_object_folders(db: sqlalchemy.engine.base.Engine, inspector) -> None:
+    """Add the revision columns and the folder counts to an object index created before they existed."""
+    from storage_explorer.bucket.utils import object_index
+
+    columns = {column['name'] for column in inspector.get_columns("object_index_state")}
+    for name, ddl in (("revision", "BIGINT NOT NULL DEFAULT 0"), ("changed_at", "DATETIME NULL")):
+        if name in columns:
+            continue
+        try:
+            with db.connect() as conn:
+                conn.execute(sqlalchemy.text(f"ALTER TABLE object_index_state ADD {name} {ddl}"))
+                conn.commit()
+            logger.info("Added column object_index_state.%s.", name)
+        except sqlalchemy.exc.DBAPIError:
+            # Another process starting at the same time may have added it first
+            if name not in {column['name'] for column in sqlalchemy.inspect(db).get_columns("object_index_state")}:
+                raise
+    if inspector.has_table("object_folders"):
+        return
+    try:
+        object_index.object_folders_table.create(db)
+    except sqlalchemy.exc.DBAPIError:
+        if not sqlalchemy.inspect(db).has_table("object_folders"):
+            raise
+        return
+    logger.info("Added table object_folders.")
+    # Count the folders of the buckets indexed so far
+    with db.connect() as conn:
+        for (bucket_name,) in conn.execute(sqlalchemy.select(object_index.object_index_state_table.c.bucket_name)).all():
+            object_index.rebuild_folders(conn, bucket_name)
+        conn.commit()
+
+def _index_usernames(db: sqlalchemy.engine.base.Engine, inspector) -> None:
+    """Add the unique username index to a users table created before it existed."""
+    existing = {index['name'] for index in inspector.get_indexes("users")}
+    if accounts.username_index.name in existing or "ix_users_username" in existing:
+        return
+    try:
+        accounts.username_index.create(db)
+        logger.info("Added index %s.", accounts.username_index.name)
+    except sqlalchemy.exc.DBAPIError as e:
+        existing = _index_names(db, "users")
+        if accounts.username_index.name in existing or "ix_users_username" in existing:
+            # Another process starting at the same time indexed them first
+            return
+        # Duplicate usernames from before the constraint: index them without it
+        logger.warning("Could not add a unique index on users.username, adding a plain one: %s", e)
+        try:
+            with db.connect() as conn:
+                conn.execute(sqlalchemy.text("CREATE INDEX ix_users_username ON users (username)"))
+                conn.commit()
+        except sqlalchemy.exc.DBAPIError:
+            if "ix_users_username" not in _index_names(db, "users"):
+                raise
+
+def _create_index(db: sqlalchemy.engine.base.Engine, index: sqlalchemy.Index, table: str) -> None:
+    """Create a missing index; one another process created concurrently counts as created."""
+    try:
+        index.create(db)
+    except sqlalchemy.exc.DBAPIError:
+        if index.name not in _index_names(db, table):
+            raise
+        return
+    logger.info("Added index %s.", index.name)
+
+def _index_names(db: sqlalchemy.engine.base.Engine, table: str) -> set:
+    # A fresh inspector: the caller's caches what it saw before the race
+    return {index['name'] for index in sqlalchemy.inspect(db).get_indexes(table)}
+
+# The pool is created once per process: by the startup warm-up of the app
+# factory (see storage_explorer.utils.health), or else on first use.
 db = None
+# Optional read replica serving read-only lookups, None without one.
+read_db = None
+_db_lock = threading.Lock()
+
+# Pool settings, set by init_app from the app config.
+pool_options = {}
+read_pool_options = {}
+# Connections idle longer than this are pinged on checkout; 0 pings every
+# checkout and a negative value disables the check.
+ping_idle = 30.0
 
-# init_db lazily instantiates a database connection pool. Users of Cloud Run or
-# App Engine may wish to skip this lazy instantiation and connect as soon
-# as the function is loaded. This is primarily to help testing.
 def init_db() -> None:
-    """Initialize the database connection pool if it is not already initialized."""
-    logger.info("Initializing database connection pool...")
-    global db
-    if db is None:
-        db = init_connection_pool()
-        migrate_db(db)
+    """Initialize the database connection pools and migrate the schema, once per process."""
+    global db, read_db
+    if db is not None:
+        return
+    with _db_lock:
+        if db is None:
+            logger.info("Initializing database connection pool...")
+            engine = init_connection_pool()
+            migrate_db(engine)
+            read_db = init_read_pool()
+            db = engine
+            logger.info("Database connection pool initialized%s.", " with a read replica" if read_db is not None else "")
 
 def get_db() -> sqlalchemy.engine.base.Engine:
     """Get the database connection pool."""
@@ -86,23 +197,71 @@ def get_db() -> sqlalchemy.engine.base.Engine:
         init_db()
     return db
 
+def get_read_db() -> sqlalchemy.engine.base.Engine:
+    """Get the pool for read-only queries that tolerate replication lag: the replica's if any, else the primary's."""
+    if db is None:
+        init_db()
+    return read_db if read_db is not None else db
+
+def engines() -> dict:
+    """The initialized pools by role, for metrics."""
+    return {name: engine for name, engine in (('primary', db), ('replica', read_db)) if engine is not None}
+
 @click.command('generate-token')
-@click.argument('quantity', type=int, default=1)
-def generate_token_command(quantity: int):
-    """Generate a new invite token."""
+@click.argument('quantity', type=click.IntRange(min=1), default=1)
+@click.option('--format', 'output_format', type=click.Choice(['text', 'csv', 'json']), default='text', help="Output format.")
+@click.option('--output', type=click.Path(dir_okay=False, writable=True), help="Write the tokens to this file instead of stdout.")
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000, show_default=True, help="Tokens per executemany.")
+def generate_token_command(quantity: int, output_format: str, output: str, batch_size: int):
+    """Generate invite tokens, all in one transaction."""
     init_db()
     db = get_db()
 
-    with db.connect() as connection:
-        for _ in range(quantity):
-            invite_token = uuid.uuid4().hex
-            connection.execute(
-                sqlalchemy.text("INSERT INTO invite_tokens (invite_token_id, created_at) VALUES (:invite_token, :created_at)"),
-                {"invite_token": invite_token, "created_at": datetime.datetime.now(datetime.timezone.utc)}
-            )
+    # Tokens are spooled while inserting and only written out once committed
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    with tempfile.TemporaryFile('w+', newline='') as spool:
+        with db.connect() as connection:
+            for start in range(0, quantity, batch_size):
+                invite_tokens = accounts.new_invite_token_ids(min(batch_size, quantity - start))
+                accounts.add_invite_tokens(connection, invite_tokens, created_at)
+                spool.writelines(f"{invite_token}\n" for invite_token in invite_tokens)
             connection.commit()
-            click.echo(f"Generated invite token: {invite_token}")
-    
+
+        spool.seek(0)
+        with click.open_file(output or '-', 'w') as out:
+            _write_tokens(out, (line.rstrip('\n') for line in spool), output_format, created_at)
+    if output:
+        click.echo(f"Generated {quantity} invite tokens in {output}.", err=True)
+
+def _write_tokens(out, invite_tokens, output_format: str, created_at: datetime.datetime) -> None:
+    if output_format == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(('invite_token_id', 'created_at'))
+        created = created_at.isoformat()
+        for invite_token in invite_tokens:
+            writer.writerow((invite_token, created))
+    elif output_format == 'json':
+        # A JSON array, written one item at a time
+        created = created_at.isoformat()
+        out.write('[')
+        for i, invite_token in enumerate(invite_tokens):
+            out.write(('\n' if i == 0 else ',\n') + json.dumps({'invite_token_id': invite_token, 'created_at': created}))
+        out.write('\n]\n')
+    else:
+        for invite_token in invite_tokens:
+            out.write(f"Generated invite token: {invite_token}\n")
+
+@click.command('expire-tokens')
+@click.option('--older-than', type=int, help="Age in seconds; defaults to INVITE_TOKEN_TTL.")
+@click.option('--batch-size', type=click.IntRange(min=1), default=1000, show_default=True, help="Tokens deleted per transaction.")
+@with_appcontext
+def expire_tokens_command(older_than: int, batch_size: int):
+    """Delete invite tokens older than the token lifetime."""
+    ttl = older_than if older_than is not None else current_app.config.get("INVITE_TOKEN_TTL")
+    if not ttl:
+        raise click.UsageError("Invite tokens do not expire: set INVITE_TOKEN_TTL or pass --older-than.")
+    deleted = accounts.delete_expired_invite_tokens(get_db(), ttl, batch_size)
+    click.echo(f"Deleted {deleted} expired invite tokens.")
 
 @click.command('init-db')
 def init_db_command():
@@ -110,12 +269,43 @@ def init_db_command():
     init_db()
     click.echo('Initialized the database.')
 
+def pool_sizing(config) -> dict:
+    """Pool options from the app config; the size defaults to the threads of this process that can query at once."""
+    if config.get("SERVER_MODE") == "async":
+        threads = config.get("ASGI_WORKER_THREADS", 128)
+    else:
+        threads = config.get("WEB_THREADS", 2)
+    # Transfers record into the indexes and stats from their own pool
+    threads += config.get("TRANSFER_WORKERS", 0)
+    if config.get("JOBS_IN_PROCESS", True):
+        threads += config.get("JOB_WORKERS", 0)
+    pool_size = config.get("DB_POOL_SIZE") or threads
+    max_overflow = config.get("DB_MAX_OVERFLOW")
+    if max_overflow is None:
+        max_overflow = max(2, pool_size // 2)
+
+    # Keep every worker process of an instance within its share of the server's connections
+    max_connections = config.get("DB_MAX_CONNECTIONS")
+    if max_connections:
+        per_process = max(1, max_connections // max(1, config.get("WEB_CONCURRENCY", 1)))
+        pool_size = min(pool_size, per_process)
+        max_overflow = min(max_overflow, per_process - pool_size)
+
+    return {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': config.get("DB_POOL_TIMEOUT", 10),
+        'pool_recycle': config.get("DB_POOL_RECYCLE", 1800),
+        'pool_use_lifo': config.get("DB_POOL_LIFO", True),
+    }
+
 def init_app(app):
+    """Size the connection pools from the app config."""
+    global pool_options, read_pool_options, ping_idle
+    pool_options = pool_sizing(app.config)
+    read_pool_options = {'pool_size': app.config["DB_READ_POOL_SIZE"]} if app.config.get("DB_READ_POOL_SIZE") else {}
+    ping_idle = app.config.get("DB_PING_IDLE", ping_idle)
+
     app.cli.add_command(init_db_command)
     app.cli.add_command(generate_token_command)
-
-    @app.before_request
-    def run_init_db():
-        """Initialize the database connection pool."""
-        init_db()
-        logger.info("Database connection pool initialized.")
\ No newline at end of file
+    app.cli.add_command(expire_tokens_command)
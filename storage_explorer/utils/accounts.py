@@ -0,0 +1,154 @@
+import datetime, os
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, bindparam, func, select
+
+metadata = MetaData()
+
+users_table = Table(
+    "users",
+    metadata,
+    Column("user_id", Integer, primary_key=True, nullable=False),
+    Column("username", String(100), nullable=False),
+    Column("name", String(100), nullable=False),
+    Column("password", String(255), nullable=False),
+    Column("gcp_bucket_name", String(255), nullable=False),
+    Column("created_at", DateTime, default=func.now(), nullable=False),
+)
+# Every lookup is by username: a unique index makes it a seek and enforces
+# that two registrations cannot race to the same name.
+username_index = Index("ux_users_username", users_table.c.username, unique=True)
+
+invite_tokens_table = Table(
+    "invite_tokens",
+    metadata,
+    Column("invite_token_id", String(255), primary_key=True, nullable=False),
+    Column("created_at", DateTime, default=func.now(), nullable=False),
+)
+# Lets the expiry sweep find old tokens without scanning the table.
+invite_token_created_index = Index("ix_invite_tokens_created_at", invite_tokens_table.c.created_at)
+
+# Hex characters of an invite token id.
+INVITE_TOKEN_LENGTH = 32
+
+
+class User:
+    """A users row; password is the hash, and None unless asked for."""
+
+    __slots__ = ('user_id', 'username', 'name', 'gcp_bucket_name', 'password')
+
+    def __init__(self, user_id: int, username: str, name: str, gcp_bucket_name: str, password: str = None):
+        self.user_id = user_id
+        self.username = username
+        self.name = name
+        self.gcp_bucket_name = gcp_bucket_name
+        self.password = password
+
+    def without_password(self) -> 'User':
+        return User(self.user_id, self.username, self.name, self.gcp_bucket_name)
+
+    def as_dict(self) -> dict:
+        return {'user_id': self.user_id, 'username': self.username, 'name': self.name, 'gcp_bucket_name': self.gcp_bucket_name}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'User':
+        return cls(data['user_id'], data['username'], data['name'], data['gcp_bucket_name'])
+
+
+class InviteToken:
+    """An invite_tokens row."""
+
+    __slots__ = ('invite_token_id', 'created_at')
+
+    def __init__(self, invite_token_id: str, created_at: datetime.datetime):
+        self.invite_token_id = invite_token_id
+        self.created_at = created_at
+
+
+# Statements built once at import: each execution is a hit in the engine's
+# compiled cache instead of a new text() construct to parse and compile.
+_user_columns = (users_table.c.user_id, users_table.c.username, users_table.c.name, users_table.c.gcp_bucket_name)
+_select_user = select(*_user_columns).where(users_table.c.username == bindparam('username'))
+_select_user_with_password = select(*_user_columns, users_table.c.password).where(users_table.c.username == bindparam('username'))
+_select_bucket_name = select(users_table.c.gcp_bucket_name).where(users_table.c.username == bindparam('username'))
+_insert_user = users_table.insert()
+_update_password = users_table.update().where(users_table.c.username == bindparam('b_username')).values(password=bindparam('new_password'))
+_select_invite_token = (
+    select(invite_tokens_table.c.invite_token_id, invite_tokens_table.c.created_at)
+    .where(
+        invite_tokens_table.c.invite_token_id == bindparam('invite_token_id'),
+        invite_tokens_table.c.created_at >= bindparam('not_before'),
+    )
+)
+_select_expired_invite_tokens = (
+    select(invite_tokens_table.c.invite_token_id)
+    .where(invite_tokens_table.c.created_at < bindparam('cutoff'))
+    .order_by(invite_tokens_table.c.created_at)
+    .limit(bindparam('batch_size', type_=Integer, literal_execute=True))
+)
+_insert_invite_token = invite_tokens_table.insert()
+_delete_invite_token = invite_tokens_table.delete().where(invite_tokens_table.c.invite_token_id == bindparam('invite_token_id'))
+
+
+def find_user(conn, username: str, with_password: bool = False) -> User:
+    """Return the user with this username, or None."""
+    row = conn.execute(_select_user_with_password if with_password else _select_user, {'username': username}).fetchone()
+    return User(*row) if row is not None else None
+
+def find_bucket_name(conn, username: str) -> str:
+    """Return the GCP bucket name of a user, or None."""
+    return conn.execute(_select_bucket_name, {'username': username}).scalar()
+
+def add_user(conn, username: str, name: str, password: str, gcp_bucket_name: str) -> None:
+    """Insert a user; password is the hash. The caller commits."""
+    conn.execute(_insert_user, {
+        'username': username,
+        'name': name,
+        'password': password,
+        'gcp_bucket_name': gcp_bucket_name,
+        'created_at': _now(),
+    })
+
+def update_password(conn, username: str, password: str) -> None:
+    """Replace a user's password hash. The caller commits."""
+    conn.execute(_update_password, {'b_username': username, 'new_password': password})
+
+def find_invite_token(conn, invite_token_id: str, ttl: int = None) -> InviteToken:
+    """Return the invite token with this id, or None; with a ttl in seconds, also None once it is older."""
+    not_before = _now() - datetime.timedelta(seconds=ttl) if ttl else datetime.datetime.min
+    row = conn.execute(_select_invite_token, {'invite_token_id': invite_token_id, 'not_before': not_before}).fetchone()
+    return InviteToken(*row) if row is not None else None
+
+def new_invite_token_ids(count: int) -> list:
+    """Generate count random token ids from a single read of the OS random source."""
+    data = os.urandom(count * INVITE_TOKEN_LENGTH // 2).hex()
+    return [data[i:i + INVITE_TOKEN_LENGTH] for i in range(0, len(data), INVITE_TOKEN_LENGTH)]
+
+def add_invite_tokens(conn, invite_token_ids: list, created_at: datetime.datetime = None) -> None:
+    """Insert invite tokens in one executemany, batched by insertmanyvalues. The caller commits."""
+    created_at = created_at or _now()
+    conn.execute(_insert_invite_token, [
+        {'invite_token_id': invite_token_id, 'created_at': created_at}
+        for invite_token_id in invite_token_ids
+    ])
+
+def delete_invite_token(conn, invite_token_id: str) -> bool:
+    """Delete an invite token; returns whether it existed. The caller commits."""
+    return conn.execute(_delete_invite_token, {'invite_token_id': invite_token_id}).rowcount > 0
+
+def delete_expired_invite_tokens(db, ttl: int, batch_size: int = 1000) -> int:
+    """Delete the invite tokens older than ttl seconds, batch_size per transaction; returns how many."""
+    cutoff = _now() - datetime.timedelta(seconds=ttl)
+    deleted = 0
+    while True:
+        # Short transactions keep locks on the table brief while registrations go on
+        with db.connect() as conn:
+            ids = conn.execute(_select_expired_invite_tokens, {'cutoff': cutoff, 'batch_size': batch_size}).scalars().all()
+            if not ids:
+                return deleted
+            conn.execute(invite_tokens_table.delete().where(invite_tokens_table.c.invite_token_id.in_(ids)))
+            conn.commit()
+        deleted += len(ids)
+
+# Utils
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
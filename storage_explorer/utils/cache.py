@@ -0,0 +1,219 @@
+import json, threading, time
+from collections import OrderedDict
+
+from storage_explorer import get_logger
+from storage_explorer.utils.accounts import User
+
+logger = get_logger()
+
+
+class LocalSharedStore:
+    """In-process stand-in for a shared key/value store such as Redis.
+
+    Implements the small subset of the redis-py API used by TTLCache and the
+    session store (``get``, ``set`` with ``ex``, ``delete``, ``exists``,
+    ``expire``, and the set commands ``sadd``, ``srem`` and ``smembers``), so
+    a real client can be dropped in to share entries across gunicorn workers.
+    Expired keys are dropped when read and swept every `purge_interval` seconds.
+    """
+
+    def __init__(self, purge_interval: float = 60):
+        self._data = {}
+        self._lock = threading.Lock()
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._live(key)
+            return item[0] if item is not None else None
+
+    def set(self, key: str, value, ex: int = None) -> None:
+        now = time.monotonic()
+        expires_at = now + ex if ex else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            if now >= self._next_purge:
+                # Keys written once and never read again would stay forever otherwise
+                self._data = {key: item for key, item in self._data.items() if item[1] is None or item[1] > now}
+                self._next_purge = now + self.purge_interval
+
+    def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def exists(self, *keys: str) -> int:
+        with self._lock:
+            return sum(self._live(key) is not None for key in keys)
+
+    def expire(self, key: str, seconds: int) -> bool:
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                return False
+            self._data[key] = (item[0], time.monotonic() + seconds)
+            return True
+
+    def sadd(self, key: str, *members) -> None:
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                item = self._data[key] = (set(), None)
+            item[0].update(members)
+
+    def srem(self, key: str, *members) -> None:
+        with self._lock:
+            item = self._live(key)
+            if item is not None:
+                item[0].difference_update(members)
+                if not item[0]:
+                    del self._data[key]
+
+    def smembers(self, key: str) -> set:
+        with self._lock:
+            item = self._live(key)
+            return set(item[0]) if item is not None else set()
+
+    def _live(self, key: str) -> tuple:
+        """The (value, expires_at) of a key, None once it expired; the caller holds the lock."""
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return item
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ``ttl`` seconds.
+
+    When a shared store is configured, misses fall through to it before the
+    caller hits the database, and writes are mirrored to it as JSON, through
+    `encode` and `decode` for values that are not plain JSON.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300, shared=None, encode=None, decode=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.encode = encode
+        self.decode = decode
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, maxsize: int = None, ttl: float = None, shared=None) -> None:
+        """Update sizing and shared store, dropping current entries."""
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self.shared = shared
+            self._data.clear()
+
+    def get(self, key: str):
+        """Return the cached value for key, or None on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None:
+                value, expires_at = item
+                if expires_at > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+
+        value = self._get_shared(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, value, now)
+        return value
+
+    def set(self, key: str, value) -> None:
+        """Cache value under key, evicting the least recently used entry when full."""
+        with self._lock:
+            self._store(key, value, time.monotonic())
+        if self.shared is not None:
+            try:
+                self.shared.set(self._shared_key(key), json.dumps(self.encode(value) if self.encode else value), ex=int(self.ttl))
+            except Exception as e:
+                logger.exception(e)
+
+    def invalidate(self, key: str) -> None:
+        """Drop key locally and from the shared store."""
+        with self._lock:
+            self._data.pop(key, None)
+        if self.shared is not None:
+            try:
+                self.shared.delete(self._shared_key(key))
+            except Exception as e:
+                logger.exception(e)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """Return size and hit-rate counters."""
+        lookups = self.hits + self.misses
+        return {
+            'name': self.name,
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    # Internals
+    def _store(self, key, value, now) -> None:
+        self._data[key] = (value, now + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def _shared_key(self, key: str) -> str:
+        return f"{self.name}:{key}"
+
+    def _get_shared(self, key: str):
+        if self.shared is None:
+            return None
+        try:
+            raw = self.shared.get(self._shared_key(key))
+        except Exception as e:
+            logger.exception(e)
+            return None
+        if raw is None:
+            return None
+        value = json.loads(raw)
+        return self.decode(value) if self.decode else value
+
+
+# User records keyed by username (never including the password hash).
+user_cache = TTLCache("user", encode=User.as_dict, decode=User.from_dict)
+# GCP bucket names keyed by username.
+bucket_name_cache = TTLCache("bucket_name")
+
+def invalidate_user(username: str) -> None:
+    """Drop every cached entry derived from the given user."""
+    user_cache.invalidate(username)
+    bucket_name_cache.invalidate(username)
+
+def stats() -> list:
+    return [user_cache.stats(), bucket_name_cache.stats()]
+
+def init_app(app):
+    """Configure the user caches from the app config."""
+    shared = app.config.get("USER_CACHE_SHARED_STORE")
+    for cache in (user_cache, bucket_name_cache):
+        cache.configure(
+            maxsize=app.config.get("USER_CACHE_SIZE"),
+            ttl=app.config.get("USER_CACHE_TTL"),
+            shared=shared,
+        )
@@ -1,14 +1,19 @@
-import os, json
+import os, json, functools
 
 def get_api_key()-> dict:
     """Retrieve the API key from environment variables."""
     api_key_str = os.environ.get("API_KEY")
     if not api_key_str:
         raise ValueError("Google Cloud API key not found in environment variables.")
-    
+
+    return _parse_api_key(api_key_str)
+
+@functools.lru_cache(maxsize=4)
+def _parse_api_key(api_key_str: str) -> dict:
+    """Parse the API key JSON once per distinct value."""
     try:
         api_key = json.loads(api_key_str)
     except json.JSONDecodeError as e:
         raise ValueError("Invalid JSON format for Google Cloud API key.") from e
-    
-    return api_key
\ No newline at end of file
+
+    return api_key
@@ -1,23 +1,45 @@
-import os
-
-from google.cloud.sql.connector import Connector, IPTypes
-import pytds
+import os, time
 
 import sqlalchemy
-
-
-def connect_with_connector() -> sqlalchemy.engine.base.Engine:
+from sqlalchemy import event
+
+from storage_explorer.utils.metrics import TimedQueuePool, db_pool_invalidations
+
+# Pool settings used when the app config does not provide them.
+DEFAULT_POOL_OPTIONS = {
+    # Pool size is the maximum number of permanent connections to keep.
+    'pool_size': 5,
+    # Temporarily exceeds the set pool_size if no connections are available.
+    'max_overflow': 2,
+    # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
+    # new connection from the pool. After the specified amount of time, an
+    # exception will be thrown.
+    'pool_timeout': 10,
+    # 'pool_recycle' is the maximum number of seconds a connection can persist.
+    # Connections that live longer than the specified amount of time will be
+    # re-established
+    'pool_recycle': 1800,  # 30 minutes
+    # Hand out the most recently used connection first, so the ones above the
+    # steady load stay idle and are recycled instead of kept warm.
+    'pool_use_lifo': True,
+}
+
+
+def connect_with_connector(instance_connection_name: str = None, **pool_options) -> sqlalchemy.engine.base.Engine:
     """
     Initializes a connection pool for a Cloud SQL instance of SQL Server.
 
-    Uses the Cloud SQL Python Connector package.
+    Uses the Cloud SQL Python Connector package, imported here: it is the
+    slowest import of the app and only this connection mode needs it.
     """
+    from google.cloud.sql.connector import Connector, IPTypes
+
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
 
-    instance_connection_name = os.environ[
+    instance_connection_name = instance_connection_name or os.environ[
         "INSTANCE_CONNECTION_NAME"
     ]  # e.g. 'project:region:instance'
     db_user = os.environ.get("DB_USER", "")  # e.g. 'my-db-user'
@@ -39,7 +61,7 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
             "validate_host": False,
         }
 
-    def getconn() -> pytds.Connection:
+    def getconn():
         conn = connector.connect(
             instance_connection_name,
             "pytds",
@@ -54,31 +76,22 @@ def connect_with_connector() -> sqlalchemy.engine.base.Engine:
         "mssql+pytds://",
         creator=getconn,
         # [START_EXCLUDE]
-        # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
-        # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
+        # QueuePool that records checkout wait times for /metrics.
+        poolclass=TimedQueuePool,
         # The total number of concurrent connections for your application will be
         # a total of pool_size and max_overflow.
-        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
-        # new connection from the pool. After the specified amount of time, an
-        # exception will be thrown.
-        pool_timeout=30,  # 30 seconds
-        # 'pool_recycle' is the maximum number of seconds a connection can persist.
-        # Connections that live longer than the specified amount of time will be
-        # re-established
-        pool_recycle=1800,  # 30 minutes
+        **{**DEFAULT_POOL_OPTIONS, **pool_options},
         # [END_EXCLUDE]
     )
     return pool
 
-def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
+def connect_tcp_socket(db_host: str = None, **pool_options) -> sqlalchemy.engine.base.Engine:
     """Initializes a TCP connection pool for a Cloud SQL instance of SQL Server."""
     # Note: Saving credentials in environment variables is convenient, but not
     # secure - consider a more secure solution such as
     # Cloud Secret Manager (https://cloud.google.com/secret-manager) to help
     # keep secrets safe.
-    db_host = os.environ[
+    db_host = db_host or os.environ[
         "INSTANCE_HOST"
     ]  # e.g. '127.0.0.1' ('172.17.0.1' if deployed to GAE Flex)
     db_user = os.environ["DB_USER"]  # e.g. 'my-db-user'
@@ -121,30 +134,53 @@ def connect_tcp_socket() -> sqlalchemy.engine.base.Engine:
         # [START cloud_sql_sqlserver_sqlalchemy_connect_tcp]
         # [START_EXCLUDE]
         # [START cloud_sql_sqlserver_sqlalchemy_limit]
-        # Pool size is the maximum number of permanent connections to keep.
-        pool_size=5,
-        # Temporarily exceeds the set pool_size if no connections are available.
-        max_overflow=2,
+        # QueuePool that records checkout wait times for /metrics.
+        poolclass=TimedQueuePool,
         # The total number of concurrent connections for your application will be
-        # a total of pool_size and max_overflow.
+        # a total of pool_size and max_overflow; see DEFAULT_POOL_OPTIONS for
+        # the timeout, lifetime and checkout order.
+        **{**DEFAULT_POOL_OPTIONS, **pool_options},
         # [END cloud_sql_sqlserver_sqlalchemy_limit]
         # [START cloud_sql_sqlserver_sqlalchemy_backoff]
         # SQLAlchemy automatically uses delays between failed connection attempts,
         # but provides no arguments for configuration.
         # [END cloud_sql_sqlserver_sqlalchemy_backoff]
-        # [START cloud_sql_sqlserver_sqlalchemy_timeout]
-        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
-        # new connection from the pool. After the specified amount of time, an
-        # exception will be thrown.
-        pool_timeout=30,  # 30 seconds
-        # [END cloud_sql_sqlserver_sqlalchemy_timeout]
-        # [START cloud_sql_sqlserver_sqlalchemy_lifetime]
-        # 'pool_recycle' is the maximum number of seconds a connection can persist.
-        # Connections that live longer than the specified amount of time will be
-        # re-established
-        pool_recycle=1800,  # 30 minutes
-        # [END cloud_sql_sqlserver_sqlalchemy_lifetime]
         # [END_EXCLUDE]
     )
 
-    return pool
\ No newline at end of file
+    return pool
+
+def connect_url(url: str = None, **pool_options) -> sqlalchemy.engine.base.Engine:
+    """Initializes a connection pool from a SQLAlchemy URL, e.g. a local database for development and benchmarks."""
+    return sqlalchemy.create_engine(
+        url or os.environ["DATABASE_URL"],
+        poolclass=TimedQueuePool,
+        **{**DEFAULT_POOL_OPTIONS, **pool_options},
+    )
+
+def check_liveness(pool: sqlalchemy.engine.base.Engine, idle: float) -> None:
+    """Ping connections idle for more than `idle` seconds when they are checked out.
+
+    A cheaper stand-in for pool_pre_ping, which pings on every checkout: under
+    load connections are reused within milliseconds and skip the round trip.
+    With idle 0 every checkout is pinged. A dead connection is replaced
+    transparently.
+    """
+    @event.listens_for(pool, "checkin")
+    def checkin(dbapi_connection, connection_record):
+        connection_record.info['checked_in_at'] = time.monotonic()
+
+    @event.listens_for(pool, "checkout")
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        checked_in_at = connection_record.info.get('checked_in_at')
+        # A connection opened for this checkout is alive
+        if checked_in_at is None or time.monotonic() - checked_in_at <= idle:
+            return
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception as e:
+            db_pool_invalidations.inc()
+            # The pool discards this connection and checks out a new one
+            raise sqlalchemy.exc.DisconnectionError() from e
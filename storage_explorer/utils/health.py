@@ -0,0 +1,116 @@
+import importlib, os, threading
+
+import sqlalchemy
+from flask import jsonify
+from sqlalchemy.pool import QueuePool
+
+from storage_explorer import get_logger
+from storage_explorer.utils import config
+
+logger = get_logger()
+
+# Bucket looked up to open a GCS connection and fetch an access token at
+# startup; whether it exists does not matter.
+WARM_UP_BUCKET = "storage-explorer-warm-up"
+
+
+def warm_up() -> bool:
+    """Build the engine, migrate, fill the SQL pool and open a GCS connection. Returns whether the app is ready."""
+    global _ready
+    with _lock:
+        if _ready:
+            return True
+        try:
+            _warm_db()
+        except Exception as e:
+            logger.exception("Startup: database not ready: %s", e)
+            return False
+        _warm_storage()
+        _ready = True
+        logger.info("Startup: ready.")
+        return True
+
+def is_ready() -> bool:
+    return _ready
+
+def preload() -> None:
+    """Import the database driver and GCS client libraries the app will use, without connecting.
+
+    They are otherwise imported on first use. Run by the app factory with
+    PRELOAD_LIBRARIES and EAGER_STARTUP off, for servers that build the app
+    once before forking workers (gunicorn --preload): nothing is connected
+    nor started yet, so every worker starts with the libraries loaded and
+    creates its own pools.
+    """
+    modules = ["google.cloud.storage", "google.auth.transport.requests", "google.oauth2.service_account"]
+    if not os.environ.get("DATABASE_URL"):
+        modules.append("pytds")
+        if os.environ.get("INSTANCE_CONNECTION_NAME") or os.environ.get("INSTANCE_READ_CONNECTION_NAME"):
+            modules.append("google.cloud.sql.connector")
+    for name in modules:
+        importlib.import_module(name)
+
+# Internals
+def _warm_db() -> None:
+    from storage_explorer import db as db_module
+
+    db_module.init_db()
+    for name, engine in db_module.engines().items():
+        pool = engine.pool
+        size = pool.size() if isinstance(pool, QueuePool) else 1
+        # Hold pool_size connections at once so each one is really opened, then hand them back idle
+        connections = []
+        try:
+            for _ in range(size):
+                conn = engine.connect()
+                connections.append(conn)
+                conn.execute(sqlalchemy.text("SELECT 1"))
+        finally:
+            for conn in connections:
+                conn.close()
+        logger.info("Startup: %d %s database connections opened.", len(connections), name)
+
+def _warm_storage() -> None:
+    from google.api_core.exceptions import GoogleAPICallError
+    from storage_explorer.utils.storage_connector import get_client
+
+    try:
+        client = get_client(config.get_api_key())
+        client.bucket(WARM_UP_BUCKET).exists()
+    except (ValueError, GoogleAPICallError) as e:
+        # e.g. a 403 for someone else's bucket: the connection and token are warm anyway
+        logger.info("Startup: storage warm-up answered: %s", e)
+    except Exception as e:
+        logger.warning("Startup: storage not warmed: %s", e)
+
+def _healthz():
+    """Liveness: the process serves requests."""
+    return jsonify(status='ok')
+
+def _readyz():
+    """Readiness: startup finished and the database answers."""
+    if not warm_up():
+        return jsonify(status='starting'), 503
+    from storage_explorer.db import get_db
+
+    try:
+        with get_db().connect() as conn:
+            conn.execute(sqlalchemy.text("SELECT 1"))
+    except Exception as e:
+        logger.warning("Readiness check failed: %s", e)
+        return jsonify(status='unavailable', reason='database'), 503
+    return jsonify(status='ready')
+
+
+# Module state
+_ready = False
+_lock = threading.Lock()
+
+def init_app(app):
+    """Serve /healthz and /readyz, and warm up before serving unless EAGER_STARTUP is off."""
+    app.add_url_rule('/healthz', 'healthz', _healthz)
+    app.add_url_rule('/readyz', 'readyz', _readyz)
+    if app.config.get("EAGER_STARTUP", True):
+        warm_up()
+    elif app.config.get("PRELOAD_LIBRARIES"):
+        preload()
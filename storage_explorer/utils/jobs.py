@@ -0,0 +1,303 @@
+import datetime, json, random, threading, time, uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import sqlalchemy
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String, Table, Text
+
+from storage_explorer import get_logger
+from storage_explorer.db import get_db
+
+logger = get_logger()
+
+QUEUED, RUNNING, SUCCEEDED, FAILED = 'queued', 'running', 'succeeded', 'failed'
+# Finished jobs are deleted once older than the retention, checked this often.
+PRUNE_INTERVAL = 3600
+
+metadata = MetaData()
+
+# Slow storage operations run off the request threads. A job is claimed by
+# flipping it to running with a lease, renewed while it runs; a job whose
+# lease expired (its worker died) is claimed again, as another attempt.
+# `dedupe_key` collapses duplicate pending jobs.
+jobs_table = Table(
+    "jobs",
+    metadata,
+    Column("job_id", String(32), primary_key=True, nullable=False),
+    Column("kind", String(50), nullable=False),
+    Column("payload", Text, nullable=False),
+    Column("owner", String(100), nullable=True),
+    Column("dedupe_key", String(255), nullable=True),
+    Column("status", String(20), nullable=False),
+    Column("attempts", Integer, nullable=False),
+    Column("max_attempts", Integer, nullable=False),
+    Column("run_after", DateTime, nullable=False),
+    Column("lease_expires", DateTime, nullable=True),
+    Column("result", Text, nullable=True),
+    Column("error", Text, nullable=True),
+    Column("created_at", DateTime, nullable=False),
+    Column("updated_at", DateTime, nullable=False),
+    Index("ix_jobs_status_run_after", "status", "run_after"),
+    Index("ix_jobs_dedupe_key", "dedupe_key"),
+)
+
+
+class JobFailed(Exception):
+    """Raised by a job handler for an error that retrying cannot fix."""
+
+
+# Handlers keyed by job kind, registered with @handler.
+_handlers = {}
+
+def handler(kind: str):
+    """Register the function running the jobs of a kind; it takes the payload as keyword arguments."""
+    def decorator(func):
+        _handlers[kind] = func
+        return func
+    return decorator
+
+def enqueue(kind: str, payload: dict, owner: str = None, dedupe_key: str = None, max_attempts: int = None) -> str:
+    """Persist a job and wake the workers. Returns the job id.
+
+    With a dedupe_key, the id of a queued or running job with the same key
+    is returned instead of adding another one.
+    """
+    db = get_db()
+    now = _now()
+    with db.connect() as conn:
+        if dedupe_key is not None:
+            pending = conn.execute(
+                sqlalchemy.select(jobs_table.c.job_id).where(
+                    jobs_table.c.dedupe_key == dedupe_key,
+                    jobs_table.c.status.in_((QUEUED, RUNNING)),
+                ).limit(1)
+            ).scalar()
+            if pending is not None:
+                return pending
+
+        job_id = uuid.uuid4().hex
+        conn.execute(jobs_table.insert().values(
+            job_id=job_id,
+            kind=kind,
+            payload=json.dumps(payload),
+            owner=owner,
+            dedupe_key=dedupe_key,
+            status=QUEUED,
+            attempts=0,
+            max_attempts=max_attempts or _max_attempts,
+            run_after=now,
+            created_at=now,
+            updated_at=now,
+        ))
+        conn.commit()
+    _wake.set()
+    return job_id
+
+def get_job(job_id: str) -> dict:
+    """Return the public state of a job, or None when it does not exist."""
+    with get_db().connect() as conn:
+        row = conn.execute(
+            sqlalchemy.select(
+                jobs_table.c.job_id, jobs_table.c.kind, jobs_table.c.owner, jobs_table.c.status,
+                jobs_table.c.attempts, jobs_table.c.max_attempts, jobs_table.c.result, jobs_table.c.error,
+                jobs_table.c.run_after, jobs_table.c.created_at, jobs_table.c.updated_at,
+            ).where(jobs_table.c.job_id == job_id)
+        ).fetchone()
+    if row is None:
+        return None
+    job = dict(row._mapping)
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+def start() -> None:
+    """Start the dispatcher thread of this process, once."""
+    global _dispatcher
+    with _lock:
+        if _dispatcher is not None:
+            return
+        _dispatcher = threading.Thread(target=_dispatch_loop, name="jobs-dispatcher", daemon=True)
+        _dispatcher.start()
+
+# Internals
+def _start_on_request() -> None:
+    if _dispatcher is None:
+        start()
+
+def _dispatch_loop() -> None:
+    pruned_at = renewed_at = 0.0
+    while True:
+        claimed = []
+        try:
+            # Heartbeat: well before they expire, extend the leases of the jobs running here
+            if _leases and time.monotonic() - renewed_at > _lease / 3:
+                _renew_leases()
+                renewed_at = time.monotonic()
+            free = _workers - _running
+            if free > 0:
+                claimed = _claim(free)
+            if time.monotonic() - pruned_at > PRUNE_INTERVAL:
+                _prune()
+                pruned_at = time.monotonic()
+        except Exception as e:
+            logger.exception(e)
+        for job in claimed:
+            _adjust_running(1)
+            _executor.submit(_run, job)
+        # Poll for jobs enqueued by other processes and for retries coming due
+        if not claimed:
+            _wake.wait(_poll_interval)
+        _wake.clear()
+
+def _claim(limit: int) -> list:
+    """Claim up to limit due jobs, atomically against the other processes."""
+    now = _now()
+    due = (
+        ((jobs_table.c.status == QUEUED) & (jobs_table.c.run_after <= now))
+        | ((jobs_table.c.status == RUNNING) & (jobs_table.c.lease_expires < now))
+    )
+    claimed = []
+    with get_db().connect() as conn:
+        candidates = conn.execute(
+            sqlalchemy.select(
+                jobs_table.c.job_id, jobs_table.c.kind, jobs_table.c.payload,
+                jobs_table.c.status, jobs_table.c.attempts, jobs_table.c.max_attempts,
+            ).where(due).order_by(jobs_table.c.run_after).limit(limit)
+        ).all()
+        for job in candidates:
+            if job.status == RUNNING and job.attempts >= job.max_attempts:
+                # Its last attempt died without finishing: do not start another
+                conn.execute(
+                    jobs_table.update().where(
+                        jobs_table.c.job_id == job.job_id,
+                        jobs_table.c.status == RUNNING,
+                        jobs_table.c.attempts == job.attempts,
+                    ).values(status=FAILED, error="Lease expired on the last attempt.", lease_expires=None, updated_at=now)
+                )
+                continue
+            # Only the process whose update still sees the job as it was selected wins it
+            won = conn.execute(
+                jobs_table.update().where(
+                    jobs_table.c.job_id == job.job_id,
+                    jobs_table.c.status == job.status,
+                    jobs_table.c.attempts == job.attempts,
+                ).values(
+                    status=RUNNING,
+                    attempts=job.attempts + 1,
+                    lease_expires=now + datetime.timedelta(seconds=_lease),
+                    updated_at=now,
+                )
+            ).rowcount
+            if won:
+                claimed.append(dict(job._mapping, attempts=job.attempts + 1))
+        conn.commit()
+    return claimed
+
+def _renew_leases() -> None:
+    with _lock:
+        running = dict(_leases)
+    now = _now()
+    with get_db().connect() as conn:
+        for job_id, attempts in running.items():
+            conn.execute(
+                jobs_table.update().where(
+                    jobs_table.c.job_id == job_id,
+                    jobs_table.c.status == RUNNING,
+                    jobs_table.c.attempts == attempts,
+                ).values(lease_expires=now + datetime.timedelta(seconds=_lease), updated_at=now)
+            )
+        conn.commit()
+
+def _prune() -> None:
+    """Drop finished jobs older than the retention period."""
+    with get_db().connect() as conn:
+        conn.execute(jobs_table.delete().where(
+            jobs_table.c.status.in_((SUCCEEDED, FAILED)),
+            jobs_table.c.updated_at < _now() - datetime.timedelta(seconds=_retention),
+        ))
+        conn.commit()
+
+def _run(job: dict) -> None:
+    with _lock:
+        _leases[job['job_id']] = job['attempts']
+    try:
+        func = _handlers.get(job['kind'])
+        if func is None:
+            raise JobFailed(f"Unknown job kind {job['kind']}.")
+        with _app.app_context():
+            result = func(**json.loads(job['payload']))
+        _finish(job, status=SUCCEEDED, result=json.dumps(result) if result is not None else None, error=None)
+    except Exception as e:
+        retry = not isinstance(e, JobFailed) and job['attempts'] < job['max_attempts']
+        if retry:
+            logger.warning("Job %s (%s) failed, attempt %d of %d: %s", job['job_id'], job['kind'], job['attempts'], job['max_attempts'], e)
+            # Exponential backoff with jitter, so retries of many jobs spread out
+            delay = min(_backoff * 2 ** (job['attempts'] - 1), _max_backoff) * random.uniform(0.5, 1.0)
+            _finish(job, status=QUEUED, error=str(e), run_after=_now() + datetime.timedelta(seconds=delay))
+        else:
+            logger.exception(e)
+            _finish(job, status=FAILED, error=str(e))
+    finally:
+        with _lock:
+            _leases.pop(job['job_id'], None)
+        _adjust_running(-1)
+        _wake.set()
+
+def _finish(job: dict, **values) -> None:
+    with get_db().connect() as conn:
+        # A worker whose lease was lost (and the job claimed again) does not overwrite the newer attempt
+        conn.execute(
+            jobs_table.update().where(
+                jobs_table.c.job_id == job['job_id'],
+                jobs_table.c.attempts == job['attempts'],
+            ).values(lease_expires=None, updated_at=_now(), **values)
+        )
+        conn.commit()
+
+def _adjust_running(delta: int) -> None:
+    global _running
+    with _lock:
+        _running += delta
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+# Module state, set by init_app
+_app = None
+_workers = 4
+_max_attempts = 5
+_backoff = 2.0
+_max_backoff = 600.0
+_poll_interval = 5.0
+_lease = 900
+_retention = 7 * 24 * 3600
+_running = 0
+_leases = {}  # job id -> attempt, of the jobs running in this process
+_lock = threading.Lock()
+_wake = threading.Event()
+_dispatcher = None
+_executor = None
+
+@click.command('run-jobs')
+def run_jobs_command():
+    """Run the background job workers in the foreground."""
+    start()
+    click.echo(f"Running background jobs with {_workers} workers.")
+    _dispatcher.join()
+
+def init_app(app):
+    """Size the worker pool from the app config; unless JOBS_IN_PROCESS is off, start it on the first request."""
+    global _app, _workers, _max_attempts, _backoff, _poll_interval, _lease, _retention, _executor
+    _app = app
+    _workers = app.config.get("JOB_WORKERS", _workers)
+    _max_attempts = app.config.get("JOB_MAX_ATTEMPTS", _max_attempts)
+    _backoff = app.config.get("JOB_RETRY_BACKOFF", _backoff)
+    _poll_interval = app.config.get("JOB_POLL_INTERVAL", _poll_interval)
+    _lease = app.config.get("JOB_LEASE", _lease)
+    _retention = app.config.get("JOB_RETENTION", _retention)
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=_workers, thread_name_prefix="job")
+    app.cli.add_command(run_jobs_command)
+    if app.config.get("JOBS_IN_PROCESS", True):
+        # Not from the factory: CLI commands build the app too and must not run workers
+        app.before_request(_start_on_request)
@@ -0,0 +1,269 @@
+import bisect, contextvars, secrets, threading, time
+
+from flask import Response, abort, current_app, g, request
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from storage_explorer import get_logger
+
+logger = get_logger()
+
+# Latency buckets in seconds; the slow end covers streamed listings and transfers.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Counter:
+    """Monotonic counter with labels, in the Prometheus text format."""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in values:
+            yield f"{self.name}_total", label_values, value
+
+
+class Histogram:
+    """Cumulative histogram with labels, in the Prometheus text format."""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", label_values + (('le', _format_bound(bound)),), cumulative
+            yield f"{self.name}_sum", label_values, counts[-1]
+            yield f"{self.name}_count", label_values, cumulative
+
+
+class RequestStats:
+    """Time spent in SQL and GCS by the current request, for the Server-Timing header."""
+
+    __slots__ = ('db_queries', 'db_time', 'gcs_calls', 'gcs_time')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.gcs_calls = 0
+        self.gcs_time = 0.0
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waited for a connection, and the ones that timed out."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            db_pool_timeouts.inc()
+            raise
+        finally:
+            db_pool_wait.observe(time.perf_counter() - started)
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time to serve a request, streamed bodies included.",
+    labels=('endpoint', 'method', 'status'),
+)
+db_query_duration = Histogram("db_query_duration_seconds", "Time of each SQL statement.")
+db_pool_wait = Histogram("db_pool_wait_seconds", "Time waited to check a connection out of the pool.")
+db_pool_timeouts = Counter("db_pool_timeouts", "Checkouts that gave up waiting for a connection.")
+db_pool_invalidations = Counter("db_pool_invalidations", "Pooled connections found dead by the liveness check.")
+gcs_request_duration = Histogram(
+    "gcs_request_duration_seconds", "Time until GCS answered with response headers.",
+    labels=('operation', 'status'),
+)
+gcs_bytes = Counter("gcs_bytes", "Bytes sent to and received from GCS.", labels=('direction',))
+
+_registry = [
+    http_request_duration, db_query_duration, db_pool_wait, db_pool_timeouts, db_pool_invalidations,
+    gcs_request_duration, gcs_bytes,
+]
+# Stats of the request running in the current thread, None outside requests.
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+def record_gcs_response(response, *args, **kwargs):
+    """requests response hook counting one GCS call, its bytes and its time."""
+    request_body = response.request.body
+    sent = len(request_body) if isinstance(request_body, (bytes, str)) else 0
+    received = int(response.headers.get('Content-Length') or 0)
+    elapsed = response.elapsed.total_seconds()
+
+    gcs_request_duration.observe(elapsed, _gcs_operation(response.request), str(response.status_code))
+    if sent:
+        gcs_bytes.inc('sent', amount=sent)
+    if received:
+        gcs_bytes.inc('received', amount=received)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.gcs_calls += 1
+        stats.gcs_time += elapsed
+    return response
+
+def render() -> str:
+    """Render every metric, plus the pool and cache counters read at scrape time, in the Prometheus text format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, label_values, value in metric.samples():
+            lines.append(f"{name}{_format_labels(metric.labels, label_values)} {value}")
+    for name, kind, help, samples in _collected():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        sample_name = f"{name}_total" if kind == 'counter' else name
+        for labels, value in samples:
+            lines.append(f"{sample_name}{_format_labels(tuple(labels), tuple(labels.values()))} {value}")
+    return '\n'.join(lines) + '\n'
+
+# Internals
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Statements of a connection run one at a time
+    conn.info['query_started'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop('query_started')
+    db_query_duration.observe(elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.db_queries += 1
+        stats.db_time += elapsed
+
+def _handle_error(context):
+    # A failed statement gets no after_cursor_execute: drop its start time
+    if context.connection is not None:
+        context.connection.info.pop('query_started', None)
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    _request_stats.set(RequestStats())
+
+def _finish_request(response: Response) -> Response:
+    started = g.get('request_started')
+    if started is None:
+        return response
+    labels = (request.endpoint or 'unmatched', request.method, str(response.status_code))
+
+    # Streamed bodies are still being produced: observe the latency once they are sent
+    response.call_on_close(lambda: http_request_duration.observe(time.perf_counter() - started, *labels))
+    g.request_observed = True
+
+    if current_app.config.get('SERVER_TIMING'):
+        stats = _request_stats.get()
+        response.headers['Server-Timing'] = ', '.join((
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.db_queries} queries"',
+            f'gcs;dur={stats.gcs_time * 1000:.1f};desc="{stats.gcs_calls} calls"',
+            f'app;dur={(time.perf_counter() - started) * 1000:.1f}',
+        ))
+    return response
+
+def _teardown_request(error) -> None:
+    # Requests that raised past the error handlers never reach _finish_request
+    started = g.get('request_started')
+    if started is not None and not g.get('request_observed'):
+        http_request_duration.observe(time.perf_counter() - started, request.endpoint or 'unmatched', request.method, '500')
+
+def _metrics_view():
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token:
+        # Timings by route and bucket are not public: only served without a token in debug mode
+        if not current_app.debug:
+            abort(403)
+    elif not secrets.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(403)
+    return Response(render(), mimetype='text/plain; version=0.0.4')
+
+def _collected():
+    from storage_explorer import db as db_module
+    from storage_explorer.utils import cache, storage_connector
+
+    pools = {name: engine.pool for name, engine in db_module.engines().items() if isinstance(engine.pool, QueuePool)}
+    if pools:
+        yield "db_pool_size", 'gauge', "Permanent connections of each SQL pool.", [
+            ({'pool': name}, pool.size()) for name, pool in pools.items()
+        ]
+        yield "db_pool_connections", 'gauge', "Connections of each SQL pool by state.", [
+            ({'pool': name, 'state': state}, value)
+            for name, pool in pools.items()
+            for state, value in (('checked_out', pool.checkedout()), ('idle', pool.checkedin()), ('overflow', max(pool.overflow(), 0)))
+        ]
+    storage = storage_connector.registry.stats()
+    yield "gcs_http_connections_opened", 'counter', "HTTP connections opened to GCS (TLS handshakes).", [({}, storage['handshakes'])]
+    yield "gcs_http_requests_pooled", 'counter', "GCS requests sent on a reused connection.", [({}, storage['pool_hits'])]
+    caches = cache.stats()
+    yield "cache_hits", 'counter', "Hits of the in-process caches.", [({'cache': stats['name']}, stats['hits']) for stats in caches]
+    yield "cache_misses", 'counter', "Misses of the in-process caches.", [({'cache': stats['name']}, stats['misses']) for stats in caches]
+
+def _gcs_operation(prepared_request) -> str:
+    url = prepared_request.url or ''
+    if '/upload/' in url:
+        return 'upload'
+    if 'alt=media' in url:
+        return 'download'
+    if '/batch/' in url:
+        return 'batch'
+    return 'metadata'
+
+def _format_labels(names: tuple, values: tuple) -> str:
+    pairs = list(zip(names, values)) + [value for value in values[len(names):]]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + '}'
+
+def _format_bound(bound) -> str:
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def init_app(app):
+    """Time every request, SQL statement and GCS call, and serve them on /metrics, unless METRICS_ENABLED is off."""
+    if not app.config.get("METRICS_ENABLED", True):
+        return
+    # Engine-wide listeners cover the engine get_db() creates lazily
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.teardown_request(_teardown_request)
+    if not app.config.get("METRICS_TOKEN") and not app.debug:
+        logger.warning("METRICS_TOKEN is not set: /metrics answers 403 until it is.")
+    app.add_url_rule('/metrics', 'metrics', _metrics_view)
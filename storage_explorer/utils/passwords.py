@@ -0,0 +1,98 @@
+import multiprocessing, os, threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    """Raised when too many hashes are already queued, or one takes too long; the caller should ask to retry."""
+
+
+def hash_password(password: str) -> str:
+    """Hash a password with the configured method, on the hashing pool."""
+    return _run(generate_password_hash, password, method)
+
+def verify_password(pwhash: str, password: str) -> bool:
+    """Check a password against its hash, on the hashing pool."""
+    return _run(check_password_hash, pwhash, password)
+
+def needs_rehash(pwhash: str) -> bool:
+    """Whether a hash was made with other parameters than the configured ones."""
+    return pwhash.split('$', 1)[0] != _hash_prefix()
+
+# Internals
+def _run(func, *args):
+    # Bound the queue, so a login burst fails fast instead of piling up behind the workers
+    if not _slots.acquire(timeout=queue_timeout):
+        raise HashingBusy()
+    try:
+        pool = _pool()
+        if pool is None:
+            return func(*args)
+        future = pool.submit(func, *args)
+        try:
+            return future.result(timeout=queue_timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingBusy()
+    except BrokenProcessPool:
+        # A worker died: the next hash starts a new pool
+        _discard_pool(pool)
+        raise HashingBusy()
+    finally:
+        _slots.release()
+
+def _pool() -> ProcessPoolExecutor:
+    """The hashing pool of this process, started on first use, or None without workers.
+
+    Never built by the app factory: a pool inherited by a worker forked after
+    it (gunicorn --preload) has no live threads and would hang every hash.
+    """
+    global _hashers, _hashers_pid
+    if not _workers:
+        return None
+    if _hashers is None or _hashers_pid != os.getpid():
+        with _pool_lock:
+            if _hashers is None or _hashers_pid != os.getpid():
+                # Spawned, not forked: a child of a process running threads (the
+                # job dispatcher, the SQL pool) can inherit a held lock and hang,
+                # and a fork server started before a fork is not the child's
+                _hashers = ProcessPoolExecutor(max_workers=_workers, mp_context=multiprocessing.get_context('spawn'))
+                _hashers_pid = os.getpid()
+    return _hashers
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    global _hashers
+    with _pool_lock:
+        if _hashers is pool:
+            _hashers = None
+
+def _hash_prefix() -> str:
+    """The "method:params" prefix of hashes made now, e.g. "scrypt:32768:8:1"."""
+    global _prefix
+    if _prefix is None:
+        # werkzeug fills in the default parameters of a bare method name, so ask it
+        _prefix = generate_password_hash('', method).split('$', 1)[0]
+    return _prefix
+
+
+# Module state, set by init_app
+method = "scrypt:32768:8:1"
+queue_timeout = 10.0
+_prefix = None
+_slots = threading.BoundedSemaphore(8)
+# scrypt and pbkdf2 hold the GIL: run them on processes so request threads keep serving.
+_workers = 2
+_hashers = None
+_hashers_pid = None
+_pool_lock = threading.Lock()
+
+def init_app(app):
+    """Set the hash parameters and the size of the hashing process pool from the app config."""
+    global method, queue_timeout, _prefix, _slots, _workers
+    method = app.config.get("PASSWORD_HASH_METHOD", method)
+    queue_timeout = app.config.get("PASSWORD_HASH_TIMEOUT", queue_timeout)
+    _prefix = None
+    _workers = app.config.get("PASSWORD_HASH_WORKERS", _workers)
+    _slots = threading.BoundedSemaphore(max(1, _workers) * app.config.get("PASSWORD_HASH_QUEUE", 4))
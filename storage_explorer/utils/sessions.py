@@ -0,0 +1,237 @@
+import secrets, threading, time
+from collections import OrderedDict
+
+import click
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from storage_explorer import get_logger
+from storage_explorer.utils.cache import LocalSharedStore
+
+logger = get_logger()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session whose data lives in a session store; the cookie only carries its id."""
+
+    def __init__(self, initial=None, sid: str = None, owner: str = None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        # Username the stored session belongs to, to index it and to spot logins
+        self.owner = owner
+        self.new = sid is None
+        self.modified = False
+        self.accessed = False
+
+
+class LocalSessionStore:
+    """In-process sessions, least recently used dropped past maxsize. Only for a single process."""
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()  # sid -> (data, owner, expires_at)
+        self._by_owner = {}
+        self._lock = threading.Lock()
+
+    def load(self, sid: str, ttl: float) -> dict:
+        """Return the data of a session and extend its lifetime, or None once expired."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._sessions.get(sid)
+            if item is None:
+                return None
+            data, owner, expires_at = item
+            if expires_at <= now:
+                self._drop(sid)
+                return None
+            self._sessions[sid] = (data, owner, now + ttl)
+            self._sessions.move_to_end(sid)
+            return dict(data)
+
+    def save(self, sid: str, data: dict, owner: str, ttl: float) -> None:
+        with self._lock:
+            self._drop(sid)
+            self._sessions[sid] = (dict(data), owner, time.monotonic() + ttl)
+            if owner is not None:
+                self._by_owner.setdefault(owner, set()).add(sid)
+            while len(self._sessions) > self.maxsize:
+                self._drop(next(iter(self._sessions)))
+
+    def delete(self, sid: str) -> None:
+        with self._lock:
+            self._drop(sid)
+
+    def revoke(self, owner: str) -> int:
+        """Delete every session of a user; returns how many."""
+        with self._lock:
+            sids = self._by_owner.pop(owner, set())
+            for sid in sids:
+                self._sessions.pop(sid, None)
+            return len(sids)
+
+    def _drop(self, sid: str) -> None:
+        item = self._sessions.pop(sid, None)
+        if item is not None and item[1] is not None:
+            sids = self._by_owner.get(item[1])
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._by_owner[item[1]]
+
+
+class SharedSessionStore:
+    """Sessions in a shared store with the redis-py API subset of LocalSharedStore, e.g. Redis.
+
+    Lifetimes slide on access but are written back at most every `refresh`
+    seconds, so most requests cost one read.
+    """
+
+    def __init__(self, client, refresh: float = 60):
+        self.client = client
+        self.refresh = refresh
+        self._serializer = TaggedJSONSerializer()
+
+    def load(self, sid: str, ttl: float) -> dict:
+        raw = self.client.get(f"session:{sid}")
+        if raw is None:
+            return None
+        record = self._serializer.loads(raw)
+        if time.time() - record['touched'] > self.refresh:
+            self._write(sid, record['data'], record['owner'], ttl)
+            if record['owner'] is not None:
+                self.client.expire(f"user_sessions:{record['owner']}", int(ttl))
+        return record['data']
+
+    def save(self, sid: str, data: dict, owner: str, ttl: float) -> None:
+        self._write(sid, data, owner, ttl)
+        if owner is not None:
+            key = f"user_sessions:{owner}"
+            # Forget the sessions of the owner that expired since, then keep
+            # the set as long as its newest session
+            stale = [member for member in self.client.smembers(key) if not self.client.exists(f"session:{_text(member)}")]
+            if stale:
+                self.client.srem(key, *stale)
+            self.client.sadd(key, sid)
+            self.client.expire(key, int(ttl))
+
+    def delete(self, sid: str) -> None:
+        raw = self.client.get(f"session:{sid}")
+        self.client.delete(f"session:{sid}")
+        if raw is not None:
+            owner = self._serializer.loads(raw)['owner']
+            if owner is not None:
+                self.client.srem(f"user_sessions:{owner}", sid)
+
+    def revoke(self, owner: str) -> int:
+        keys = [f"session:{_text(sid)}" for sid in self.client.smembers(f"user_sessions:{owner}")]
+        # Ids of sessions that expired meanwhile are dropped with the set, uncounted
+        revoked = self.client.exists(*keys) if keys else 0
+        if keys:
+            self.client.delete(*keys)
+        self.client.delete(f"user_sessions:{owner}")
+        return revoked
+
+    def _write(self, sid: str, data: dict, owner: str, ttl: float) -> None:
+        record = {'data': dict(data), 'owner': owner, 'touched': time.time()}
+        self.client.set(f"session:{sid}", self._serializer.dumps(record), ex=int(ttl))
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps sessions in a session store, expiring after `ttl` seconds without a request."""
+
+    def __init__(self, store, ttl: float):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request) -> ServerSideSession:
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.load(sid, self.ttl)
+            if data is not None:
+                return ServerSideSession(data, sid=sid, owner=data.get('username'))
+        return ServerSideSession()
+
+    def save_session(self, app, session: ServerSideSession, response) -> None:
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if not session:
+            if session.sid is not None and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=self.get_cookie_secure(app),
+                                       httponly=self.get_cookie_httponly(app), samesite=self.get_cookie_samesite(app))
+            return
+        if not session.modified:
+            return
+
+        owner = session.get('username')
+        sid = session.sid
+        if sid is None or owner != session.owner:
+            # A new id on login, so an id planted before it is worthless
+            if sid is not None:
+                self.store.delete(sid)
+            sid = secrets.token_urlsafe(32)
+        self.store.save(sid, session, owner, self.ttl)
+        if sid != session.sid or session.permanent:
+            response.set_cookie(
+                name, sid,
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+
+def is_server_side(session) -> bool:
+    """Whether the session is kept by a session store, so it may carry the user record."""
+    return isinstance(session, ServerSideSession)
+
+def revoke_user(username: str) -> int:
+    """End every session of a user; returns how many. Without a session store there is nothing to end."""
+    if store is None:
+        return 0
+    return store.revoke(username)
+
+# Utils
+def _text(member) -> str:
+    # redis-py returns bytes unless decode_responses is set
+    return member.decode() if isinstance(member, bytes) else member
+
+
+# Module state, set by init_app
+store = None
+
+@click.command('revoke-sessions')
+@click.argument('usernames', nargs=-1, required=True)
+def revoke_sessions_command(usernames):
+    """End every session of the given users (needs the shared session store)."""
+    revoked = sum(revoke_user(username) for username in usernames)
+    click.echo(f"Revoked {revoked} sessions.")
+
+def init_app(app):
+    """Keep sessions server-side when SESSION_BACKEND is local or shared; cookie sessions otherwise."""
+    global store
+    backend = app.config.get("SESSION_BACKEND", "cookie")
+    if backend == "local":
+        store = LocalSessionStore(maxsize=app.config.get("SESSION_STORE_SIZE", 100_000))
+    elif backend == "shared":
+        client = app.config.get("SESSION_SHARED_STORE")
+        if client is None:
+            logger.warning("SESSION_BACKEND is shared but no SESSION_SHARED_STORE is set: using an in-process stand-in.")
+            client = LocalSharedStore()
+        store = SharedSessionStore(client)
+    else:
+        store = None
+        return
+    app.session_interface = ServerSessionInterface(store, ttl=app.config.get("SESSION_IDLE_TIMEOUT", 24 * 3600))
+    app.cli.add_command(revoke_sessions_command)
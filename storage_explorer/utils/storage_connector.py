@@ -0,0 +1,176 @@
+import os, threading
+
+from storage_explorer import get_logger
+from storage_explorer.utils import config, metrics
+
+logger = get_logger()
+
+STORAGE_SCOPES = ("https://www.googleapis.com/auth/devstorage.full_control",)
+
+# Key used for the anonymous client that talks to a local storage emulator
+# (e.g. fake-gcs-server) when STORAGE_EMULATOR_HOST is defined.
+EMULATOR_KEY = "emulator"
+
+
+class ClientRegistry:
+    """Process-wide registry holding one long-lived storage client per service account.
+
+    Every client shares a sized HTTP connection pool, so gunicorn threads reuse
+    open TLS connections instead of paying for a new handshake on each request.
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 10, max_retries: int = 3):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        # Optional callable(api_key) -> client, used to plug a fake backend in tests.
+        self.factory = None
+        self._clients = {}
+        self._adapters = []
+        self._lock = threading.Lock()
+        self._client_hits = 0
+        self._client_misses = 0
+
+    def configure(self, pool_connections: int = None, pool_maxsize: int = None, factory=None) -> None:
+        """Update pool sizing and backend factory, dropping any client built with the old settings."""
+        with self._lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            self.factory = factory
+            self._close_all()
+
+    def get_client(self, api_key: dict):
+        """Return the shared client for the given service account, building it on first use."""
+        key = self._key_for(api_key)
+        client = self._clients.get(key)
+        if client is not None:
+            self._client_hits += 1
+            return client
+
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                self._client_misses += 1
+                client = self._build_client(api_key)
+                self._clients[key] = client
+                logger.info("Storage client created for %s.", key)
+            else:
+                self._client_hits += 1
+        return client
+
+    def register(self, key: str, client) -> None:
+        """Register a prebuilt client (e.g. a local fake) under a service account key."""
+        with self._lock:
+            self._clients[key] = client
+
+    def clear(self) -> None:
+        """Close and forget every registered client."""
+        with self._lock:
+            self._close_all()
+
+    def stats(self) -> dict:
+        """Return registry and HTTP connection pool counters."""
+        requests_sent = 0
+        handshakes = 0
+        for adapter in self._adapters:
+            for pool in _pools_of(adapter):
+                requests_sent += pool.num_requests
+                handshakes += pool.num_connections
+        return {
+            'clients': len(self._clients),
+            'client_hits': self._client_hits,
+            'client_misses': self._client_misses,
+            'http_requests': requests_sent,
+            'handshakes': handshakes,
+            'pool_hits': max(requests_sent - handshakes, 0),
+        }
+
+    # Internals
+    def _key_for(self, api_key: dict) -> str:
+        if os.environ.get("STORAGE_EMULATOR_HOST"):
+            return EMULATOR_KEY
+        return api_key.get("client_email") or api_key.get("private_key_id") or "default"
+
+    def _build_client(self, api_key: dict):
+        if self.factory is not None:
+            return self.factory(api_key)
+        # Imported on the first client, so processes that never reach GCS do not load them
+        import requests
+        from google.auth.credentials import AnonymousCredentials
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import storage
+        from google.oauth2 import service_account
+
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            max_retries=self.max_retries,
+        )
+        self._adapters.append(adapter)
+
+        if os.environ.get("STORAGE_EMULATOR_HOST"):
+            # The client picks up STORAGE_EMULATOR_HOST itself; only credentials are faked.
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.hooks['response'].append(metrics.record_gcs_response)
+            return storage.Client(
+                project=api_key.get("project_id", "local"),
+                credentials=AnonymousCredentials(),
+                _http=session,
+            )
+
+        credentials = service_account.Credentials.from_service_account_info(api_key, scopes=STORAGE_SCOPES)
+        session = AuthorizedSession(credentials)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.hooks['response'].append(metrics.record_gcs_response)
+        return storage.Client(
+            project=api_key.get("project_id"),
+            credentials=credentials,
+            _http=session,
+        )
+
+    def _close_all(self) -> None:
+        for client in self._clients.values():
+            close = getattr(client, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception as e:
+                    logger.exception(e)
+        self._clients = {}
+        self._adapters = []
+
+
+def _pools_of(adapter):
+    pools = adapter.poolmanager.pools
+    with pools.lock:
+        return [pools[key] for key in pools.keys()]
+
+
+# Process-wide registry shared by every request thread.
+registry = ClientRegistry()
+
+def get_client(api_key: dict):
+    """Get the shared storage client for the given service account."""
+    return registry.get_client(api_key)
+
+def init_app(app):
+    """Configure the client registry from the app config and warm the default client, unless EAGER_STARTUP is off."""
+    registry.configure(
+        pool_connections=app.config.get("STORAGE_POOL_CONNECTIONS"),
+        pool_maxsize=app.config.get("STORAGE_POOL_MAXSIZE"),
+        factory=app.config.get("STORAGE_CLIENT_FACTORY"),
+    )
+    if not app.config.get("EAGER_STARTUP", True):
+        return
+
+    try:
+        api_key = config.get_api_key()
+    except ValueError as e:
+        logger.warning("Storage client not warmed: %s", e)
+        return
+    registry.get_client(api_key)
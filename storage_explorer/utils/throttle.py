@@ -0,0 +1,84 @@
+import math, threading, time
+from collections import OrderedDict
+
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+
+class LocalBuckets:
+    """In-process token buckets keyed by string, least recently used dropped past maxsize.
+
+    A shared backend (e.g. backed by Redis) replaces it through the
+    THROTTLE_BACKEND setting by implementing the same `take`.
+    """
+
+    def __init__(self, maxsize: int = 100_000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: int, period: float) -> float:
+        """Take one token from a bucket of capacity refilled over period seconds.
+
+        Returns 0 when a token was taken, else the seconds until one is available.
+        """
+        rate = capacity / period
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(capacity), now]
+                while len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / rate
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+def login_attempt(ip: str, username: str) -> int:
+    """Count a login attempt against its client address and its username.
+
+    Returns 0 when it may go on, else the seconds to wait. Checked before the
+    password is hashed, so refused attempts cost no hashing.
+    """
+    if not enabled:
+        return 0
+    wait = backend.take(f"login:ip:{ip}", ip_limit, period)
+    if not wait:
+        wait = backend.take(f"login:user:{username.lower()}", user_limit, period)
+    return math.ceil(wait)
+
+def register_attempt(ip: str) -> int:
+    """Count a registration attempt against its client address; returns the seconds to wait, or 0."""
+    if not enabled:
+        return 0
+    return math.ceil(backend.take(f"register:ip:{ip}", ip_limit, period))
+
+
+# Module state, set by init_app
+enabled = True
+ip_limit = 20
+user_limit = 5
+period = 60.0
+backend = LocalBuckets()
+
+def init_app(app):
+    """Set the login limits and backend from the app config, and trust PROXY_FIX_X_FOR proxies for client addresses."""
+    global enabled, ip_limit, user_limit, period, backend
+    enabled = app.config.get("LOGIN_THROTTLE_ENABLED", enabled)
+    ip_limit = app.config.get("LOGIN_IP_LIMIT", ip_limit)
+    user_limit = app.config.get("LOGIN_USER_LIMIT", user_limit)
+    period = app.config.get("LOGIN_THROTTLE_PERIOD", period)
+    backend = app.config.get("THROTTLE_BACKEND") or LocalBuckets()
+    # Behind a load balancer (e.g. Cloud Run) remote_addr is the proxy's unless X-Forwarded-For is trusted
+    proxies = app.config.get("PROXY_FIX_X_FOR", 0)
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)